@@ -0,0 +1,104 @@
+"""Parse adduct notations like [M+H]+, [2M+Na]+, [M-H2O+H]+ or [M+H+H]2+."""
+import re
+from functools import lru_cache
+from typing import NamedTuple, Iterable
+
+import numpy as np
+
+ELECTRON_MASS = 0.000548579909
+
+# monoisotopic masses
+ELEMENT_MASSES: dict[str, float] = {
+    'H': 1.00782503207,
+    'Li': 7.0160034366,
+    'C': 12.,
+    'N': 14.0030740048,
+    'O': 15.99491461956,
+    'F': 18.99840322,
+    'Na': 22.9897692809,
+    'P': 30.97376163,
+    'S': 31.97207100,
+    'Cl': 34.96885268,
+    'K': 38.96370668,
+    'Br': 78.9183371,
+}
+
+# common abbreviations in adduct notations
+GROUP_FORMULAS: dict[str, str] = {
+    'ACN': 'C2H3N',
+    'FA': 'CH2O2',
+    'HCOO': 'CHO2',
+    'Hac': 'C2H4O2',
+    'HAc': 'C2H4O2',
+    'MeOH': 'CH4O',
+    'DMSO': 'C2H6OS',
+    'TFA': 'C2HF3O2',
+}
+
+_pattern_adduct = re.compile(r'^\[(\d*)M(.*)\](\d*)([+-])$')
+_pattern_term = re.compile(r'([+-])(\d*)([A-Za-z][A-Za-z0-9]*)')
+_pattern_element = re.compile(r'([A-Z][a-z]?)(\d*)')
+
+
+class Adduct(NamedTuple):
+    """m/z = (n_M * M + mass_shift) / |charge|"""
+    name: str
+    n_M: int
+    mass_shift: float
+    charge: int
+
+    def mz_from_M(self, M: float | np.ndarray) -> float | np.ndarray:
+        return (self.n_M * M + self.mass_shift) / abs(self.charge)
+
+    def M_from_mz(self, mz: float | np.ndarray) -> float | np.ndarray:
+        return (mz * abs(self.charge) - self.mass_shift) / self.n_M
+
+
+def formula_mass(formula: str) -> float:
+    formula = GROUP_FORMULAS.get(formula, formula)
+    elements = _pattern_element.findall(formula)
+    if ''.join(e + n for e, n in elements) != formula:
+        raise ValueError(f'cannot parse formula {formula}')
+    return sum(ELEMENT_MASSES[e] * (int(n) if n else 1) for e, n in elements)
+
+
+@lru_cache(maxsize=None)
+def parse_adduct(adduct: str) -> Adduct:
+    """Raises ValueError for notations that cannot be parsed."""
+    match = _pattern_adduct.match(adduct.replace(' ', ''))
+    if match is None:
+        raise ValueError(f'cannot parse adduct {adduct}')
+    n_M, terms, charge, sign = match.groups()
+    n_M = int(n_M) if n_M else 1
+    charge = (int(charge) if charge else 1) * (1 if sign == '+' else -1)
+
+    parsed_terms = _pattern_term.findall(terms)
+    if ''.join(s + n + f for s, n, f in parsed_terms) != terms:
+        raise ValueError(f'cannot parse adduct {adduct}')
+
+    mass_shift = sum(
+        (1 if s == '+' else -1) * (int(n) if n else 1) * formula_mass(f)
+        for s, n, f in parsed_terms
+    )
+    # charge is carried by missing/extra electrons
+    mass_shift -= charge * ELECTRON_MASS
+    return Adduct(name=adduct, n_M=n_M, mass_shift=mass_shift, charge=charge)
+
+
+def try_parse_adduct(adduct: str | None) -> Adduct | None:
+    if adduct is None:
+        return None
+    try:
+        return parse_adduct(adduct)
+    except (ValueError, KeyError):
+        return None
+
+
+def parse_adducts(adducts: Iterable[str]) -> list[Adduct]:
+    return [parse_adduct(a) for a in adducts]
+
+
+if __name__ == '__main__':
+    M = 760.5856  # PC 34:1
+    for a in ['[M+H]+', '[M+Na]+', '[M+NH4]+', '[M-H]-', '[M+HCOO]-', '[2M+H]+', '[M+H+H]2+', '[M-H2O+H]+']:
+        print(a, round(parse_adduct(a).mz_from_M(M), 4))
@@ -126,6 +126,47 @@ def write_table(project_import_manager: ProjectImportManager) -> tuple[pd.DataFr
     return df, df_intensities, excluded_properties
 
 
+def write_table_columnar(project_import_manager: ProjectImportManager) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Same tables as write_table, but joined from the tables of the import
+    managers on the feature id instead of instantiating every feature.
+    Attributes are taken from MetaboScape first, then from the preferred ion
+    of the mgf file, GNPS and the best SIRIUS candidates (same order as in
+    FeatureCombinedFlat). Intensities are samples x feature ids, e.g.
+
+        df, df_intensities = write_table_columnar(project_import_manager)
+        df.to_csv(path_table, index=False)
+    """
+    include_dtypes = [int, float, str]
+    columns = [col for col, dtype in FeatureCombinedFlat.__annotations__.items()
+               if dtype in include_dtypes]
+
+    managers = project_import_manager.active_managers
+    tables: list[pd.DataFrame] = []
+    if 'metaboscape' in managers:
+        tables.append(managers['metaboscape'].get_table())
+    if 'mgf' in managers:
+        tables.append(managers['mgf'].get_table())
+    if 'gnps' in managers:
+        tables.append(managers['gnps'].get_table())
+    if 'sirius' in managers:
+        tables.append(managers['sirius'].get_highest_scoring_table())
+
+    f_ids = project_import_manager.feature_ids
+    df = pd.DataFrame(index=pd.Index(f_ids, name='feature_id'))
+    for table in tables:
+        df = df.combine_first(table.loc[:, [c for c in table.columns if c in columns]])
+    df = df.reindex(index=f_ids, columns=columns)
+    df['feature_id'] = f_ids
+
+    if 'metaboscape' in managers:
+        df_intensities = managers['metaboscape'].get_intensity_table()
+    else:
+        df_intensities = pd.DataFrame()
+
+    return df, df_intensities
+
+
 if __name__ == '__main__':
     path_metaboscape_csv = r"\\hlabstorage.dmz.marum.de\scratch\Yannick\Guaymas\U1545B_U1549B\MetabSscape\timsTOF_combined_re.csv"
     path_mgf_sirius = r"\\hlabstorage.dmz.marum.de\scratch\Yannick\Guaymas\U1545B_U1549B\MetabSscape\timsTOF_combined_re.sirius.mgf"
@@ -1,6 +1,8 @@
+import os
 from functools import cached_property
 from typing import Any, Iterable, Literal, Callable
 
+import networkx as nx
 import numpy as np
 import pandas as pd
 import logging
@@ -12,19 +14,27 @@ from rdkit.Contrib.Glare.glare import Library
 from tqdm import tqdm
 
 from msIO import PeakList
+from msIO.adducts import parse_adducts, try_parse_adduct
 from msIO.environmental.sample import Sample
-from msIO.list_of_ions.read_mca import MoleculeAnnotation
-from msIO.metrics import cosine_similarity_sym, cosine_similarity_forward, cosine_similarity_backward
-from msIO.sql.session import get_sessionmaker
+from msIO.list_of_ions.base import PeakFeature, SpectrumArrays, consensus_arrays
+from msIO.list_of_ions.read_mca import MoleculeAnnotation, McaImportManager
+from msIO.metrics import cosine_similarity_batch, modified_cosine_batch, get_metric, score_pairs, binned_vectors
+from msIO.preprocessing import Preprocessing
+from msIO.sql.session import get_sessionmaker, get_engine
 from sqlalchemy.orm import load_only
-from sqlalchemy import select, inspect
+from sqlalchemy import select, inspect, text, func, insert, delete
 from sqlalchemy.orm import selectinload, joinedload
 
 # need to import so that sqlalchemy knows about relationships
-from msIO.features.metaboscape import FeatureMetaboScape, Intensity
-from msIO.features.mgf import FeatureMgf, MsSpec
-from msIO.features.sirius import CompoundCandidate, FormulaCandidate
+from msIO.features.metaboscape import FeatureMetaboScape, Intensity, IntensityVector, SampleOrderEntry, \
+    INTENSITY_VECTOR_DTYPE, RTREE_TABLE
+from msIO.features.mgf import FeatureMgf, MsSpec, ION_PREFERENCES
+from msIO.features.sirius import CompoundCandidate, FormulaCandidate, CompoundGroup, flatten_highest_scoring
 from msIO.features.combined import FeatureCombined
+from msIO.features.base import SqlBaseClass
+from msIO.features.mca import McaMatch, McaAnnotation, McaScore, MCA_TABLES
+from msIO.features.duplicates import DuplicateGroup, DUPLICATE_TABLES
+from msIO.features.network import SimilarityEdge, NETWORK_TABLES
 
 logger = logging.getLogger(__name__)
 
@@ -65,6 +75,9 @@ class FeatureManagerDB:
      instance
     """
 
+    _open_search_index: dict[str, np.ndarray] | None = None
+    _similarity_adjacency: dict[str, np.ndarray] | None = None
+
     def __init__(self, path_file_db: str):
         self.path_file = path_file_db
 
@@ -152,14 +165,12 @@ class FeatureManagerDB:
     @cached_property
     def formula_sirius(self):
         stmt = (
-            select(FormulaCandidate).filter(FormulaCandidate.formula_rank == 1)
+            select(FormulaCandidate.feature_id, FormulaCandidate.formula_sirius)
+            .filter(FormulaCandidate.formula_rank == 1)
         )
 
         with self.session_maker() as session:
-            objs = session.execute(stmt).scalars().all()
-            formulas = {}
-            for o in objs:
-                formulas[o.feature_id] = o.formula_sirius
+            formulas = dict(session.execute(stmt).all())
         return formulas
 
     @cached_property
@@ -168,15 +179,35 @@ class FeatureManagerDB:
         Returns dict mapping feature id to a sirius name based on the best formula. If there is no name for the
         highest scoring formula, None will be assigned to that feature."""
         stmt = (
-            select(CompoundCandidate).filter(CompoundCandidate.formula_rank == 1)
+            select(CompoundCandidate.feature_id, CompoundCandidate.name_sirius)
+            .filter(CompoundCandidate.formula_rank == 1)
         )
-        names = {}
         with self.session_maker() as session:
-            objs = session.execute(stmt).scalars().all()
-            for o in objs:
-                names[o.feature_id] = o.name_sirius
+            names = dict(session.execute(stmt).all())
         return names
 
+    def get_sirius_highest_scoring_table(
+            self, use_zodiac_scoring_for_best: bool = True, prefer_npc: bool = True
+    ) -> pd.DataFrame:
+        """
+        Best formula, compound and compound class for all features (see
+        FeatureSirius.get_highest_scoring), read from the candidate tables in
+        one query each and flattened into a DataFrame indexed by feature id.
+        """
+        table_classes = dict(
+            formula_identifications=FormulaCandidate,
+            compound_identifications=CompoundCandidate,
+            canopus_formula_summary=CompoundGroup
+        )
+        engine = get_engine(self.path_file)
+        existing = set(inspect(engine).get_table_names())
+        with engine.connect() as conn:
+            tables = {
+                name: pd.read_sql(select(cls.__table__).order_by(cls.__table__.c.id), conn).drop(columns='id')
+                for name, cls in table_classes.items() if cls.__tablename__ in existing
+            }
+        return flatten_highest_scoring(tables, use_zodiac_scoring_for_best, prefer_npc)
+
     @cached_property
     def names_metaboscape(self) -> dict[int, str]:
         return self.get_all_attributes_from(FeatureMetaboScape, 'name_metaboscape')
@@ -269,8 +300,901 @@ class FeatureManagerDB:
         )
 
         with self.session_maker() as session:
-            ints = session.execute(stmt).all()
-            return dict(ints)
+            ints = dict(session.execute(stmt).all())
+            if len(ints) > 0:
+                return ints
+            # feature may be stored in the compact layout
+            vector = session.execute(
+                select(IntensityVector).where(IntensityVector.feature_id == feature_id)
+            ).scalar_one_or_none()
+            if vector is not None:
+                ints = vector.to_dict()
+            return ints
+
+    def _db_signature(self) -> np.ndarray[int]:
+        """
+        Modification time and size of the DB file (and its write-ahead log, if
+        present), used to invalidate sidecar caches when the DB changes.
+        """
+        signature = []
+        for path in (self.path_file, self.path_file + '-wal'):
+            if os.path.exists(path):
+                st = os.stat(path)
+                signature += [st.st_mtime_ns, st.st_size]
+            else:
+                signature += [0, 0]
+        return np.asarray(signature, dtype=np.int64)
+
+    def _sidecar_path(self, tag: str) -> str:
+        return f'{self.path_file}.{tag}.npz'
+
+    def _load_sidecar(self, tag: str) -> dict[str, np.ndarray] | None:
+        """Load arrays cached next to the DB, returns None if missing or outdated."""
+        path = self._sidecar_path(tag)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            if not np.array_equal(data['db_signature'], self._db_signature()):
+                logger.info(f'{path} is outdated, recomputing')
+                return None
+            return {k: data[k] for k in data.files if k != 'db_signature'}
+
+    def _save_sidecar(self, tag: str, **arrays: np.ndarray) -> None:
+        """Cache arrays next to the DB, e.g. a read-only share only logs a warning."""
+        path = self._sidecar_path(tag)
+        try:
+            np.savez(path, db_signature=self._db_signature(), **arrays)
+        except OSError as e:
+            logger.warning(f'could not write cache {path}: {e}')
+
+    def _load_mmap_sidecar(self, tag: str) -> dict[str, np.ndarray] | None:
+        """Memory-map arrays cached next to the DB (one .npy file per array),
+        returns None if missing or outdated."""
+        path = f'{self.path_file}.{tag}'
+        path_signature = os.path.join(path, 'db_signature.npy')
+        if not os.path.exists(path_signature):
+            return None
+        if not np.array_equal(np.load(path_signature), self._db_signature()):
+            logger.info(f'{path} is outdated, recomputing')
+            return None
+        return {
+            file[:-len('.npy')]: np.load(os.path.join(path, file), mmap_mode='r')
+            for file in os.listdir(path) if file.endswith('.npy') and file != 'db_signature.npy'
+        }
+
+    def _save_mmap_sidecar(self, tag: str, **arrays: np.ndarray) -> bool:
+        """Cache arrays next to the DB as .npy files, returns False (with a
+        warning) if they can not be written."""
+        path = f'{self.path_file}.{tag}'
+        try:
+            os.makedirs(path, exist_ok=True)
+            for name, array in arrays.items():
+                np.save(os.path.join(path, f'{name}.npy'), array)
+            # written last, an interrupted save leaves the cache invalid
+            np.save(os.path.join(path, 'db_signature.npy'), self._db_signature())
+        except OSError as e:
+            logger.warning(f'could not write cache {path}: {e}')
+            return False
+        return True
+
+    def _get_intensity_triplets(self) -> dict[str, np.ndarray]:
+        """
+        Fetch all intensities with a single query per storage layout in
+        coordinate format. Rows index into feature_ids (sorted), columns into
+        sample_ids (ordered as the samples were added to the DB).
+        """
+        stmt_samples = select(Sample.id, Sample.sample_name).order_by(Sample.id)
+        stmt = (
+            select(FeatureMetaboScape.feature_id, Intensity.sample_id, Intensity.value)
+            .select_from(Intensity)
+            .join(Intensity.feature)
+            .where(FeatureMetaboScape.feature_id.is_not(None))
+        )
+        stmt_vectors = (
+            select(FeatureMetaboScape.feature_id, IntensityVector.sample_order_id, IntensityVector.packed)
+            .select_from(IntensityVector)
+            .join(IntensityVector.feature)
+            .where(FeatureMetaboScape.feature_id.is_not(None))
+        )
+        stmt_orders = select(SampleOrderEntry.sample_order_id, SampleOrderEntry.position, SampleOrderEntry.sample_id)
+
+        with self.session_maker() as session:
+            samples = session.execute(stmt_samples).all()
+            rows = session.execute(stmt).all()
+            vectors = session.execute(stmt_vectors).all()
+            orders = session.execute(stmt_orders).all()
+
+        sample_ids = np.asarray([s[0] for s in samples], dtype=np.int64)
+        sample_names = np.asarray(['' if s[1] is None else s[1] for s in samples], dtype=str)
+
+        triplets = np.asarray(rows, dtype=float).reshape(-1, 3)
+        f_ids = triplets[:, 0].astype(np.int64)
+        s_ids = triplets[:, 1].astype(np.int64)
+        values = np.nan_to_num(triplets[:, 2])
+
+        if len(vectors) > 0:
+            # unpack all vectors at once and look up the sample at each position
+            lengths = np.asarray([len(v[2]) for v in vectors]) // INTENSITY_VECTOR_DTYPE.itemsize
+            values_v = np.frombuffer(b''.join(v[2] for v in vectors), dtype=INTENSITY_VECTOR_DTYPE)
+            f_ids_v = np.repeat(np.asarray([v[0] for v in vectors], dtype=np.int64), lengths)
+            order_ids_v = np.repeat(np.asarray([v[1] for v in vectors], dtype=np.int64), lengths)
+            positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+            s_ids_v = np.empty(len(values_v), dtype=np.int64)
+            orders = np.asarray(orders, dtype=np.int64).reshape(-1, 3)
+            for order_id in np.unique(order_ids_v):
+                entries = orders[orders[:, 0] == order_id]
+                position_to_sample = np.empty(entries[:, 1].max() + 1, dtype=np.int64)
+                position_to_sample[entries[:, 1]] = entries[:, 2]
+                mask = order_ids_v == order_id
+                s_ids_v[mask] = position_to_sample[positions[mask]]
+
+            f_ids = np.concatenate([f_ids, f_ids_v])
+            s_ids = np.concatenate([s_ids, s_ids_v])
+            values = np.concatenate([values, values_v.astype(float)])
+
+        feature_ids, rows_idx = np.unique(f_ids, return_inverse=True)
+        cols_idx = np.searchsorted(sample_ids, s_ids)
+
+        return dict(
+            feature_ids=feature_ids,
+            sample_ids=sample_ids,
+            sample_names=sample_names,
+            rows=rows_idx.astype(np.int64),
+            cols=cols_idx.astype(np.int64),
+            values=values
+        )
+
+    def get_intensity_matrix(
+            self,
+            feature_ids: Iterable[int] = None,
+            samples: Iterable[str] = None,
+            sparse: bool = False,
+            use_cache: bool = False
+    ) -> tuple[np.ndarray | Any, np.ndarray[int], np.ndarray[str]]:
+        """
+        Returns the feature x sample intensity matrix together with the feature
+        ids (rows) and sample names (columns).
+
+        All intensities are fetched with one query. Rows are sorted by feature
+        id unless feature_ids is provided, in which case the given order is
+        used (features without intensities are filled with zeros, repeated
+        ones get the same row). Same for samples. With sparse=True a scipy CSR matrix is returned. With
+        use_cache=True the intensities are stored in a .npz file next to the
+        DB, which is recomputed whenever the DB file changes.
+        """
+        data = self._load_sidecar('intensities') if use_cache else None
+        if data is None:
+            data = self._get_intensity_triplets()
+            if use_cache:
+                self._save_sidecar('intensities', **data)
+
+        rows, cols, values = data['rows'], data['cols'], data['values']
+
+        # the matrix is filled for the unique requested features and samples,
+        # repeated ones are copied afterwards via the inverse indices
+        row_inverse = col_inverse = None
+        if feature_ids is None:
+            feature_ids = unique_ids = data['feature_ids']
+        else:
+            feature_ids = np.asarray(list(feature_ids), dtype=np.int64)
+            unique_ids, row_inverse = np.unique(feature_ids, return_inverse=True)
+            # map rows of all features to requested rows
+            present = np.zeros(len(unique_ids), dtype=bool)
+            pos = np.zeros(len(unique_ids), dtype=np.int64)
+            if len(data['feature_ids']) > 0:
+                pos = np.clip(np.searchsorted(data['feature_ids'], unique_ids), 0, len(data['feature_ids']) - 1)
+                present = data['feature_ids'][pos] == unique_ids
+            row_map = np.full(len(data['feature_ids']), -1, dtype=np.int64)
+            row_map[pos[present]] = np.flatnonzero(present)
+            rows = row_map[rows]
+
+        if samples is None:
+            sample_names = unique_names = data['sample_names']
+        else:
+            sample_names = np.asarray(list(samples), dtype=str)
+            unique_names, col_inverse = np.unique(sample_names, return_inverse=True)
+            name_to_col = {name: i for i, name in enumerate(unique_names)}
+            col_map = np.asarray([name_to_col.get(name, -1) for name in data['sample_names']], dtype=np.int64)
+            cols = col_map[cols] if len(col_map) > 0 else cols
+
+        keep = (rows >= 0) & (cols >= 0)
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+        shape = (len(unique_ids), len(unique_names))
+
+        if sparse:
+            from scipy.sparse import csr_matrix
+            matrix = csr_matrix((values, (rows, cols)), shape=shape)
+        else:
+            matrix = np.zeros(shape, dtype=float)
+            matrix[rows, cols] = values
+
+        if row_inverse is not None:
+            matrix = matrix[row_inverse]
+        if col_inverse is not None:
+            matrix = matrix[:, col_inverse]
+
+        return matrix, feature_ids, sample_names
+
+    def _has_rtree(self) -> bool:
+        with self.session_maker() as session:
+            n = session.execute(
+                text("SELECT count(*) FROM sqlite_master WHERE name = :name"), {'name': RTREE_TABLE}
+            ).scalar_one()
+        return n > 0
+
+    def query_boxes(
+            self,
+            mz: Iterable[tuple[float, float] | None] = None,
+            rt: Iterable[tuple[float, float] | None] = None,
+            ccs: Iterable[tuple[float, float] | None] = None
+    ) -> list[list[int]]:
+        """
+        Returns the feature ids inside each of many m/z (Da), RT (seconds) and
+        CCS (Å²) boxes, given as (low, high) per box. A dimension that is
+        None (or None for a box) is not constrained. Features without RT or
+        CCS are not excluded by ranges on these dimensions.
+
+        All boxes are resolved in a single query against the R*Tree of the
+        features. DBs that predate it (see msIO.sql.session.ensure_rtree) are
+        searched with the index on the m/z instead.
+        """
+        dims = {name: None if ranges is None else list(ranges)
+                for name, ranges in dict(mz=mz, rt=rt, ccs=ccs).items()}
+        n_boxes = max([len(ranges) for ranges in dims.values() if ranges is not None] + [0])
+        if n_boxes == 0:
+            return []
+
+        bounds: dict[str, np.ndarray] = {}
+        for name, ranges in dims.items():
+            ranges = [None] * n_boxes if ranges is None else ranges
+            assert len(ranges) == n_boxes, 'provide the same number of ranges for all dimensions'
+            bounds[name] = np.asarray(
+                [(-np.inf, np.inf) if r is None else r for r in ranges], dtype=float
+            ).reshape(n_boxes, 2)
+
+        boxes = [
+            dict(box_idx=i,
+                 mz_lo=bounds['mz'][i, 0], mz_hi=bounds['mz'][i, 1],
+                 rt_lo=bounds['rt'][i, 0], rt_hi=bounds['rt'][i, 1],
+                 ccs_lo=bounds['ccs'][i, 0], ccs_hi=bounds['ccs'][i, 1])
+            for i in range(n_boxes)
+        ]
+        if self._has_rtree():
+            # CROSS JOIN makes SQLite loop over the boxes and pass them to the rtree.
+            # The rtree stores 32-bit floats rounded outwards, so refine with the exact values
+            join = f"""
+            CROSS JOIN {RTREE_TABLE} AS r
+                ON r.mz_max >= b.mz_lo AND r.mz_min <= b.mz_hi
+                AND r.rt_max >= b.rt_lo AND r.rt_min <= b.rt_hi
+                AND r.ccs_max >= b.ccs_lo AND r.ccs_min <= b.ccs_hi
+            JOIN metaboscape_features AS f ON f.id = r.id"""
+        else:
+            logger.info(f'no {RTREE_TABLE} in {self.path_file}, run msIO.sql.session.ensure_rtree for faster queries')
+            join = """
+            CROSS JOIN metaboscape_features AS f"""
+        stmt = text(f"""
+            SELECT b.box_idx, f.feature_id
+            FROM temp_boxes AS b{join}
+            WHERE f.mz_meas BETWEEN b.mz_lo AND b.mz_hi
+                AND (f.rt_seconds IS NULL OR f.rt_seconds BETWEEN b.rt_lo AND b.rt_hi)
+                AND (f.CCS IS NULL OR f.CCS BETWEEN b.ccs_lo AND b.ccs_hi)
+            ORDER BY b.box_idx, f.feature_id
+        """)
+
+        with self.session_maker() as session:
+            session.execute(text(
+                "CREATE TEMP TABLE IF NOT EXISTS temp_boxes (box_idx INTEGER PRIMARY KEY, "
+                "mz_lo REAL, mz_hi REAL, rt_lo REAL, rt_hi REAL, ccs_lo REAL, ccs_hi REAL)"
+            ))
+            session.execute(text("DELETE FROM temp_boxes"))
+            session.execute(text(
+                "INSERT INTO temp_boxes VALUES (:box_idx, :mz_lo, :mz_hi, :rt_lo, :rt_hi, :ccs_lo, :ccs_hi)"
+            ), boxes)
+            rows = session.execute(stmt).all()
+            session.rollback()
+
+        out: list[list[int]] = [[] for _ in range(n_boxes)]
+        for box_idx, feature_id in rows:
+            out[box_idx].append(feature_id)
+        return out
+
+    def query_box(
+            self,
+            mz: tuple[float, float] = None,
+            rt: tuple[float, float] = None,
+            ccs: tuple[float, float] = None
+    ) -> list[int]:
+        """Returns the feature ids inside a single m/z, RT, CCS box."""
+        return self.query_boxes(mz=[mz], rt=[rt], ccs=[ccs])[0]
+
+    def query_targets(
+            self,
+            mzs: Iterable[float],
+            rts_seconds: Iterable[float] = None,
+            ccss: Iterable[float] = None,
+            mz_tol_ppm: float | None = 10.,
+            mz_tol_da: float | None = None,
+            rt_tol_seconds: float = 5.,
+            ccs_tol_A: float = 1.
+    ) -> list[list[int]]:
+        """
+        Find features for a list of targets with the same tolerance semantics
+        as McaImportManager.find_annotations (mz_tol_da overrides mz_tol_ppm).
+        RT and CCS are only used if provided.
+        """
+        mzs = np.asarray(list(mzs), dtype=float)
+        dmz = mz_tol_da if mz_tol_da is not None else mzs * mz_tol_ppm * 1e-6
+        mz_ranges = np.column_stack([mzs - dmz, mzs + dmz])
+
+        def ranges_for(centers, tol):
+            if centers is None:
+                return None
+            centers = np.asarray(list(centers), dtype=float)
+            return [None if np.isnan(c) else (c - tol, c + tol) for c in centers]
+
+        return self.query_boxes(
+            mz=mz_ranges,
+            rt=ranges_for(rts_seconds, rt_tol_seconds),
+            ccs=ranges_for(ccss, ccs_tol_A)
+        )
+
+    def _get_ms_spectra_arrays_limited_variable_number(
+            self,
+            feature_ids: list[int] | None,
+            level: int
+    ) -> list[tuple[int, int, int | None, float | None, float, float]]:
+        preferred_id = FeatureMgf.ms1_id if level == 1 else FeatureMgf.ms2_id
+        stmt = (
+            select(
+                FeatureMgf.feature_id,
+                MsSpec.peaks_id,
+                preferred_id,
+                # MSP libraries do not have a precursor in the mgf table
+                func.coalesce(MsSpec.mz, FeatureMgf.mz, FeatureMetaboScape.mz_meas),
+                PeakFeature.mz,
+                PeakFeature.intensity
+            )
+            .select_from(MsSpec)
+            .join(MsSpec.feature_mgf)
+            .join(PeakFeature, PeakFeature.peak_list_id == MsSpec.peaks_id)
+            .outerjoin(FeatureMetaboScape, FeatureMetaboScape.feature_id == FeatureMgf.feature_id)
+            .where(
+                FeatureMgf.feature_id.is_not(None),
+                MsSpec.ms_level == level,
+            )
+        )
+        if feature_ids is not None:
+            stmt = stmt.where(FeatureMgf.feature_id.in_(feature_ids))
+
+        with self.session_maker() as session:
+            # plain tuples, numpy probes Row objects for array attributes otherwise
+            return list(map(tuple, session.execute(stmt).all()))
+
+    def get_ms_spectra_arrays(
+            self,
+            feature_ids: list[int] = None,
+            level: int = 2,
+            all_spectra: bool = False,
+            max_spectra_per_query: int = 20_000
+    ) -> SpectrumArrays:
+        """
+        Fetch spectra of the given features (all if None) as concatenated peak
+        arrays, without building ORM objects. Spectra are sorted by feature id,
+        features without a spectrum are left out.
+
+        By default one spectrum per feature is returned (the one of the
+        preferred ion, if set). With all_spectra=True every spectrum of the
+        level is returned (e.g. one per adduct), so feature ids may repeat.
+        """
+        level = int(level)
+
+        if level not in (1, 2):
+            raise ValueError("level must be 1 or 2")
+
+        if feature_ids is None:
+            rows = self._get_ms_spectra_arrays_limited_variable_number(None, level)
+        else:
+            feature_ids = list(feature_ids)
+            rows = []
+            for i in range(0, len(feature_ids), max_spectra_per_query):
+                rows += self._get_ms_spectra_arrays_limited_variable_number(
+                    feature_ids[i:i + max_spectra_per_query], level
+                )
+
+        rows = np.asarray(rows, dtype=float).reshape(-1, 6)
+        f_ids_peaks = rows[:, 0].astype(np.int64)
+        peak_list_ids = rows[:, 1].astype(np.int64)
+
+        if not all_spectra:
+            # keep the preferred spectrum, otherwise the first one stored
+            not_preferred = rows[:, 2] != rows[:, 1]  # NaN if not set
+            o = np.lexsort((peak_list_ids, not_preferred, f_ids_peaks))
+            is_first = np.ones(len(o), dtype=bool)
+            is_first[1:] = f_ids_peaks[o][1:] != f_ids_peaks[o][:-1]
+            keep = np.isin(peak_list_ids, peak_list_ids[o][is_first])
+            rows, f_ids_peaks, peak_list_ids = rows[keep], f_ids_peaks[keep], peak_list_ids[keep]
+
+        # one spectrum per peak list, ordered by feature id
+        keys, first, spectrum_index = np.unique(
+            np.column_stack([f_ids_peaks, peak_list_ids]).reshape(-1, 2),
+            axis=0, return_inverse=True, return_index=True
+        )
+        return SpectrumArrays.from_peaks(
+            feature_ids=keys[:, 0],
+            precursor_mzs=rows[first, 3],
+            spectrum_index=spectrum_index.ravel(),
+            mzs=rows[:, 4],
+            intensities=np.nan_to_num(rows[:, 5])
+        )
+
+    def build_fragment_index(self, use_cache: bool = False) -> dict[str, np.ndarray]:
+        """
+        Build the search index over all MS2 spectra (of all ions): fragment m/z
+        and neutral losses (precursor minus fragment), each sorted and pointing
+        to the feature ids, with intensities relative to the base peak of the
+        spectrum. With use_cache=True the index is stored next to the DB.
+        """
+        index = self._load_sidecar('fragment_index') if use_cache else None
+        if index is None:
+            spectra = self.get_ms_spectra_arrays(level=2, all_spectra=True)
+            spectrum_index = spectra.spectrum_index
+            base_peaks = np.zeros(len(spectra))
+            np.maximum.at(base_peaks, spectrum_index, spectra.intensities)
+            base_peaks[base_peaks == 0] = 1.
+            rel_intensities = spectra.intensities / base_peaks[spectrum_index]
+
+            losses = spectra.precursor_mzs[spectrum_index] - spectra.mzs
+            has_loss = ~np.isnan(losses)
+
+            o_fragments = np.argsort(spectra.mzs, kind='stable')
+            o_losses = np.flatnonzero(has_loss)[np.argsort(losses[has_loss], kind='stable')]
+            index = dict(
+                fragment_mzs=spectra.mzs[o_fragments],
+                fragment_feature_ids=spectra.feature_ids[spectrum_index[o_fragments]],
+                fragment_rel_intensities=rel_intensities[o_fragments],
+                loss_mzs=losses[o_losses],
+                loss_feature_ids=spectra.feature_ids[spectrum_index[o_losses]],
+                loss_rel_intensities=rel_intensities[o_losses]
+            )
+            if use_cache:
+                self._save_sidecar('fragment_index', **index)
+        self._fragment_index = index
+        return index
+
+    def get_preprocessed_spectra(
+            self,
+            preprocessing: Preprocessing,
+            feature_ids: Iterable[int] = None,
+            use_cache: bool = False
+    ) -> SpectrumArrays:
+        """
+        MS2 spectra (one per feature, sorted by feature id) after preprocessing.
+        All spectra are processed once per pipeline and kept in memory, with
+        use_cache=True they are also stored next to the DB.
+        """
+        if not hasattr(self, '_preprocessed_spectra'):
+            self._preprocessed_spectra = {}
+        if (spectra := self._preprocessed_spectra.get(preprocessing.key)) is None:
+            tag = f'spectra_{preprocessing.key}'
+            data = self._load_sidecar(tag) if use_cache else None
+            if data is not None:
+                spectra = SpectrumArrays(**data)
+            else:
+                spectra = preprocessing(self.get_ms_spectra_arrays(level=2))
+                if use_cache:
+                    self._save_sidecar(tag, **vars(spectra))
+            self._preprocessed_spectra[preprocessing.key] = spectra
+
+        if feature_ids is None:
+            return spectra
+        pos = pd.Index(spectra.feature_ids).get_indexer(np.unique(np.asarray(list(feature_ids), dtype=np.int64)))
+        return spectra.subset(pos[pos >= 0])
+
+    def get_binned_spectra(
+            self,
+            bin_width: float = 1.,
+            bin_offset: float = 0.4,
+            use_cache: bool = False
+    ) -> tuple[Any, np.ndarray[int]]:
+        """
+        MS2 spectra (one per feature) as binned, L2-normalised rows of a scipy
+        CSR matrix (see msIO.metrics.binned_vectors) and the feature id of each
+        row (sorted). The matrix is kept in memory, with use_cache=True it is
+        also stored next to the DB.
+        """
+        key = (float(bin_width), float(bin_offset))
+        if not hasattr(self, '_binned_spectra'):
+            self._binned_spectra = {}
+        if key in self._binned_spectra:
+            return self._binned_spectra[key]
+
+        tag = f'binned_spectra_{bin_width:g}_{bin_offset:g}'
+        data = self._load_sidecar(tag) if use_cache else None
+        if data is not None:
+            from scipy.sparse import csr_matrix
+            matrix = csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+            feature_ids = data['feature_ids']
+        else:
+            spectra = self.get_ms_spectra_arrays(level=2)
+            matrix, feature_ids = binned_vectors(spectra, bin_width, bin_offset), spectra.feature_ids
+            if use_cache:
+                self._save_sidecar(
+                    tag, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                    shape=np.asarray(matrix.shape, dtype=np.int64), feature_ids=feature_ids
+                )
+        self._binned_spectra[key] = matrix, feature_ids
+        return matrix, feature_ids
+
+    @property
+    def fragment_index(self) -> dict[str, np.ndarray]:
+        if getattr(self, '_fragment_index', None) is None:
+            self.build_fragment_index()
+        return self._fragment_index
+
+    def _find_in_fragment_index(
+            self,
+            kind: Literal['fragment', 'loss'],
+            mz: float,
+            tol_ppm: float | None,
+            tol_da: float | None,
+            min_rel_intensity: float
+    ) -> np.ndarray[int]:
+        """Sorted unique feature ids with a peak of the given kind within the tolerance."""
+        index = self.fragment_index
+        values = index[f'{kind}_mzs']
+        dmz = tol_da if tol_da is not None else abs(mz) * tol_ppm * 1e-6
+        start = np.searchsorted(values, mz - dmz, side='left')
+        end = np.searchsorted(values, mz + dmz, side='right')
+        f_ids = index[f'{kind}_feature_ids'][start:end]
+        if min_rel_intensity > 0:
+            f_ids = f_ids[index[f'{kind}_rel_intensities'][start:end] >= min_rel_intensity]
+        return np.unique(f_ids)
+
+    def build_open_search_index(self, bin_width: float = 0.01, use_cache: bool = False) -> dict[str, np.ndarray]:
+        """
+        Inverted index over the MS2 spectra (one per feature) for open search:
+        the spectra in bin i (floor(mz / bin_width)) are
+        postings[bin_ptr[i]:bin_ptr[i + 1]], rows into feature_ids, with the
+        intensity summed in the bin and L2-normalised per spectrum as weight.
+        The index is kept in memory, with use_cache=True the arrays are stored
+        next to the DB and memory-mapped instead of loaded.
+        """
+        tag = f'open_search_index_{bin_width:g}'
+        index = self._load_mmap_sidecar(tag) if use_cache else None
+        if index is None:
+            spectra = self.get_ms_spectra_arrays(level=2)
+            bins = np.floor(spectra.mzs / bin_width).astype(np.int64)
+            # one posting per spectrum and bin, ordered by bin
+            keys, inverse = np.unique(
+                np.column_stack([bins, spectra.spectrum_index]).reshape(-1, 2), axis=0, return_inverse=True
+            )
+            weights = np.bincount(inverse.ravel(), spectra.intensities, minlength=len(keys))
+            norms = np.sqrt(np.bincount(keys[:, 1], weights ** 2, minlength=len(spectra)))
+            norms[norms == 0] = 1.
+            n_bins = int(keys[:, 0].max(initial=-1)) + 1
+            index = dict(
+                bin_ptr=np.concatenate([[0], np.cumsum(np.bincount(keys[:, 0], minlength=n_bins))]).astype(np.int64),
+                postings=keys[:, 1].astype(np.int32),
+                weights=(weights / norms[keys[:, 1]]).astype(np.float32),
+                feature_ids=spectra.feature_ids,
+                bin_width=np.asarray(bin_width, dtype=float)
+            )
+            if use_cache and self._save_mmap_sidecar(tag, **index):
+                index = self._load_mmap_sidecar(tag)
+        self._open_search_index = index
+        return index
+
+    @property
+    def open_search_index(self) -> dict[str, np.ndarray]:
+        if self._open_search_index is None:
+            self.build_open_search_index()
+        return self._open_search_index
+
+    def open_search(
+            self,
+            ms2_spectra: Iterable[PeakList | None],
+            top_k: int = 50,
+            n_top_peaks: int = 10,
+            max_dmz_da: float = 0.01,
+            queries_per_batch: int = 256,
+            use_cache: bool = False
+    ) -> pd.DataFrame:
+        """
+        Library candidates of each spectrum regardless of the precursor, from
+        the inverted index (see build_open_search_index): the n_top_peaks most
+        intense peaks of a query look up all bins within max_dmz_da, which
+        gives the partial dot products with every spectrum sharing a fragment.
+        Each query peak counts once per library spectrum (its best bin) and
+        each library bin once per query (its best peak), so the score is the
+        cosine of the matched peaks (at most 1). Returns the top_k candidates
+        per query (query_index, feature_id, score, n_shared_peaks with the
+        peaks of a library spectrum in one bin counting as one), best first.
+        The index is built on the first call (use_cache, see
+        build_open_search_index).
+        """
+        if self._open_search_index is None:
+            self.build_open_search_index(use_cache=use_cache)
+        index = self._open_search_index
+        bin_ptr, postings, weights = index['bin_ptr'], index['postings'], index['weights']
+        bin_width, n_bins = float(index['bin_width']), len(bin_ptr) - 1
+        n_rows = len(index['feature_ids'])
+
+        spectra = SpectrumArrays.from_peak_lists(ms2_spectra)
+        spectrum_index = spectra.spectrum_index
+        norms = np.sqrt(np.bincount(spectrum_index, spectra.intensities ** 2, minlength=len(spectra)))
+        norms[norms == 0] = 1.
+        # the most intense peaks of each query, weighted as in the index
+        o = np.lexsort((-spectra.intensities, spectrum_index))
+        ranks = np.arange(len(o)) - spectra.offsets[spectrum_index[o]]
+        top = np.sort(o[ranks < n_top_peaks])
+        queries = spectrum_index[top]
+        query_weights = spectra.intensities[top] / norms[queries]
+        bins_lo = np.clip(np.floor((spectra.mzs[top] - max_dmz_da) / bin_width).astype(np.int64), 0, n_bins)
+        bins_hi = np.clip(np.floor((spectra.mzs[top] + max_dmz_da) / bin_width).astype(np.int64) + 1, 0, n_bins)
+
+        out = []
+        bounds = np.searchsorted(queries, np.arange(0, len(spectra) + queries_per_batch, queries_per_batch))
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if start == stop:
+                continue
+            # the bins of a peak are consecutive, so their postings are one range
+            lo, hi = bin_ptr[bins_lo[start:stop]], bin_ptr[bins_hi[start:stop]]
+            counts = hi - lo
+            peaks = np.repeat(np.arange(start, stop), counts)
+            idcs = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+            rows = postings[idcs]
+            products = query_weights[peaks] * weights[idcs]
+            # best bin of each query peak per library spectrum
+            o = np.lexsort((-products, rows, peaks))
+            o = o[np.r_[True, (peaks[o][1:] != peaks[o][:-1]) | (rows[o][1:] != rows[o][:-1])]]
+            # best query peak of each library bin per query
+            queries_o = queries[peaks[o]]
+            o = o[np.lexsort((-products[o], idcs[o], queries_o))]
+            queries_o = queries[peaks[o]]
+            o = o[np.r_[True, (idcs[o][1:] != idcs[o][:-1]) | (queries_o[1:] != queries_o[:-1])]]
+
+            keys, inverse = np.unique(queries[peaks[o]] * n_rows + rows[o], return_inverse=True)
+            scores = np.bincount(inverse, products[o], minlength=len(keys))
+            n_shared = np.bincount(inverse, minlength=len(keys))
+
+            # top k per query
+            query_idcs = keys // n_rows
+            o = np.lexsort((-scores, query_idcs))
+            ranks = np.arange(len(o)) - np.searchsorted(query_idcs[o], query_idcs[o], side='left')
+            o = o[ranks < top_k]
+            out.append(pd.DataFrame(dict(
+                query_index=query_idcs[o],
+                feature_id=index['feature_ids'][keys[o] % n_rows],
+                score=np.minimum(scores[o], 1.),  # float32 rounding
+                n_shared_peaks=n_shared[o],
+            )))
+        if len(out) == 0:
+            return pd.DataFrame(dict(
+                query_index=np.array([], dtype=np.int64), feature_id=np.array([], dtype=np.int64),
+                score=np.array([], dtype=float), n_shared_peaks=np.array([], dtype=np.int64)
+            ))
+        return pd.concat(out, ignore_index=True)
+
+    def find_by_fragment(
+            self,
+            mz: float,
+            tol_ppm: float | None = 5.,
+            tol_da: float | None = None,
+            min_rel_intensity: float = 0.
+    ) -> np.ndarray[int]:
+        """
+        Feature ids whose MS2 spectrum contains a fragment at mz (tol_da
+        overrides tol_ppm). Peaks below min_rel_intensity (relative to the base
+        peak) are ignored.
+        """
+        return self._find_in_fragment_index('fragment', mz, tol_ppm, tol_da, min_rel_intensity)
+
+    def find_by_neutral_loss(
+            self,
+            delta: float,
+            tol_ppm: float | None = 5.,
+            tol_da: float | None = None,
+            min_rel_intensity: float = 0.
+    ) -> np.ndarray[int]:
+        """
+        Feature ids whose MS2 spectrum contains a fragment at precursor - delta.
+        The ppm tolerance is relative to delta, so for small losses tol_da is
+        usually the better choice.
+        """
+        return self._find_in_fragment_index('loss', delta, tol_ppm, tol_da, min_rel_intensity)
+
+    def find_by_fragments(
+            self,
+            fragments: Iterable[float] = (),
+            neutral_losses: Iterable[float] = (),
+            how: Literal['and', 'or'] = 'and',
+            tol_ppm: float | None = 5.,
+            tol_da: float | None = None,
+            min_rel_intensity: float = 0.
+    ) -> np.ndarray[int]:
+        """
+        Combine several fragment and neutral loss queries, 'and' requires all
+        of them to be present in a spectrum, 'or' at least one.
+        """
+        if how not in ('and', 'or'):
+            raise ValueError("how must be 'and' or 'or'")
+
+        hits = [self.find_by_fragment(mz, tol_ppm, tol_da, min_rel_intensity) for mz in fragments] + \
+            [self.find_by_neutral_loss(delta, tol_ppm, tol_da, min_rel_intensity) for delta in neutral_losses]
+        if len(hits) == 0:
+            return np.array([], dtype=np.int64)
+
+        out = hits[0]
+        for h in hits[1:]:
+            out = np.intersect1d(out, h) if how == 'and' else np.union1d(out, h)
+        return out
+
+    def build_similarity_network(
+            self,
+            max_precursor_delta: float | None = None,
+            min_score: float = 0.7,
+            top_k: int | None = 10,
+            min_matched_peaks: int = 6,
+            max_ms2_dmz_da: float = 0.02,
+            min_shared_peaks: int = 1,
+            n_top_peaks: int = 10,
+            max_posting_length: int = 2_000,
+            batch_size: int = 20_000,
+            n_workers: int = 1,
+            store: bool = True
+    ) -> pd.DataFrame:
+        """
+        Molecular network of the MS2 spectra (one per feature). Candidate pairs
+        share at least min_shared_peaks binned fragments or neutral losses among
+        their n_top_peaks most intense peaks (see _shared_peak_pairs) and have
+        precursors within max_precursor_delta (any if None).
+        min_shared_peaks=0 takes all pairs within the precursor window instead.
+        Candidates are scored with the modified cosine and kept with at least
+        min_score and min_matched_peaks. Of those, an edge is only kept if it is
+        among the top_k edges of both its features (no pruning if None).
+
+        With store=True the edges replace those in the similarity_edges table
+        and the adjacency is cached next to the DB (see get_similarity_neighbors).
+        Returns the edges (feature_id_a, feature_id_b, score, n_matched_peaks,
+        precursor_delta).
+        """
+        spectra = self.get_ms_spectra_arrays(level=2)
+        precursor_mzs = spectra.precursor_mzs
+        if min_shared_peaks > 0:
+            pos_a, pos_b, n_shared = _shared_peak_pairs(spectra, 2 * max_ms2_dmz_da, n_top_peaks, max_posting_length)
+            keep = n_shared >= min_shared_peaks
+            if max_precursor_delta is not None:
+                keep &= np.abs(precursor_mzs[pos_b] - precursor_mzs[pos_a]) <= max_precursor_delta
+            pos_a, pos_b = pos_a[keep], pos_b[keep]
+        else:
+            assert max_precursor_delta is not None, 'need a precursor window or shared peaks for the candidates'
+            # all pairs i < j with precursors within the window (sweep over the sorted m/z)
+            o = np.argsort(precursor_mzs, kind='stable')
+            mzs = precursor_mzs[o]
+            n = np.count_nonzero(~np.isnan(mzs))
+            lo = np.arange(1, n + 1)
+            hi = np.searchsorted(mzs[:n], mzs[:n] + max_precursor_delta, side='right')
+            counts = np.maximum(hi - lo, 0)
+            pos_a = o[np.repeat(np.arange(n), counts)]
+            pos_b = o[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)]
+        logger.info(f'scoring {len(pos_a):_} candidate pairs of {len(spectra):_} spectra')
+
+        scores, n_matched = modified_cosine_batch(
+            spectra, spectra, max_ms2_dmz_da, pos_a, pos_b, batch_size=batch_size, n_workers=n_workers
+        )
+        keep = (scores >= min_score) & (n_matched >= min_matched_peaks)
+        pos_a, pos_b, scores, n_matched = pos_a[keep], pos_b[keep], scores[keep], n_matched[keep]
+
+        if top_k is not None and len(pos_a) > 0:
+            # rank the edges of each node by score
+            nodes = np.concatenate([pos_a, pos_b])
+            edges = np.tile(np.arange(len(pos_a)), 2)
+            o = np.lexsort((edges, -np.tile(scores, 2), nodes))
+            nodes_sorted = nodes[o]
+            ranks = np.arange(len(o)) - np.searchsorted(nodes_sorted, nodes_sorted, side='left')
+            keep = np.bincount(edges[o][ranks < top_k], minlength=len(pos_a)) == 2
+            pos_a, pos_b, scores, n_matched = pos_a[keep], pos_b[keep], scores[keep], n_matched[keep]
+
+        # spectra are sorted by feature id, so feature_id_a < feature_id_b
+        swap = pos_a > pos_b
+        pos_a, pos_b = np.where(swap, pos_b, pos_a), np.where(swap, pos_a, pos_b)
+        o = np.lexsort((pos_b, pos_a))
+        network = pd.DataFrame(dict(
+            feature_id_a=spectra.feature_ids[pos_a[o]],
+            feature_id_b=spectra.feature_ids[pos_b[o]],
+            score=scores[o],
+            n_matched_peaks=n_matched[o],
+            precursor_delta=precursor_mzs[pos_b[o]] - precursor_mzs[pos_a[o]],
+        ))
+        logger.info(f'found {len(network):_} edges')
+        if store:
+            self.write_similarity_network(network)
+        return network
+
+    def write_similarity_network(self, network: pd.DataFrame) -> None:
+        """Store edges found by build_similarity_network in the similarity_edges
+        table (replacing previous edges) and cache the adjacency."""
+        SqlBaseClass.metadata.create_all(get_engine(self.path_file), tables=NETWORK_TABLES)
+        rows = [
+            dict(id=i + 1, feature_id_a=a, feature_id_b=b, score=score, n_matched_peaks=n,
+                 precursor_delta=None if np.isnan(delta) else delta)
+            for i, (a, b, score, n, delta) in enumerate(zip(
+                network['feature_id_a'].tolist(), network['feature_id_b'].tolist(), network['score'].tolist(),
+                network['n_matched_peaks'].tolist(), network['precursor_delta'].tolist()
+            ))
+        ]
+        with self.session_maker() as session:
+            session.execute(delete(SimilarityEdge))
+            if len(rows) > 0:
+                session.execute(insert(SimilarityEdge), rows)
+            session.commit()
+        self._similarity_adjacency = None
+        self._get_similarity_adjacency(use_cache=True)
+
+    def get_similarity_network(self, as_graph: bool = False) -> pd.DataFrame | nx.Graph:
+        """Stored edges of the similarity network, as a graph with the edge
+        attributes score and n_matched_peaks if as_graph is True."""
+        if not inspect(get_engine(self.path_file)).has_table(SimilarityEdge.__tablename__):
+            network = pd.DataFrame(columns=['feature_id_a', 'feature_id_b', 'score', 'n_matched_peaks', 'precursor_delta'])
+        else:
+            stmt = select(
+                SimilarityEdge.feature_id_a, SimilarityEdge.feature_id_b, SimilarityEdge.score,
+                SimilarityEdge.n_matched_peaks, SimilarityEdge.precursor_delta
+            ).order_by(SimilarityEdge.id)
+            with self.session_maker() as session:
+                network = pd.DataFrame(session.execute(stmt).all(), columns=[
+                    'feature_id_a', 'feature_id_b', 'score', 'n_matched_peaks', 'precursor_delta'
+                ])
+        if not as_graph:
+            return network
+
+        G = nx.Graph()
+        G.add_weighted_edges_from(
+            zip(network.feature_id_a.tolist(), network.feature_id_b.tolist(), network.score.tolist()),
+            weight='score'
+        )
+        nx.set_edge_attributes(G, {
+            (a, b): n for a, b, n in
+            zip(network.feature_id_a.tolist(), network.feature_id_b.tolist(), network.n_matched_peaks.tolist())
+        }, 'n_matched_peaks')
+        return G
+
+    def _get_similarity_adjacency(self, use_cache: bool = False) -> dict[str, np.ndarray]:
+        """Stored network in CSR format: the neighbors of feature_ids[i] are
+        neighbor_ids[indptr[i]:indptr[i + 1]] (sorted by descending score).
+        Kept in memory, with use_cache=True also cached next to the DB."""
+        if self._similarity_adjacency is not None:
+            return self._similarity_adjacency
+        adjacency = self._load_sidecar('similarity_network') if use_cache else None
+        if adjacency is None:
+            network = self.get_similarity_network()
+            nodes = np.concatenate([network.feature_id_a, network.feature_id_b]).astype(np.int64)
+            neighbors = np.concatenate([network.feature_id_b, network.feature_id_a]).astype(np.int64)
+            scores = np.tile(network.score.to_numpy(dtype=float), 2)
+            o = np.lexsort((neighbors, -scores, nodes))
+            feature_ids, counts = np.unique(nodes, return_counts=True)
+            adjacency = dict(
+                feature_ids=feature_ids,
+                indptr=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                neighbor_ids=neighbors[o],
+                scores=scores[o]
+            )
+            if use_cache:
+                self._save_sidecar('similarity_network', **adjacency)
+        self._similarity_adjacency = adjacency
+        return adjacency
+
+    def get_similarity_neighbors(self, feature_id: int, use_cache: bool = False) -> pd.Series:
+        """Scores of the neighbors of a feature in the stored network, by
+        feature id (best first). With use_cache=True the adjacency is read
+        from (or written to) the cache next to the DB."""
+        adjacency = self._get_similarity_adjacency(use_cache=use_cache)
+        i = np.searchsorted(adjacency['feature_ids'], feature_id)
+        if i == len(adjacency['feature_ids']) or adjacency['feature_ids'][i] != feature_id:
+            return pd.Series([], dtype=float, name='score')
+        start, end = adjacency['indptr'][i], adjacency['indptr'][i + 1]
+        return pd.Series(adjacency['scores'][start:end], index=adjacency['neighbor_ids'][start:end], name='score')
 
     def compare_features(self, f_id1: int, f_id2: int):
         fig, axs = plt.subplots(nrows=4)
@@ -316,9 +1240,7 @@ class FeatureManagerDB:
         pd.plotting.table(ax=axs[2], data=df.T, loc="center", cellLoc="center", edges='open')
 
         # bar plot with intensities
-        ints1 = {i.sample.sample_name: i.value for i in f_1.metaboscape.intensities}
-        ints2 = {i.sample.sample_name: i.value for i in f_2.metaboscape.intensities}
-        df = pd.DataFrame(data=[ints1, ints2], index=[f_id1, f_id2]).T
+        df = pd.DataFrame(data=[self.get_intensities(f_id1), self.get_intensities(f_id2)], index=[f_id1, f_id2]).T
 
         df.plot.bar(rot=45, ax=axs[3])
         axs[3].set_title('Intensities')
@@ -329,6 +1251,158 @@ class FeatureManagerDB:
     def find_objects_for_attr(self, attr_name: str) -> list[object]:
         raise NotImplementedError()
 
+    def add_mca_annotations(
+            self,
+            mca: McaImportManager | str,
+            mz_tol_ppm: float | None = 10.0,
+            mz_tol_da: float | None = None,
+            rt_tol_seconds: float = 5.0,
+            ccs_tol_A: float = 1.0,
+            sort_by: Literal["ppm", "rt", "ccs", "combined"] = "combined",
+            replace: bool = True
+    ) -> int:
+        """
+        Match every feature against the ions of an .mca file (same tolerances
+        as McaImportManager.find_annotations) and store the matches with
+        their annotations and scores. With replace=True, matches previously
+        stored from the same file are removed. Returns the number of matches.
+        """
+        if isinstance(mca, str):
+            mca = McaImportManager(mca)
+        SqlBaseClass.metadata.create_all(get_engine(self.path_file), tables=MCA_TABLES)
+
+        stmt = (
+            select(FeatureMetaboScape.feature_id, FeatureMetaboScape.mz_meas,
+                   FeatureMetaboScape.rt_seconds, FeatureMetaboScape.CCS)
+            .where(FeatureMetaboScape.feature_id.is_not(None), FeatureMetaboScape.mz_meas.is_not(None))
+        )
+        with self.session_maker() as session:
+            features = np.asarray(session.execute(stmt).all(), dtype=float).reshape(-1, 4)
+
+        table = mca.find_annotations_table(
+            features[:, 1], features[:, 2], features[:, 3],
+            mz_tol_ppm=mz_tol_ppm, mz_tol_da=mz_tol_da, rt_tol_seconds=rt_tol_seconds,
+            ccs_tol_A=ccs_tol_A, sort_by=sort_by
+        )
+        feature_ids = features[table['query_index'].to_numpy(), 0].astype(np.int64)
+        ranks = table.groupby('query_index').cumcount().to_numpy()
+
+        # only parse the molecules that matched
+        molecule_idcs = np.unique(table['molecule_index'].to_numpy()).tolist()
+        molecules = dict(zip(molecule_idcs, mca.molecule_annotations.get_many(molecule_idcs)))
+
+        with self.session_maker() as session:
+            if replace:
+                match_ids = select(McaMatch.id).where(McaMatch.mca_file == mca.path_mca)
+                annotation_ids = select(McaAnnotation.id).where(McaAnnotation.match_id.in_(match_ids))
+                session.execute(delete(McaScore).where(McaScore.annotation_id.in_(annotation_ids)))
+                session.execute(delete(McaAnnotation).where(McaAnnotation.match_id.in_(match_ids)))
+                session.execute(delete(McaMatch).where(McaMatch.mca_file == mca.path_mca))
+
+            # explicit ids so that children can reference their parents in bulk inserts
+            next_ids = [
+                (session.execute(select(func.max(t.id))).scalar() or 0) + 1
+                for t in (McaMatch, McaAnnotation, McaScore)
+            ]
+            match_id, annotation_id, score_id = next_ids
+
+            rows_matches, rows_annotations, rows_scores = [], [], []
+            for feature_id, rank, mol_idx, ion_idx, dmz_da, dmz_ppm, drt_s, dccs_A in zip(
+                    feature_ids.tolist(), ranks.tolist(),
+                    *(table[c].tolist() for c in ('molecule_index', 'ion_index', 'mz_da', 'mz_ppm', 'rt_s', 'ccs_A'))
+            ):
+                mol = molecules[mol_idx]
+                ion = mol.ions[ion_idx]
+                rows_matches.append(dict(
+                    id=match_id, feature_id=feature_id, rank=rank, mca_file=mca.path_mca,
+                    molecule_index=mol_idx, neutral_mass=mol.neutral_mass,
+                    ion_mz=ion.mz, ion_rt_seconds=ion.rt_seconds, ion_ccs=ion.ccs, ion_notation=ion.notation,
+                    dmz_da=dmz_da, dmz_ppm=dmz_ppm, drt_seconds=drt_s, dccs_A=dccs_A
+                ))
+                for ann in mol.annotations:
+                    source = ann.source
+                    rows_annotations.append(dict(
+                        id=annotation_id, match_id=match_id, name=ann.name, formula=ann.formula,
+                        tool_name=source.tool_name if source else None,
+                        db_name=source.db_name if source else None
+                    ))
+                    for score in ann.scores:
+                        rows_scores.append(dict(
+                            id=score_id, annotation_id=annotation_id,
+                            name=score.name, value=score.value, unit=score.unit
+                        ))
+                        score_id += 1
+                    annotation_id += 1
+                match_id += 1
+
+            for cls, rows in ((McaMatch, rows_matches), (McaAnnotation, rows_annotations), (McaScore, rows_scores)):
+                if rows:
+                    session.execute(insert(cls), rows)
+            session.commit()
+
+        logger.info(f'stored {len(rows_matches):_} mca matches for {len(np.unique(feature_ids)):_} features')
+        return len(rows_matches)
+
+    def _query_mca_annotations(self, *where) -> pd.DataFrame:
+        """Stored annotations (one row per annotation) with scores as columns."""
+        stmt = (
+            select(
+                McaMatch.feature_id, McaMatch.rank, McaAnnotation.id.label('annotation_id'),
+                McaAnnotation.name, McaAnnotation.formula, McaAnnotation.tool_name, McaAnnotation.db_name,
+                McaMatch.ion_notation, McaMatch.ion_mz, McaMatch.dmz_ppm, McaMatch.drt_seconds, McaMatch.dccs_A,
+                McaMatch.mca_file
+            )
+            .join(McaAnnotation.match)
+            .where(*where)
+            .order_by(McaMatch.feature_id, McaMatch.rank, McaAnnotation.id)
+        )
+        stmt_scores = (
+            select(McaScore.annotation_id, McaScore.name, McaScore.value)
+            .where(McaScore.annotation_id.in_(stmt.with_only_columns(McaAnnotation.id).order_by(None)))
+        )
+        if not inspect(get_engine(self.path_file)).has_table(McaMatch.__tablename__):
+            return pd.DataFrame(columns=[c.name for c in stmt.selected_columns])
+
+        with self.session_maker() as session:
+            df = pd.DataFrame(session.execute(stmt).all(), columns=[c.name for c in stmt.selected_columns])
+            scores = pd.DataFrame(session.execute(stmt_scores).all(), columns=['annotation_id', 'name', 'value'])
+
+        if len(scores) > 0:
+            scores = scores.pivot_table(index='annotation_id', columns='name', values='value', aggfunc='first')
+            df = df.join(scores.add_prefix('score_'), on='annotation_id')
+        return df
+
+    def get_mca_annotations(
+            self,
+            feature_ids: int | Iterable[int] = None,
+            max_features_per_query: int = 10_000
+    ) -> pd.DataFrame:
+        """Stored .mca annotations of the given feature(s), all if None."""
+        if feature_ids is None:
+            return self._query_mca_annotations()
+        if isinstance(feature_ids, int | np.integer):
+            feature_ids = [feature_ids]
+        feature_ids = list(dict.fromkeys(int(f) for f in feature_ids))
+        if len(feature_ids) <= max_features_per_query:
+            return self._query_mca_annotations(McaMatch.feature_id.in_(feature_ids))
+        # the ids are bound twice per query (annotations and scores)
+        dfs = [
+            self._query_mca_annotations(McaMatch.feature_id.in_(feature_ids[i:i + max_features_per_query]))
+            for i in range(0, len(feature_ids), max_features_per_query)
+        ]
+        dfs = [df for df in dfs if len(df) > 0] or dfs[:1]
+        return (
+            pd.concat(dfs, ignore_index=True)
+            .sort_values(['feature_id', 'rank', 'annotation_id'], ignore_index=True)
+        )
+
+    def find_features_by_mca_annotation(self, name: str, exact: bool = True) -> pd.DataFrame:
+        """Stored .mca annotations with the given compound name (literal substring
+        if not exact, % and _ are not wildcards)."""
+        if exact:
+            return self._query_mca_annotations(McaAnnotation.name == name)
+        return self._query_mca_annotations(McaAnnotation.name.contains(name, autoescape=True))
+
     def add_annotations_from_library(self, library: "Library" = None, library_file: str | None = None):
         assert (library is None) ^ (library_file is None), 'provide either library or library_file'
         if library is not None:
@@ -336,6 +1410,58 @@ class FeatureManagerDB:
         ...
 
 
+def _shared_peak_pairs(
+        spectra: SpectrumArrays,
+        bin_width: float,
+        n_top_peaks: int,
+        max_posting_length: int
+) -> tuple[np.ndarray[int], np.ndarray[int], np.ndarray[int]]:
+    """
+    Pairs of spectra (positions i < j) that share binned peaks among the
+    n_top_peaks most intense peaks of each spectrum, either as fragment or as
+    neutral loss, from an inverted index of the bins. Bins in more than
+    max_posting_length spectra are skipped (unspecific, and the number of pairs
+    grows with the square). Returns the positions and the number of shared bins.
+    """
+    n = len(spectra)
+    spectrum_index = spectra.spectrum_index
+    o = np.lexsort((-spectra.intensities, spectrum_index))
+    ranks = np.arange(len(o)) - spectra.offsets[spectrum_index[o]]
+    top = o[ranks < n_top_peaks]
+    specs = spectrum_index[top]
+    fragments = np.floor(spectra.mzs[top] / bin_width)
+    losses = np.floor((spectra.precursor_mzs[specs] - spectra.mzs[top]) / bin_width)
+    has_loss = ~np.isnan(losses)
+
+    # (kind, bin, spectrum), sorted such that the spectra of a bin are consecutive
+    tokens = np.unique(np.column_stack([
+        np.concatenate([np.zeros(len(top)), np.ones(np.count_nonzero(has_loss))]),
+        np.concatenate([fragments, losses[has_loss]]),
+        np.concatenate([specs, specs[has_loss]])
+    ]).astype(np.int64).reshape(-1, 3), axis=0)
+    is_start = np.ones(len(tokens), dtype=bool)
+    is_start[1:] = (tokens[1:, :2] != tokens[:-1, :2]).any(axis=1)
+    sizes = np.diff(np.append(np.flatnonzero(is_start), len(tokens)))
+    sizes_tokens = np.repeat(sizes, sizes)
+
+    # every spectrum of a bin with all following ones
+    lo = np.arange(1, len(tokens) + 1)
+    counts = np.repeat(np.flatnonzero(is_start) + sizes, sizes) - lo
+    counts[sizes_tokens > max_posting_length] = 0
+    first = np.repeat(np.arange(len(tokens)), counts)
+    second = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+
+    keys, n_shared = np.unique(tokens[first, 2] * n + tokens[second, 2], return_counts=True)
+    return keys // n, keys % n, n_shared
+
+
+def _to_float_array(values: Iterable[float | None] | None) -> np.ndarray[float] | None:
+    """Missing values (None) become NaN."""
+    if values is None:
+        return None
+    return np.asarray([np.nan if v is None else v for v in values], dtype=float)
+
+
 class Library(FeatureManagerDB):
     """
     This class is not intended to be structured like this longterm. This is
@@ -386,32 +1512,197 @@ class Library(FeatureManagerDB):
             self._set_sorted_mzs()
         return self._mzs_sorted
 
-    def find_matches_precursor(
+    @cached_property
+    def _metadata_sorted(self) -> dict[str, np.ndarray]:
+        """Names, formulas and source libraries aligned with f_ids_sorted."""
+        ann_libs: dict[int, str] = self._get_dict_for_attributes(FeatureMetaboScape, 'annotation_type')
+        f_ids = self.f_ids_sorted.tolist()
+        return dict(
+            name=np.asarray([self.names.get(f_id) for f_id in f_ids], dtype=object),
+            formula=np.asarray([self.formula_metaboscape.get(f_id) for f_id in f_ids], dtype=object),
+            source_library=np.asarray([ann_libs.get(f_id, 'unknown') for f_id in f_ids], dtype=object),
+            adduct=np.asarray([self.adducts.get(f_id) for f_id in f_ids], dtype=object),
+        )
+
+    @cached_property
+    def _rts_ccss_sorted(self) -> dict[str, np.ndarray[float]]:
+        """Retention times and CCS aligned with f_ids_sorted (NaN if missing)."""
+        f_ids = self.f_ids_sorted.tolist()
+        return dict(
+            rt_seconds=_to_float_array([self.retention_times_in_seconds.get(f_id) for f_id in f_ids]),
+            ccs=_to_float_array([self.collisional_cross_sections.get(f_id) for f_id in f_ids]),
+        )
+
+    @cached_property
+    def adducts(self) -> dict[int, str]:
+        return self._get_dict_for_attributes(FeatureMetaboScape, 'adduct_metaboscape')
+
+    def get_adduct_index(self, adducts: Iterable[str] = tuple(ION_PREFERENCES)) -> dict[str, np.ndarray]:
+        """
+        Sorted m/z of every library entry as each of the given adducts. The
+        neutral mass is derived from the stored precursor m/z and adduct.
+        Entries whose adduct cannot be parsed keep their stored m/z and get an
+        adduct index of -1.
+        """
+        adducts = tuple(adducts)
+        if (index := self._adduct_indices.get(adducts)) is not None:
+            return index
+
+        parsed = parse_adducts(adducts)
+        adducts_lib = [try_parse_adduct(a) for a in self._metadata_sorted['adduct'].tolist()]
+        is_parsed = np.asarray([a is not None for a in adducts_lib], dtype=bool)
+        pos_parsed = np.flatnonzero(is_parsed)
+        Ms = np.asarray(
+            [adducts_lib[i].M_from_mz(self.mzs_sorted[i]) for i in pos_parsed.tolist()], dtype=float
+        )
+
+        mzs = [self.mzs_sorted[~is_parsed]]
+        lib_pos = [np.flatnonzero(~is_parsed)]
+        adduct_idcs = [np.full((~is_parsed).sum(), -1, dtype=np.int64)]
+        for i, adduct in enumerate(parsed):
+            mzs.append(adduct.mz_from_M(Ms))
+            lib_pos.append(pos_parsed)
+            adduct_idcs.append(np.full(len(pos_parsed), i, dtype=np.int64))
+
+        mzs = np.concatenate(mzs).astype(float)
+        o = np.argsort(mzs, kind='stable')
+        index = dict(
+            mzs=mzs[o],
+            lib_pos=np.concatenate(lib_pos)[o],
+            adduct_idcs=np.concatenate(adduct_idcs)[o]
+        )
+        self._adduct_indices[adducts] = index
+        return index
+
+    @cached_property
+    def _adduct_indices(self) -> dict[tuple[str, ...], dict[str, np.ndarray]]:
+        return {}
+
+    def _find_candidates_precursor(
             self,
             mzs: Iterable[float],
             max_dmz_da: float = None,
             max_dmz_ppm: float | int = None,
-    ) -> list[list[int]]:
-        """Returns the matched feature ids"""
+            adducts: Iterable[str] = None,
+            rts_seconds: Iterable[float | None] = None,
+            ccss: Iterable[float | None] = None,
+            max_drt_seconds: float = None,
+            max_dccs_A: float = None,
+    ) -> tuple[np.ndarray[int], np.ndarray[int], np.ndarray[float], np.ndarray[int]]:
+        """
+        Returns flat arrays of all precursor matches: the index of the query,
+        the position of the match in the sorted library, the library m/z that
+        was matched and the index of the adduct it was expanded to (-1 without
+        adducts or if the library adduct is unknown).
+
+        If RT and/or CCS of the queries and a tolerance are provided, matches
+        outside the tolerance are removed. Missing values (on either side) do
+        not remove a match.
+        """
         assert (max_dmz_da is None) ^ (max_dmz_ppm is None), \
             'provide either max_dmz_da or max_dmz_ppm (but not both)'
 
-        mzs = np.asarray(mzs)
+        mzs = np.asarray(mzs, dtype=float)
 
         if max_dmz_da is None:
             max_dmz_da = mzs * (max_dmz_ppm * 1e-6)
 
-        # get all features that match the mz within the tolerance
-        idcs_left = np.searchsorted(self.mzs_sorted, mzs - max_dmz_da, side='right')
-        idcs_right = np.searchsorted(self.mzs_sorted, mzs + max_dmz_da, side='right')
-
-        f_ids: list[np.ndarray[int]] = [
-            self.f_ids_sorted[idx_left:idx_right]
-            for idx_left, idx_right in zip(idcs_left, idcs_right)
-        ]
+        if adducts is None:
+            mzs_index, lib_pos_index = self.mzs_sorted, None
+        else:
+            index = self.get_adduct_index(adducts)
+            mzs_index, lib_pos_index = index['mzs'], index['lib_pos']
+
+        idcs_left = np.searchsorted(mzs_index, mzs - max_dmz_da, side='right')
+        idcs_right = np.searchsorted(mzs_index, mzs + max_dmz_da, side='right')
+
+        # expand windows [left, right) into flat pairs
+        counts = idcs_right - idcs_left
+        query_idcs = np.repeat(np.arange(len(mzs)), counts)
+        pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) \
+            + np.repeat(idcs_left, counts)
+        if adducts is None:
+            lib_pos, adduct_idcs = pos, np.full(len(pos), -1, dtype=np.int64)
+        else:
+            lib_pos, adduct_idcs = lib_pos_index[pos], index['adduct_idcs'][pos]
+        mzs_lib = mzs_index[pos]
+
+        # secondary dimensions
+        keep = np.ones(len(pos), dtype=bool)
+        for values, tol, key in ((rts_seconds, max_drt_seconds, 'rt_seconds'), (ccss, max_dccs_A, 'ccs')):
+            if (values is None) or (tol is None):
+                continue
+            values = _to_float_array(values)
+            assert len(values) == len(mzs), f'need a {key} value (or None) for every mz'
+            diffs = np.abs(values[query_idcs] - self._rts_ccss_sorted[key][lib_pos])
+            keep &= ~(diffs > tol)  # NaN passes
+        if not keep.all():
+            query_idcs, lib_pos, mzs_lib, adduct_idcs = \
+                query_idcs[keep], lib_pos[keep], mzs_lib[keep], adduct_idcs[keep]
+        return query_idcs, lib_pos, mzs_lib, adduct_idcs
+
+    def find_matches_adducts(
+            self,
+            mzs: Iterable[float],
+            max_dmz_da: float = None,
+            max_dmz_ppm: float | int = None,
+            adducts: Iterable[str] = tuple(ION_PREFERENCES),
+            query_adducts: Iterable[str | None] = None,
+    ) -> pd.DataFrame:
+        """
+        Match measured m/z against the library by neutral mass across adducts
+        (e.g. a feature measured as [M+Na]+ hits an entry recorded as [M+H]+).
+        If the adducts of the queries are known (query_adducts), only hits
+        explained by that adduct are returned.
+        """
+        adducts = tuple(adducts)
+        mzs = np.asarray(list(mzs), dtype=float)
+        query_idcs, lib_pos, mzs_lib, adduct_idcs = self._find_candidates_precursor(
+            mzs, max_dmz_da=max_dmz_da, max_dmz_ppm=max_dmz_ppm, adducts=adducts
+        )
+        adduct_names = np.asarray(adducts + (None,), dtype=object)
+        adducts_lib = self._metadata_sorted['adduct'][lib_pos]
+        # unknown library adduct: the stored ion is the only explanation
+        adducts_query = np.where(adduct_idcs >= 0, adduct_names[adduct_idcs], adducts_lib)
+
+        if query_adducts is not None:
+            query_adducts = np.asarray(list(query_adducts), dtype=object)
+            keep = (query_adducts[query_idcs] == None) | (query_adducts[query_idcs] == adducts_query)
+            query_idcs, lib_pos, mzs_lib, adducts_query, adducts_lib = \
+                query_idcs[keep], lib_pos[keep], mzs_lib[keep], adducts_query[keep], adducts_lib[keep]
+
+        dmz = mzs[query_idcs] - mzs_lib
+        return pd.DataFrame(dict(
+            query_index=query_idcs,
+            feature_id=self.f_ids_sorted[lib_pos],
+            query_adduct=adducts_query,
+            library_adduct=adducts_lib,
+            mz_library=mzs_lib,
+            dmz_mda=dmz * 1e3,
+            dmz_ppm=dmz / mzs_lib * 1e6,
+        ))
 
-        # convert types
-        return [[int(f_id) for f_id in _f_ids] for _f_ids in f_ids]
+    def find_matches_precursor(
+            self,
+            mzs: Iterable[float],
+            max_dmz_da: float = None,
+            max_dmz_ppm: float | int = None,
+            rts_seconds: Iterable[float | None] = None,
+            ccss: Iterable[float | None] = None,
+            max_drt_seconds: float = None,
+            max_dccs_A: float = None,
+    ) -> list[list[int]]:
+        """Returns the matched feature ids"""
+        mzs = np.asarray(mzs, dtype=float)
+        query_idcs, lib_pos, *_ = self._find_candidates_precursor(
+            mzs, max_dmz_da=max_dmz_da, max_dmz_ppm=max_dmz_ppm,
+            rts_seconds=rts_seconds, ccss=ccss, max_drt_seconds=max_drt_seconds, max_dccs_A=max_dccs_A
+        )
+        if len(mzs) == 0:
+            return []
+        # query indices are sorted, split into one array per query
+        splits = np.searchsorted(query_idcs, np.arange(1, len(mzs)))
+        return [f_ids.tolist() for f_ids in np.split(self.f_ids_sorted[lib_pos], splits)]
 
     def find_matches(
             self,
@@ -421,10 +1712,52 @@ class Library(FeatureManagerDB):
             ms2_spectra: Iterable[PeakList | None] | dict[int, PeakList | None] = None,
             max_ms2_dmz_da: float = 10e-3,
             min_ms2_score: float | None = 0.7,
-            metric: Callable[[PeakList | None, PeakList | None], float] | Literal['cosine_fwd', 'cosine_bwd', 'cosine_sim'] = 'cosine_sim',
+            metric: Callable[[PeakList | None, PeakList | None], float] | str = 'cosine_sim',
             return_nhits_ms2: bool = False,
             require_ms2: bool = False,
+            as_table: bool = False,
+            adducts: Iterable[str] = None,
+            rts_seconds: Iterable[float | None] | dict[int, float | None] = None,
+            ccss: Iterable[float | None] | dict[int, float | None] = None,
+            max_drt_seconds: float = None,
+            max_dccs_A: float = None,
+            prefilter_fraction: float = None,
+            prefilter_bin_width: float = 1.,
+            prefilter_bin_offset: float = 0.4,
+            preprocessing: Preprocessing = None,
+            use_cache: bool = False,
     ):
+        """
+        Match measured precursors (and optionally MS2 spectra) against the
+        library. By default a list (or dict if mzs is a dict) of matches per
+        query is returned. With as_table=True all matches are returned as one
+        flat DataFrame (one row per query-library pair), which is much faster
+        for large queries. Providing adducts (requires as_table) matches by
+        neutral mass across those adducts, see find_matches_adducts.
+
+        Retention times and CCS of the queries (same layout as mzs) together
+        with max_drt_seconds and max_dccs_A restrict the candidates before MS2
+        scoring. Missing values do not exclude a candidate.
+
+        metric is the name of a metric in msIO.metrics.METRICS (e.g.
+        'cosine_sim', 'modified_cosine' which also matches fragments shifted by
+        the difference of the query and library precursor m/z, 'entropy') or a
+        callable like cosine_similarity_sym. With as_table=True named metrics
+        score all candidates at once with their batched kernel.
+
+        For wide precursor windows (analog or open search), prefilter_fraction
+        (requires as_table) first ranks the candidates of each query by an
+        approximate cosine of binned spectra (see get_binned_spectra) and only
+        scores the best fraction of them exactly, the others are dropped.
+        With use_cache=True the binned and preprocessed library spectra are
+        also stored next to the library DB.
+
+        A preprocessing pipeline (see msIO.preprocessing) is applied to the
+        query and library spectra before scoring, the processed library spectra
+        are kept in memory (see get_preprocessed_spectra).
+        """
+        assert (adducts is None) or as_table, 'adduct matching is only available with as_table=True'
+        assert (prefilter_fraction is None) or as_table, 'prefiltering is only available with as_table=True'
         assert (max_dmz_da is None) ^ (max_dmz_ppm is None), \
             'provide either max_dmz_da or max_dmz_ppm (but not both)'
         if (as_dicts := isinstance(mzs, dict)) and (ms2_spectra is not None) and (not isinstance(ms2_spectra, dict)):
@@ -435,14 +1768,37 @@ class Library(FeatureManagerDB):
             mzs: list[float] = list(mzs.values())
             if ms2_spectra is not None:
                 ms2_spectra: list[PeakList | None] = [ms2_spectra.get(f_id) for f_id in mz_ids]
+            if rts_seconds is not None:
+                rts_seconds = [rts_seconds.get(f_id) for f_id in mz_ids]
+            if ccss is not None:
+                ccss = [ccss.get(f_id) for f_id in mz_ids]
         else:
-            assert len(ms2_spectra) == len(mzs), \
+            assert (ms2_spectra is None) or (len(ms2_spectra) == len(mzs)), \
                 'ms2 and mzs must have the same length (can set ms2 to None for some mzs, if not available)'
             mz_ids = None
 
+        if (preprocessing is not None) and (ms2_spectra is not None):
+            # library spectra are processed where they are loaded
+            processed = preprocessing(SpectrumArrays.from_peak_lists(ms2_spectra, precursor_mzs=mzs))
+            # spectra without peaks left are missing
+            ms2_spectra = [
+                processed.to_peak_list(i) if n_peaks > 0 else None for i, n_peaks in enumerate(processed.n_peaks)
+            ]
+
+        if as_table:
+            return self._find_matches_table(
+                mzs=mzs, mz_ids=mz_ids, max_dmz_da=max_dmz_da, max_dmz_ppm=max_dmz_ppm,
+                ms2_spectra=ms2_spectra, max_ms2_dmz_da=max_ms2_dmz_da, min_ms2_score=min_ms2_score,
+                metric=metric, require_ms2=require_ms2, adducts=adducts,
+                rts_seconds=rts_seconds, ccss=ccss, max_drt_seconds=max_drt_seconds, max_dccs_A=max_dccs_A,
+                prefilter_fraction=prefilter_fraction, prefilter_bin_width=prefilter_bin_width,
+                prefilter_bin_offset=prefilter_bin_offset, preprocessing=preprocessing, use_cache=use_cache
+            )
+
         logger.info(f'finding precursor matches')
         matched_f_ids: list[list[int]] = self.find_matches_precursor(
-            mzs=mzs, max_dmz_da=max_dmz_da, max_dmz_ppm=max_dmz_ppm
+            mzs=mzs, max_dmz_da=max_dmz_da, max_dmz_ppm=max_dmz_ppm,
+            rts_seconds=rts_seconds, ccss=ccss, max_drt_seconds=max_drt_seconds, max_dccs_A=max_dccs_A
         )
         logger.info(f'found matches for {sum(1 for mchs in matched_f_ids if len(mchs) > 0):_} features')
 
@@ -455,15 +1811,8 @@ class Library(FeatureManagerDB):
             else:
                 return matched_f_ids
 
-        if isinstance(metric, str):
-            if metric == 'cosine_sim':
-                metric = cosine_similarity_sym
-            elif metric == 'cosine_fwd':
-                metric = cosine_similarity_forward
-            elif metric == 'cosine_backward':
-                metric = cosine_similarity_backward
-            else:
-                raise ValueError(f'Unknown metric {metric}')
+        uses_precursors = isinstance(metric, str) and get_metric(metric).uses_precursors
+        metric = self._get_metric(metric)
 
         # fetch ms2 spectra of library matches
         matched_f_ids_raveled: set[int] = set()
@@ -471,7 +1820,9 @@ class Library(FeatureManagerDB):
             matched_f_ids_raveled.update(_f_ids_matched_precursor)
 
         logger.info(f'loading lib ms2 spectra for {len(matched_f_ids_raveled):_} features')
-        matched_ms2_spectra_lib: dict[int, PeakList] = self.get_ms_spectra(list(matched_f_ids_raveled), level=2)
+        matched_ms2_spectra_lib: dict[int, PeakList] = self._get_ms2_peak_lists(
+            list(matched_f_ids_raveled), preprocessing, use_cache
+        )
 
         ann_libs: dict[int, str] = self._get_dict_for_attributes(FeatureMetaboScape, 'annotation_type')
 
@@ -486,7 +1837,8 @@ class Library(FeatureManagerDB):
         ):
             matches_per_meas: list[dict] = []
             for f_id_lib in f_id_libs:
-                ms2_score, *n_hits_ms2 = metric(matched_ms2_spectra_lib.get(f_id_lib), ms2_measured, max_ms2_dmz_da, return_nhits=return_nhits_ms2)
+                kwargs = dict(precursor_mz_ref=self.mzs[f_id_lib], precursor_mz_meas=mz_meas) if uses_precursors else {}
+                ms2_score, *n_hits_ms2 = metric(matched_ms2_spectra_lib.get(f_id_lib), ms2_measured, max_ms2_dmz_da, return_nhits=return_nhits_ms2, **kwargs)
                 # only add the entry if ms2 is not required or score is above the threshold
                 if (require_ms2 and np.isnan(ms2_score)) or (ms2_score < min_ms2_score):
                     continue
@@ -512,6 +1864,321 @@ class Library(FeatureManagerDB):
             return out
         return matches
 
+    def _get_ms2_arrays(
+            self, feature_ids: list[int], preprocessing: Preprocessing | None, use_cache: bool = False
+    ) -> SpectrumArrays:
+        if preprocessing is None:
+            return self.get_ms_spectra_arrays(feature_ids, level=2)
+        return self.get_preprocessed_spectra(preprocessing, feature_ids, use_cache=use_cache)
+
+    def _get_ms2_peak_lists(
+            self, feature_ids: list[int], preprocessing: Preprocessing | None, use_cache: bool = False
+    ) -> dict[int, PeakList]:
+        if preprocessing is None:
+            return self.get_ms_spectra(feature_ids, level=2)
+        spectra = self.get_preprocessed_spectra(preprocessing, feature_ids, use_cache=use_cache)
+        # spectra without peaks left are missing
+        return {
+            f_id: spectra.to_peak_list(i)
+            for i, (f_id, n_peaks) in enumerate(zip(spectra.feature_ids.tolist(), spectra.n_peaks)) if n_peaks > 0
+        }
+
+    @staticmethod
+    def _get_metric(
+            metric: Callable | str
+    ) -> Callable[[PeakList | None, PeakList | None], float]:
+        if not isinstance(metric, str):
+            return metric
+        return get_metric(metric).scalar
+
+    def _find_matches_table(
+            self,
+            mzs: list[float],
+            mz_ids: list[int] | None,
+            max_dmz_da: float | None,
+            max_dmz_ppm: float | int | None,
+            ms2_spectra: list[PeakList | None] | None,
+            max_ms2_dmz_da: float,
+            min_ms2_score: float | None,
+            metric: Callable | str,
+            require_ms2: bool,
+            adducts: Iterable[str] | None = None,
+            rts_seconds: Iterable[float | None] = None,
+            ccss: Iterable[float | None] = None,
+            max_drt_seconds: float = None,
+            max_dccs_A: float = None,
+            prefilter_fraction: float = None,
+            prefilter_bin_width: float = 1.,
+            prefilter_bin_offset: float = 0.4,
+            preprocessing: Preprocessing = None,
+            use_cache: bool = False,
+    ) -> pd.DataFrame:
+        """Columnar version of find_matches, see there (queries are already preprocessed)."""
+        mzs = np.asarray(mzs, dtype=float)
+        logger.info(f'finding precursor matches')
+        adducts = tuple(adducts) if adducts is not None else None
+        query_idcs, lib_pos, mzs_lib, adduct_idcs = self._find_candidates_precursor(
+            mzs=mzs, max_dmz_da=max_dmz_da, max_dmz_ppm=max_dmz_ppm, adducts=adducts,
+            rts_seconds=rts_seconds, ccss=ccss, max_drt_seconds=max_drt_seconds, max_dccs_A=max_dccs_A
+        )
+        logger.info(f'found {len(query_idcs):_} candidates for {len(np.unique(query_idcs)):_} features')
+
+        if (ms2_spectra is not None) and (prefilter_fraction is not None):
+            keep = self._prefilter_candidates(
+                ms2_spectra, query_idcs, self.f_ids_sorted[lib_pos], prefilter_fraction,
+                prefilter_bin_width, prefilter_bin_offset, keep_missing=not require_ms2, use_cache=use_cache
+            )
+            query_idcs, lib_pos, mzs_lib, adduct_idcs = \
+                query_idcs[keep], lib_pos[keep], mzs_lib[keep], adduct_idcs[keep]
+            logger.info(f'kept {len(query_idcs):_} candidates after prefiltering')
+
+        n_candidates = len(query_idcs)
+        ms2_scores = np.full(n_candidates, np.nan)
+        n_hits = np.zeros(n_candidates, dtype=np.int64)
+
+        if ms2_spectra is not None:
+            f_ids_candidates = self.f_ids_sorted[lib_pos]
+            logger.info(f'loading lib ms2 spectra for {len(np.unique(f_ids_candidates)):_} features')
+            if isinstance(metric, str):
+                # score all candidates at once with the batched kernel of the metric
+                spectra_query = SpectrumArrays.from_peak_lists(ms2_spectra, precursor_mzs=mzs)
+                spectra_lib = self._get_ms2_arrays(np.unique(f_ids_candidates).tolist(), preprocessing, use_cache)
+                spec_lib = pd.Index(spectra_lib.feature_ids).get_indexer(f_ids_candidates)
+                has_ms2 = spec_lib >= 0
+                ms2_scores[has_ms2], n_hits[has_ms2] = score_pairs(
+                    metric, spectra_lib, spectra_query, max_ms2_dmz_da, spec_lib[has_ms2], query_idcs[has_ms2]
+                )
+            else:
+                metric = self._get_metric(metric)
+                ms2_lib: dict[int, PeakList] = self._get_ms2_peak_lists(
+                    np.unique(f_ids_candidates).tolist(), preprocessing, use_cache
+                )
+
+                for i, (query_idx, f_id_lib) in tqdm(
+                        enumerate(zip(query_idcs.tolist(), f_ids_candidates.tolist())),
+                        desc='assigning ms2 scores',
+                        total=n_candidates
+                ):
+                    ms2_scores[i], n_hits[i] = metric(
+                        ms2_lib.get(f_id_lib), ms2_spectra[query_idx], max_ms2_dmz_da, return_nhits=True
+                    )
+
+            # NaN scores (no MS2) pass unless MS2 is required
+            keep = ~(ms2_scores < (min_ms2_score if min_ms2_score is not None else -np.inf))
+            if require_ms2:
+                keep &= ~np.isnan(ms2_scores)
+            query_idcs, lib_pos, mzs_lib, adduct_idcs, ms2_scores, n_hits = \
+                query_idcs[keep], lib_pos[keep], mzs_lib[keep], adduct_idcs[keep], ms2_scores[keep], n_hits[keep]
+
+        dmz = mzs[query_idcs] - mzs_lib
+        metadata = self._metadata_sorted
+        out = pd.DataFrame(dict(
+            query_index=query_idcs,
+            query_id=np.asarray(mz_ids, dtype=np.int64)[query_idcs] if mz_ids is not None else query_idcs,
+            feature_id=self.f_ids_sorted[lib_pos],
+            dmz_mda=dmz * 1e3,
+            dmz_ppm=dmz / mzs_lib * 1e6,
+            ms2_score=ms2_scores,
+            n_hits_ms2=n_hits,
+            name=metadata['name'][lib_pos],
+            formula=metadata['formula'][lib_pos],
+            source_library=metadata['source_library'][lib_pos],
+        ))
+        if adducts is not None:
+            adduct_names = np.asarray(adducts + (None,), dtype=object)
+            out['library_adduct'] = metadata['adduct'][lib_pos]
+            out['query_adduct'] = np.where(adduct_idcs >= 0, adduct_names[adduct_idcs], out['library_adduct'])
+        return out
+
+    def approximate_cosine(
+            self,
+            ms2_spectra: list[PeakList | None],
+            query_idcs: np.ndarray[int],
+            feature_ids: np.ndarray[int],
+            bin_width: float = 1.,
+            bin_offset: float = 0.4,
+            queries_per_batch: int = 100,
+            use_cache: bool = False
+    ) -> np.ndarray[float]:
+        """
+        Approximate cosine score of ms2_spectra[query_idcs[i]] with the library
+        spectrum of feature_ids[i] from binned vectors, NaN if either spectrum
+        is missing. Each batch of queries takes one sparse matrix product with
+        the library spectra of their candidates (use_cache, see
+        get_binned_spectra).
+        """
+        vectors_lib, f_ids_lib = self.get_binned_spectra(bin_width, bin_offset, use_cache=use_cache)
+        spectra_query = SpectrumArrays.from_peak_lists(ms2_spectra)
+        vectors_query = binned_vectors(spectra_query, bin_width, bin_offset, n_bins=vectors_lib.shape[1])
+
+        query_idcs = np.asarray(query_idcs, dtype=np.int64)
+        rows_lib = pd.Index(f_ids_lib).get_indexer(np.asarray(feature_ids, dtype=np.int64))
+        scores = np.full(len(query_idcs), np.nan)
+        has_ms2 = (rows_lib >= 0) & (spectra_query.n_peaks[query_idcs] > 0)
+
+        o = np.flatnonzero(has_ms2)[np.argsort(query_idcs[has_ms2], kind='stable')]
+        bounds = np.searchsorted(query_idcs[o], np.arange(0, len(spectra_query) + queries_per_batch, queries_per_batch))
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if start == stop:
+                continue
+            batch = o[start:stop]
+            first_query = query_idcs[batch[0]]
+            rows_unique, cols = np.unique(rows_lib[batch], return_inverse=True)
+            products = vectors_query[first_query:query_idcs[batch[-1]] + 1] @ vectors_lib[rows_unique].T
+            # lookups bisect sorted rows, otherwise they scan them
+            products.sort_indices()
+            scores[batch] = np.asarray(products[query_idcs[batch] - first_query, cols]).ravel()
+        return scores
+
+    def _prefilter_candidates(
+            self,
+            ms2_spectra: list[PeakList | None],
+            query_idcs: np.ndarray[int],
+            feature_ids: np.ndarray[int],
+            fraction: float,
+            bin_width: float,
+            bin_offset: float,
+            keep_missing: bool = True,
+            use_cache: bool = False
+    ) -> np.ndarray[bool]:
+        """Mask of the candidates among the best fraction (rounded up) of each
+        query by approximate cosine. Candidates without spectra are kept if
+        keep_missing (they can not be scored anyway)."""
+        assert 0 < fraction <= 1, 'fraction must be in (0, 1]'
+        scores = self.approximate_cosine(
+            ms2_spectra, query_idcs, feature_ids, bin_width, bin_offset, use_cache=use_cache
+        )
+        has_score = np.flatnonzero(~np.isnan(scores))
+        n_keep = np.ceil(fraction * np.bincount(query_idcs[has_score], minlength=len(ms2_spectra)))
+
+        # rank the candidates of each query by their score
+        o = has_score[np.lexsort((-scores[has_score], query_idcs[has_score]))]
+        queries_sorted = query_idcs[o]
+        ranks = np.arange(len(o)) - np.searchsorted(queries_sorted, queries_sorted, side='left')
+        keep = np.isnan(scores) if keep_missing else np.zeros(len(scores), dtype=bool)
+        keep[o[ranks < n_keep[queries_sorted]]] = True
+        return keep
+
+    def find_duplicates(
+            self,
+            max_dmz_da: float = 5e-3,
+            min_ms2_score: float | None = 0.7,
+            max_ms2_dmz_da: float = 10e-3,
+            require_ms2: bool = True,
+            batch_size: int = 20_000
+    ) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Find library entries that are likely the same compound. Candidate
+        pairs have precursors within max_dmz_da (sweep over the sorted m/z)
+        and are confirmed by the cosine score of their MS2 spectra (pairs
+        without MS2 only pass if require_ms2 is False, min_ms2_score=None
+        skips the MS2 comparison).
+
+        Returns the edges (feature_id_a, feature_id_b, dmz_mda, ms2_score,
+        n_hits_ms2) and the connected components with more than one entry
+        (feature_id, group_id, group_size, name, source_library).
+        """
+        mzs = self.mzs_sorted
+        n = len(mzs)
+        # all pairs i < j with mz_j - mz_i < max_dmz_da
+        lo = np.arange(1, n + 1)
+        hi = np.searchsorted(mzs, mzs + max_dmz_da, side='left')
+        counts = np.maximum(hi - lo, 0)
+        pos_a = np.repeat(np.arange(n), counts)
+        pos_b = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        logger.info(f'found {len(pos_a):_} candidate pairs')
+
+        f_ids_a, f_ids_b = self.f_ids_sorted[pos_a], self.f_ids_sorted[pos_b]
+        ms2_scores = np.full(len(pos_a), np.nan)
+        n_hits = np.zeros(len(pos_a), dtype=np.int64)
+        if min_ms2_score is not None:
+            spectra = self.get_ms_spectra_arrays(np.unique(np.concatenate([f_ids_a, f_ids_b])).tolist(), level=2)
+            # position of the spectrum of each entry (-1 without MS2)
+            spec_index = pd.Index(spectra.feature_ids)
+            spec_a, spec_b = spec_index.get_indexer(f_ids_a), spec_index.get_indexer(f_ids_b)
+            has_ms2 = (spec_a >= 0) & (spec_b >= 0)
+            ms2_scores[has_ms2], n_hits[has_ms2] = cosine_similarity_batch(
+                spectra, spectra, max_ms2_dmz_da, spec_a[has_ms2], spec_b[has_ms2], batch_size=batch_size
+            )
+            # NaN scores (no MS2) pass unless MS2 is required
+            keep = ~(ms2_scores < min_ms2_score)
+            if require_ms2:
+                keep &= ~np.isnan(ms2_scores)
+            pos_a, pos_b, f_ids_a, f_ids_b, ms2_scores, n_hits = \
+                pos_a[keep], pos_b[keep], f_ids_a[keep], f_ids_b[keep], ms2_scores[keep], n_hits[keep]
+
+        edges = pd.DataFrame(dict(
+            feature_id_a=f_ids_a,
+            feature_id_b=f_ids_b,
+            dmz_mda=(mzs[pos_b] - mzs[pos_a]) * 1e3,
+            ms2_score=ms2_scores,
+            n_hits_ms2=n_hits,
+        ))
+
+        G = nx.Graph()
+        G.add_edges_from(zip(f_ids_a.tolist(), f_ids_b.tolist()))
+        # number groups by their smallest feature id
+        components = sorted((sorted(c) for c in nx.connected_components(G)), key=lambda c: c[0])
+        group_sizes = np.asarray([len(c) for c in components], dtype=np.int64)
+        f_ids_groups = np.asarray([f_id for c in components for f_id in c], dtype=np.int64)
+        pos = pd.Index(self.f_ids_sorted).get_indexer(f_ids_groups)
+        metadata = self._metadata_sorted
+        groups = pd.DataFrame(dict(
+            feature_id=f_ids_groups,
+            group_id=np.repeat(np.arange(len(components)), group_sizes),
+            group_size=np.repeat(group_sizes, group_sizes),
+            name=metadata['name'][pos],
+            source_library=metadata['source_library'][pos],
+        ))
+        logger.info(f'found {len(components):_} groups of duplicates with {len(groups):_} entries')
+        return edges, groups
+
+    def write_duplicate_groups(self, groups: pd.DataFrame) -> None:
+        """Store groups found by find_duplicates in the duplicate_group table
+        (replacing previous groups)."""
+        SqlBaseClass.metadata.create_all(get_engine(self.path_file), tables=DUPLICATE_TABLES)
+        rows = [
+            dict(id=i + 1, group_id=group_id, feature_id=feature_id, group_size=group_size)
+            for i, (group_id, feature_id, group_size) in enumerate(zip(
+                groups['group_id'].tolist(), groups['feature_id'].tolist(), groups['group_size'].tolist()
+            ))
+        ]
+        with self.session_maker() as session:
+            session.execute(delete(DuplicateGroup))
+            if len(rows) > 0:
+                session.execute(insert(DuplicateGroup), rows)
+            session.commit()
+
+    def get_duplicate_groups(self) -> dict[int, list[int]]:
+        """Feature ids of the stored groups of duplicates by group id."""
+        if not inspect(get_engine(self.path_file)).has_table(DuplicateGroup.__tablename__):
+            return {}
+        stmt = select(DuplicateGroup.group_id, DuplicateGroup.feature_id).order_by(DuplicateGroup.id)
+        groups: dict[int, list[int]] = {}
+        with self.session_maker() as session:
+            for group_id, feature_id in session.execute(stmt).all():
+                groups.setdefault(group_id, []).append(feature_id)
+        return groups
+
+    def get_duplicate_consensus_spectra(
+            self,
+            tol_ppm: float = 5.,
+            min_fraction: float = 0.5,
+            preprocessing: Preprocessing | None = None
+    ) -> SpectrumArrays:
+        """
+        Consensus MS2 spectrum of each stored group of duplicates (see
+        consensus_arrays), the feature ids of the result are the group ids.
+        Members without a spectrum do not count towards the group.
+        """
+        groups = self.get_duplicate_groups()
+        feature_ids = [f_id for members in groups.values() for f_id in members]
+        group_of_feature = dict(zip(feature_ids, [g_id for g_id, members in groups.items() for _ in members]))
+        spectra = self._get_ms2_arrays(sorted(set(feature_ids)), preprocessing)
+        return consensus_arrays(
+            spectra, [group_of_feature[f_id] for f_id in spectra.feature_ids.tolist()], tol_ppm, min_fraction
+        )
+
     def plot_compound_overview(self, f_id, axs: tuple[plt.Axes, plt.Axes] = None, **kwargs):
         if axs is None:
             _, axs = plt.subplots(nrows=2)
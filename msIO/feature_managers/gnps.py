@@ -42,6 +42,12 @@ class GnpsImportManager(FeatureManager):
         )
         self._features[f_id] = f
 
+    def get_table(self) -> pd.DataFrame:
+        """Node properties indexed by feature id."""
+        df = self._df_nodes.copy()
+        df['rt_minutes'] = df['rt_seconds'] / 60
+        return df
+
     @cached_property
     def feature_ids(self) -> np.ndarray[int]:
         return self._df_nodes.index.values
@@ -2,12 +2,20 @@ import numpy as np
 import pandas as pd
 
 from msIO.feature_managers.base import FeatureManager
-from msIO.features.metaboscape import FeatureMetaboScape, METABOSCAPE_CSV_RENAME_COLUMNS
+from msIO.features.metaboscape import FeatureMetaboScape, METABOSCAPE_CSV_RENAME_COLUMNS, SampleOrder, \
+    is_intensity_column
 from msIO.environmental.sample import Sample
 
 
 class MetaboscapeImportManager(FeatureManager):
-    def __init__(self, path_metaboscape_export_file: str, path_metaboscape_clipboard_file: str = None):
+    def __init__(
+            self,
+            path_metaboscape_export_file: str,
+            path_metaboscape_clipboard_file: str = None,
+            compact_intensities: bool = False
+    ):
+        """With compact_intensities, intensities of each feature are stored as
+        one packed vector instead of one row per (feature, sample)."""
         self.path_metaboscape_export_file = path_metaboscape_export_file
 
         _df = pd.read_csv(path_metaboscape_export_file).rename(columns=METABOSCAPE_CSV_RENAME_COLUMNS)
@@ -26,6 +34,7 @@ class MetaboscapeImportManager(FeatureManager):
             self._add_from_clipboard(path_metaboscape_clipboard_file)
 
         self._sample_name_to_sample: dict[str, Sample] = {}
+        self._sample_order: SampleOrder | None = SampleOrder() if compact_intensities else None
 
     def _add_from_clipboard(self, path_file: str):
         # rows should match 1 to 1
@@ -46,9 +55,28 @@ class MetaboscapeImportManager(FeatureManager):
     def feature_ids(self):
         return self._df.feature_id.unique()
 
+    @property
+    def intensity_columns(self) -> list[str]:
+        return [c for c in self._df.columns if is_intensity_column(c)]
+
+    def get_table(self) -> pd.DataFrame:
+        """Feature properties (without intensities) indexed by feature id."""
+        df = self._df.drop(columns=self.intensity_columns).drop_duplicates('feature_id').set_index('feature_id')
+        df['rt_minutes'] = df['rt_seconds'] / 60
+        return df
+
+    def get_intensity_table(self) -> pd.DataFrame:
+        """Intensities (samples x feature ids), missing values are set to 0 like in to_intensity."""
+        df = self._df.drop_duplicates('feature_id').set_index('feature_id').loc[:, self.intensity_columns]
+        values = df.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+        values = np.where(values > 0, values, 0).astype(np.int64)
+        return pd.DataFrame(values.T, index=df.columns, columns=df.index).sort_index(axis=1)
+
     def _inner_missing_feature(self, f_id) -> None:
         idx = np.argwhere(self._df.feature_id == f_id)[0][0]
-        f = FeatureMetaboScape.from_dataframe_row(self._df.iloc[idx, :], self._sample_name_to_sample)
+        f = FeatureMetaboScape.from_dataframe_row(
+            self._df.iloc[idx, :], self._sample_name_to_sample, self._sample_order
+        )
         self._features[f_id] = f
 
 
@@ -4,7 +4,7 @@ import numpy as np
 import pandas as pd
 
 from msIO.feature_managers.base import FeatureManager
-from msIO.features.sirius import FeatureSirius
+from msIO.features.sirius import FeatureSirius, flatten_highest_scoring
 
 SIRIUS_FILE_NAMES = [
     'formula_identifications',
@@ -132,6 +132,13 @@ class SiriusImportManager(FeatureManager):
             renamer = renamers[n]
             process_with_rename(n, renamer)
 
+    def get_highest_scoring_table(
+            self, use_zodiac_scoring_for_best: bool = True, prefer_npc: bool = True
+    ) -> pd.DataFrame:
+        """Best formula, compound and compound class for all features, indexed by feature id."""
+        assert self._tables is not None, 'tables have to be read first'
+        return flatten_highest_scoring(self._tables, use_zodiac_scoring_for_best, prefer_npc)
+
     def _inner_missing_feature(self, f_id) -> None:
         f = FeatureSirius.from_tables(f_id, self._tables)
         self._features[f_id] = f
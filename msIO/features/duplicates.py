@@ -0,0 +1,21 @@
+"""
+Groups of library entries that describe the same compound (e.g. the same
+spectrum in several source libraries), see Library.find_duplicates.
+"""
+from sqlalchemy import Integer
+from sqlalchemy.orm import Mapped, mapped_column
+
+from msIO.features.base import SqlBaseClass
+
+
+class DuplicateGroup(SqlBaseClass):
+    """Membership of a library entry in a group of duplicates."""
+    __tablename__ = "duplicate_group"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    group_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    feature_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    group_size: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+DUPLICATE_TABLES = [DuplicateGroup.__table__]
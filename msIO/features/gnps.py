@@ -19,7 +19,7 @@ class FeatureGnpsNode(SqlBaseClass, FeatureBaseClass):
     __tablename__ = "gnps_features"
 
     id: Mapped[int] = mapped_column(primary_key=True)  # required unless inherited
-    feature_id: Mapped[Optional[int]] = mapped_column(Integer)
+    feature_id: Mapped[Optional[int]] = mapped_column(Integer, index=True)
     cluster_label: Mapped[Optional[int]] = mapped_column(Integer)
     M_gnps: Mapped[Optional[float]] = mapped_column(Float)
     rt_seconds: Mapped[Optional[float]] = mapped_column(Float)
@@ -29,7 +29,7 @@ class FeatureGnpsNode(SqlBaseClass, FeatureBaseClass):
     #  converting to json for now
     other: Mapped[Optional[str]] = mapped_column(String)
 
-    combined_feature_id: Mapped[int] = mapped_column(ForeignKey('features.id'))
+    combined_feature_id: Mapped[int] = mapped_column(ForeignKey('features.id'), index=True)
     combined_feature: Mapped["FeatureCombined"] = relationship(back_populates='gnps')
 
     @classmethod
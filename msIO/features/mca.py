@@ -0,0 +1,73 @@
+"""
+Annotations of features from a MetaboScape .mca export, stored such that they
+can be queried by feature or compound name without re-parsing the .mca file.
+"""
+from typing import Optional
+
+from sqlalchemy import Integer, Float, String, ForeignKey, Index
+from sqlalchemy.orm import Mapped, mapped_column, relationship
+
+from msIO.features.base import SqlBaseClass
+
+
+class McaMatch(SqlBaseClass):
+    """Ion of an .mca molecule annotation that matched a feature."""
+    __tablename__ = "mca_matches"
+    __table_args__ = (
+        Index('ix_mca_matches_feature_id_rank', 'feature_id', 'rank'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    feature_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    # order of the match among all matches of the feature (0 is best)
+    rank: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    mca_file: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    molecule_index: Mapped[int] = mapped_column(Integer, nullable=False)
+    neutral_mass: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+
+    ion_mz: Mapped[float] = mapped_column(Float, nullable=False)
+    ion_rt_seconds: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    ion_ccs: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    ion_notation: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+
+    dmz_da: Mapped[float] = mapped_column(Float, nullable=False)
+    dmz_ppm: Mapped[float] = mapped_column(Float, nullable=False)
+    drt_seconds: Mapped[float] = mapped_column(Float, nullable=False)
+    dccs_A: Mapped[float] = mapped_column(Float, nullable=False)
+
+    annotations: Mapped[list["McaAnnotation"]] = relationship(
+        back_populates="match", cascade="all, delete-orphan"
+    )
+
+
+class McaAnnotation(SqlBaseClass):
+    __tablename__ = "mca_annotations"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[Optional[str]] = mapped_column(String, nullable=True, index=True)
+    formula: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    tool_name: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    db_name: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+
+    match_id: Mapped[int] = mapped_column(ForeignKey("mca_matches.id"), nullable=False, index=True)
+    match: Mapped["McaMatch"] = relationship(back_populates="annotations")
+
+    scores: Mapped[list["McaScore"]] = relationship(
+        back_populates="annotation", cascade="all, delete-orphan"
+    )
+
+
+class McaScore(SqlBaseClass):
+    __tablename__ = "mca_scores"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    value: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    unit: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+
+    annotation_id: Mapped[int] = mapped_column(ForeignKey("mca_annotations.id"), nullable=False, index=True)
+    annotation: Mapped["McaAnnotation"] = relationship(back_populates="scores")
+
+
+MCA_TABLES = [McaMatch.__table__, McaAnnotation.__table__, McaScore.__table__]
@@ -1,8 +1,9 @@
 from functools import cached_property
-from typing import Optional
+from typing import Optional, NamedTuple
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import Integer, Float, String, ForeignKey, Boolean
+from sqlalchemy import Integer, Float, String, ForeignKey, Boolean, LargeBinary, DDL, event
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from msIO.environmental.sample import Sample
@@ -27,6 +28,52 @@ METABOSCAPE_CSV_RENAME_COLUMNS: dict[str, str] = {
     'Include': 'include_flag'
 }
 
+# packed intensity vectors are stored as little-endian int64
+INTENSITY_VECTOR_DTYPE = np.dtype('<i8')
+
+# R*Tree over m/z, RT and CCS of the features, kept in sync by triggers.
+# Missing RT or CCS values span the whole axis, so they match any range.
+RTREE_TABLE = 'metaboscape_features_rtree'
+_RTREE_UNBOUNDED = 3e38  # rtree coordinates are 32-bit floats
+_RTREE_VALUES = (
+    f"NEW.id, NEW.mz_meas, NEW.mz_meas, "
+    f"coalesce(NEW.rt_seconds, -{_RTREE_UNBOUNDED}), coalesce(NEW.rt_seconds, {_RTREE_UNBOUNDED}), "
+    f"coalesce(NEW.CCS, -{_RTREE_UNBOUNDED}), coalesce(NEW.CCS, {_RTREE_UNBOUNDED})"
+)
+RTREE_DDL: list[str] = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {RTREE_TABLE} "
+    f"USING rtree(id, mz_min, mz_max, rt_min, rt_max, ccs_min, ccs_max)",
+    f"CREATE TRIGGER IF NOT EXISTS {RTREE_TABLE}_insert AFTER INSERT ON metaboscape_features "
+    f"WHEN NEW.mz_meas IS NOT NULL "
+    f"BEGIN INSERT INTO {RTREE_TABLE} VALUES ({_RTREE_VALUES}); END",
+    f"CREATE TRIGGER IF NOT EXISTS {RTREE_TABLE}_update AFTER UPDATE OF mz_meas, rt_seconds, CCS "
+    f"ON metaboscape_features "
+    f"BEGIN DELETE FROM {RTREE_TABLE} WHERE id = OLD.id; "
+    f"INSERT INTO {RTREE_TABLE} SELECT {_RTREE_VALUES} WHERE NEW.mz_meas IS NOT NULL; END",
+    f"CREATE TRIGGER IF NOT EXISTS {RTREE_TABLE}_delete AFTER DELETE ON metaboscape_features "
+    f"BEGIN DELETE FROM {RTREE_TABLE} WHERE id = OLD.id; END",
+]
+RTREE_BACKFILL: str = (
+    f"INSERT INTO {RTREE_TABLE} SELECT {_RTREE_VALUES.replace('NEW.', '')} "
+    f"FROM metaboscape_features WHERE mz_meas IS NOT NULL"
+)
+
+
+def is_intensity_column(column: str) -> bool:
+    """Columns of the MetaboScape export that are neither known properties
+    nor aggregated intensities hold the intensities of a sample."""
+    if column.endswith('MaxIntensity') or column.endswith('MeanIntensity'):
+        return False
+    return ((column not in METABOSCAPE_CSV_RENAME_COLUMNS.keys())
+            and (column not in METABOSCAPE_CSV_RENAME_COLUMNS.values()))
+
+
+def to_intensity(value) -> int:
+    """set nan values to 0"""
+    if isinstance(value, str):
+        value = float(value)
+    return 0 if not (value > 0) else int(value)
+
 
 class Intensity(SqlBaseClass, FeatureBaseClass):
     __tablename__ = "intensities"
@@ -35,13 +82,106 @@ class Intensity(SqlBaseClass, FeatureBaseClass):
 
     value: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
 
-    feature_id: Mapped[int] = mapped_column(ForeignKey("metaboscape_features.id"), nullable=False)
-    feature: Mapped["FeatureMetaboScape"] = relationship(back_populates="intensities")
+    feature_id: Mapped[int] = mapped_column(ForeignKey("metaboscape_features.id"), nullable=False, index=True)
+    feature: Mapped["FeatureMetaboScape"] = relationship(back_populates="intensity_rows")
 
-    sample_id: Mapped[int] = mapped_column(ForeignKey("samples.id", ondelete="CASCADE"), nullable=False)
+    sample_id: Mapped[int] = mapped_column(ForeignKey("samples.id", ondelete="CASCADE"), nullable=False, index=True)
     sample: Mapped["Sample"] = relationship("Sample", back_populates="intensities")
 
 
+class IntensityView(NamedTuple):
+    """Read-only stand-in for an Intensity row of a packed intensity vector"""
+    sample: Sample
+    value: int
+
+
+class SampleOrder(SqlBaseClass):
+    """Study-level order of samples to which packed intensity vectors are
+    aligned."""
+    __tablename__ = "sample_orders"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+    entries: Mapped[list["SampleOrderEntry"]] = relationship(
+        back_populates="sample_order",
+        cascade="all, delete-orphan",
+        order_by="SampleOrderEntry.position"
+    )
+
+    @property
+    def samples(self) -> list[Sample]:
+        return [e.sample for e in self.entries]
+
+    def positions(self, sample_name_to_sample: dict[str, Sample], sample_names) -> list[int]:
+        """Position of each sample name, samples not in the order yet are appended."""
+        name_to_position: dict[str, int] = {e.sample.sample_name: e.position for e in self.entries}
+        positions = []
+        for name in sample_names:
+            if name not in name_to_position:
+                if name not in sample_name_to_sample:
+                    sample_name_to_sample[name] = Sample(sample_name=name)
+                name_to_position[name] = len(self.entries)
+                self.entries.append(SampleOrderEntry(
+                    position=len(self.entries), sample=sample_name_to_sample[name]
+                ))
+            positions.append(name_to_position[name])
+        return positions
+
+
+class SampleOrderEntry(SqlBaseClass):
+    __tablename__ = "sample_order_entries"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    position: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    sample_order_id: Mapped[int] = mapped_column(ForeignKey("sample_orders.id"), nullable=False, index=True)
+    sample_order: Mapped["SampleOrder"] = relationship(back_populates="entries")
+
+    sample_id: Mapped[int] = mapped_column(ForeignKey("samples.id"), nullable=False)
+    sample: Mapped["Sample"] = relationship()
+
+
+class IntensityVector(SqlBaseClass, FeatureBaseClass):
+    """Intensities of one feature in all samples, packed into a single blob
+    and aligned to a SampleOrder. Replaces one Intensity row per sample."""
+    __tablename__ = "intensity_vectors"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+    packed: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+    feature_id: Mapped[int] = mapped_column(ForeignKey("metaboscape_features.id"), nullable=False, unique=True)
+    feature: Mapped["FeatureMetaboScape"] = relationship(back_populates="intensity_vector")
+
+    sample_order_id: Mapped[int] = mapped_column(ForeignKey("sample_orders.id"), nullable=False)
+    sample_order: Mapped["SampleOrder"] = relationship()
+
+    @classmethod
+    def from_intensities(
+            cls,
+            intensities: dict[str, int],
+            sample_order: SampleOrder,
+            sample_name_to_sample: dict[str, Sample]
+    ):
+        positions = sample_order.positions(sample_name_to_sample, intensities.keys())
+        values = np.zeros(len(sample_order.entries), dtype=INTENSITY_VECTOR_DTYPE)
+        values[positions] = list(intensities.values())
+        return cls(packed=values.tobytes(), sample_order=sample_order)
+
+    @property
+    def values(self) -> np.ndarray[int]:
+        return np.frombuffer(self.packed, dtype=INTENSITY_VECTOR_DTYPE)
+
+    def to_views(self) -> list[IntensityView]:
+        # samples appended to the order after this vector was packed have no intensity
+        values = self.values
+        return [IntensityView(sample=e.sample, value=int(values[e.position]) if e.position < len(values) else 0)
+                for e in self.sample_order.entries]
+
+    def to_dict(self) -> dict[str, int]:
+        return {v.sample.sample_name: v.value for v in self.to_views()}
+
+
 class FeatureMetaboScape(SqlBaseClass, FeatureBaseClass):
     """Container for features living in the exported feature table from MetaboScape"""
     __tablename__ = "metaboscape_features"
@@ -50,7 +190,7 @@ class FeatureMetaboScape(SqlBaseClass, FeatureBaseClass):
     # TODO: define Annotation objects
 
     id: Mapped[int] = mapped_column(primary_key=True)  # include only if not inherited
-    feature_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    feature_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
     rt_seconds: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
     M_metaboscape: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
     CCS: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
@@ -61,43 +201,61 @@ class FeatureMetaboScape(SqlBaseClass, FeatureBaseClass):
     adduct_metaboscape: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     KEGG: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
     CAS: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
-    mz_meas: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    mz_meas: Mapped[Optional[float]] = mapped_column(Float, nullable=True, index=True)
     flags: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     annotation_type: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     annotation_source: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     include_flag: Mapped[bool] = mapped_column(Boolean, nullable=True)
 
-    intensities: Mapped[list[Intensity]] = relationship(
+    intensity_rows: Mapped[list[Intensity]] = relationship(
+        back_populates="feature",
+        cascade="all, delete-orphan"
+    )
+    # compact alternative to intensity_rows
+    intensity_vector: Mapped[Optional[IntensityVector]] = relationship(
         back_populates="feature",
         cascade="all, delete-orphan"
     )
 
-    combined_feature_id: Mapped[Optional[int]] = mapped_column(ForeignKey('features.id'))
+    combined_feature_id: Mapped[Optional[int]] = mapped_column(ForeignKey('features.id'), index=True)
     combined_feature: Mapped[Optional["FeatureCombined"]] = relationship(back_populates='metaboscape')
 
     @classmethod
-    def from_dataframe_row(cls, ser: pd.Series, sample_name_to_sample: dict[str, Sample]):
-        processed = {'intensities': []}
+    def from_dataframe_row(
+            cls,
+            ser: pd.Series,
+            sample_name_to_sample: dict[str, Sample],
+            sample_order: SampleOrder = None
+    ):
+        """If a sample_order is provided, intensities are stored as a packed
+        vector aligned to it instead of one Intensity row per sample."""
+        processed = {}
+        intensities: dict[str, int] = {}
 
         for k, v in ser.items():
             if k.endswith('MaxIntensity') or k.endswith('MeanIntensity'):
                 continue
-            if ((k not in METABOSCAPE_CSV_RENAME_COLUMNS.keys())
-                    and (k not in METABOSCAPE_CSV_RENAME_COLUMNS.values())):
+            if is_intensity_column(k):
                 # print(f'column "{k}" could not be converted, assuming it contains intensities')
-                # set nan values to 0
-                if isinstance(v, str):
-                    v = float(v)
-                v = 0 if not (v > 0) else int(v)
-                if k not in sample_name_to_sample:
-                    sample_name_to_sample[k] = Sample(sample_name=k)
-                processed['intensities'].append(Intensity(sample=sample_name_to_sample[k], value=v))
+                intensities[k] = to_intensity(v)
             else:
                 if k in METABOSCAPE_CSV_RENAME_COLUMNS.values():
                     k_new = k
                 else:
                     k_new = METABOSCAPE_CSV_RENAME_COLUMNS[k]
                 processed[k_new] = cls._convert_type(k_new, v)
+
+        if sample_order is not None:
+            processed['intensity_vector'] = IntensityVector.from_intensities(
+                intensities, sample_order, sample_name_to_sample
+            )
+            return cls(**processed)
+
+        processed['intensity_rows'] = []
+        for k, v in intensities.items():
+            if k not in sample_name_to_sample:
+                sample_name_to_sample[k] = Sample(sample_name=k)
+            processed['intensity_rows'].append(Intensity(sample=sample_name_to_sample[k], value=v))
         return cls(**processed)
 
     @classmethod
@@ -105,6 +263,14 @@ class FeatureMetaboScape(SqlBaseClass, FeatureBaseClass):
         # TODO
         ...
 
+    @property
+    def intensities(self) -> list[Intensity | IntensityView]:
+        """Intensity rows, or views on the packed vector for features stored in
+        the compact layout."""
+        if self.intensity_vector is None:
+            return self.intensity_rows
+        return self.intensity_vector.to_views()
+
     @property
     def M(self):
         return self.M_metaboscape
@@ -124,6 +290,10 @@ class FeatureMetaboScape(SqlBaseClass, FeatureBaseClass):
         return self.adduct_metaboscape
 
 
+for _ddl in RTREE_DDL:
+    event.listen(FeatureMetaboScape.__table__, 'after_create', DDL(_ddl).execute_if(dialect='sqlite'))
+
+
 if __name__ == '__main__':
     t = FeatureMetaboScape.py_types()
 
@@ -1,9 +1,11 @@
 from dataclasses import dataclass
 from typing import Self, Optional
 
+import numpy as np
+import pandas as pd
 from enum import Enum as PyEnum
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import ForeignKey, Boolean, String, Integer, Float
+from sqlalchemy import ForeignKey, Boolean, String, Integer, Float, Index
 from sqlalchemy import Enum
 
 from msIO.features.base import FeatureBaseClass, SqlBaseClass
@@ -11,6 +13,8 @@ from msIO.list_of_ions.base import PeakList
 
 # select which ion is most likely (first in list)
 ION_PREFERENCES = ['[M+H]+', '[M+Na]+', '[M+K]+', '[M+NH4]+', '[M]+', '[M+H+H]2+', '[M+H+H2]3+']
+# properties of a FeatureMgf taken from the spectrum of the preferred ion
+PREFERRED_ION_PROPS = ['ion', 'rt_seconds', 'rt_minutes', 'charge', 'mz']
 
 
 def parse_ion_props(inpt: list[str]) -> dict:
@@ -45,6 +49,9 @@ def parse_ion_props(inpt: list[str]) -> dict:
 
 class MsSpec(SqlBaseClass, FeatureBaseClass):
     __tablename__ = "ms_spec"
+    __table_args__ = (
+        Index('ix_ms_spec_feature_mgf_id_ms_level', 'feature_mgf_id', 'ms_level'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
 
@@ -55,7 +62,7 @@ class MsSpec(SqlBaseClass, FeatureBaseClass):
     ion: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     rt_minutes: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
 
-    peaks_id: Mapped[Optional[int]] = mapped_column(ForeignKey("peak_list.id"))
+    peaks_id: Mapped[Optional[int]] = mapped_column(ForeignKey("peak_list.id"), index=True)
     peaks: Mapped[Optional["PeakList"]] = relationship()
 
     feature_mgf_id: Mapped[int] = mapped_column(ForeignKey("mgf_features.id"), nullable=False)
@@ -75,7 +82,7 @@ class FeatureMgf(SqlBaseClass, FeatureBaseClass):
     __tablename__ = "mgf_features"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    feature_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    feature_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
     polarity: Mapped[Optional[str]] = mapped_column(
         Enum("pos", "neg", name="polarity_enum"),
         nullable=True
@@ -98,7 +105,7 @@ class FeatureMgf(SqlBaseClass, FeatureBaseClass):
         back_populates="feature_mgf", cascade="all, delete-orphan"
     )
 
-    combined_feature_id: Mapped[Optional[int]] = mapped_column(ForeignKey('features.id'))
+    combined_feature_id: Mapped[Optional[int]] = mapped_column(ForeignKey('features.id'), index=True)
     combined_feature: Mapped[Optional["FeatureCombined"]] = relationship(back_populates='mgf')
 
     @classmethod
@@ -134,14 +141,75 @@ class FeatureMgf(SqlBaseClass, FeatureBaseClass):
                 add_pref = key[0]
                 ms_pref = adducts[key]
 
-        update_props = ['ion', 'rt_seconds', 'rt_minutes', 'charge', 'mz']
+        self._set_preferred(
+            ms_pref,
+            ms1=adducts[k].peaks if (k := (add_pref, 1)) in adducts else None,
+            ms2=adducts[k].peaks if (k := (add_pref, 2)) in adducts else None,
+        )
+
+    def _set_preferred(self, ms_pref: "MsSpec", ms1: PeakList | None, ms2: PeakList | None) -> None:
         self.__dict__ |= {k: v
                           for k, v in ms_pref.__dict__.items()
-                          if k in update_props}
-
-        for level in [1, 2]:
-            if (k := (add_pref, level)) in adducts:
-                self.__setattr__(f'ms{level}', adducts[k].peaks)
+                          if k in PREFERRED_ION_PROPS}
+        if ms1 is not None:
+            self.ms1 = ms1
+        if ms2 is not None:
+            self.ms2 = ms2
+
+
+def select_preferred_ions(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Same selection as FeatureMgf.__post_init__ for all features at once. df
+    has one row per spectrum (columns feature_id, ion, ms_level). Returns one
+    row per feature id with the position of the row of the preferred spectrum
+    ('row'), its ion and level and whether the feature has multiple adducts.
+
+    Among duplicates of (feature, ion, level) the last row is used, like the
+    dict in __post_init__.
+    """
+    n = len(df)
+    pos = np.arange(n)
+    keys = pd.DataFrame(dict(
+        feature_id=df['feature_id'].to_numpy(),
+        ion=df['ion'].to_numpy(dtype=object),
+        ms_level=df['ms_level'].to_numpy(dtype=np.int64),
+        pos=pos,
+    ))
+    ms_level = keys['ms_level'].to_numpy()
+    feature_ids = keys['feature_id'].to_numpy()
+
+    by_key = keys.groupby(['feature_id', 'ion', 'ms_level'], dropna=False, sort=False)['pos']
+    first = by_key.transform('min').to_numpy()
+    is_last = pos == by_key.transform('max').to_numpy()
+
+    by_ion = keys.assign(is_ms1=ms_level == 1, is_ms2=ms_level == 2) \
+        .groupby(['feature_id', 'ion'], dropna=False, sort=False)
+    has_both = by_ion['is_ms1'].transform('any').to_numpy() & by_ion['is_ms2'].transform('any').to_numpy()
+
+    rank = keys['ion'].map({ion: i for i, ion in enumerate(ION_PREFERENCES)}) \
+        .fillna(len(ION_PREFERENCES)).to_numpy(dtype=np.int64)
+    is_preferred = rank < len(ION_PREFERENCES)
+
+    # 0: preferred ion with both levels (MS2), 1: any preferred ion, 2: first stored
+    tier = np.where(is_preferred & has_both & (ms_level == 2), 0, np.where(is_preferred, 1, 2))
+    # within preferred ions MS2 comes first, otherwise the order of insertion counts
+    level_order = np.where((tier == 1) & (ms_level == 1), 1, 0)
+
+    candidates = np.flatnonzero(is_last)
+    o = candidates[np.lexsort((
+        first[candidates], level_order[candidates], rank[candidates], tier[candidates], feature_ids[candidates]
+    ))]
+    is_first_of_feature = np.ones(len(o), dtype=bool)
+    is_first_of_feature[1:] = feature_ids[o][1:] != feature_ids[o][:-1]
+    chosen = o[is_first_of_feature]
+
+    n_ions = keys.groupby('feature_id', sort=True)['ion'].nunique(dropna=False)
+    return pd.DataFrame(dict(
+        row=chosen,
+        ion=keys['ion'].to_numpy()[chosen],
+        ms_level=ms_level[chosen],
+        has_multiple_adducts=(n_ions.loc[feature_ids[chosen]] > 1).to_numpy(),
+    ), index=pd.Index(feature_ids[chosen], name='feature_id'))
 
 
 def test():
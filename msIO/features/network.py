@@ -0,0 +1,26 @@
+"""
+Edges of the molecular network of the features in a DB (MS2 similarity of
+their spectra), see FeatureManagerDB.build_similarity_network.
+"""
+from typing import Optional
+
+from sqlalchemy import Integer, Float
+from sqlalchemy.orm import Mapped, mapped_column
+
+from msIO.features.base import SqlBaseClass
+
+
+class SimilarityEdge(SqlBaseClass):
+    """Pair of features with similar MS2 spectra (feature_id_a < feature_id_b)."""
+    __tablename__ = "similarity_edges"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    feature_id_a: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    feature_id_b: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    score: Mapped[float] = mapped_column(Float, nullable=False)
+    n_matched_peaks: Mapped[int] = mapped_column(Integer, nullable=False)
+    # precursor m/z of b minus precursor m/z of a
+    precursor_delta: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+
+
+NETWORK_TABLES = [SimilarityEdge.__table__]
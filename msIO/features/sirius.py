@@ -1,5 +1,5 @@
 from typing import Optional, Self
-from sqlalchemy import ForeignKey, String, Float, Integer, Boolean
+from sqlalchemy import ForeignKey, String, Float, Integer, Boolean, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 import numpy as np
@@ -10,10 +10,13 @@ from msIO.features.base import FeatureBaseClass, SqlBaseClass
 
 class FormulaCandidate(SqlBaseClass, FeatureBaseClass):
     __tablename__ = "formula_candidate"
+    __table_args__ = (
+        Index('ix_formula_candidate_feature_id_formula_rank', 'feature_id', 'formula_rank'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     formula_sirius: Mapped[str] = mapped_column(String, nullable=True)
-    formula_rank: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    formula_rank: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
     adduct_sirius: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     zodiac_score: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
     sirius_score: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
@@ -33,11 +36,14 @@ class FormulaCandidate(SqlBaseClass, FeatureBaseClass):
 
 class CompoundCandidate(SqlBaseClass, FeatureBaseClass):
     __tablename__ = "compound_candidate"
+    __table_args__ = (
+        Index('ix_compound_candidate_feature_id_formula_rank', 'feature_id', 'formula_rank'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     confidence_rank: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     structure_per_id_rank: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
-    formula_rank: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    formula_rank: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
     num_adducts: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     num_predicted_fingerprints: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     confidence_score: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
@@ -82,7 +88,7 @@ class CompoundGroup(SqlBaseClass, FeatureBaseClass):
     cf_superclass_probability: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
     cf_path: Mapped[Optional[str]] = mapped_column(String, nullable=True)
 
-    feature_id: Mapped[int] = mapped_column(ForeignKey("feature_sirius.feature_id"))
+    feature_id: Mapped[int] = mapped_column(ForeignKey("feature_sirius.feature_id"), index=True)
     feature: Mapped["FeatureSirius"] = relationship(back_populates="compound_groups")
 
 
@@ -90,7 +96,7 @@ class FeatureSirius(SqlBaseClass, FeatureBaseClass):
     __tablename__ = "feature_sirius"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    feature_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    feature_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
 
     formula_candidates: Mapped[list[FormulaCandidate]] = relationship(
         back_populates="feature",
@@ -108,7 +114,7 @@ class FeatureSirius(SqlBaseClass, FeatureBaseClass):
     use_zodiac_scoring_for_best: Mapped[bool] = mapped_column(Boolean, default=True)
     highest_scoring_formula: Mapped[Optional[String]] = mapped_column(String, nullable=True)
 
-    combined_feature_id: Mapped[Optional[int]] = mapped_column(ForeignKey('features.id'))
+    combined_feature_id: Mapped[Optional[int]] = mapped_column(ForeignKey('features.id'), index=True)
     combined_feature: Mapped[Optional["FeatureCombined"]] = relationship(back_populates='sirius')
 
     def __init__(self, use_zodiac_scoring_for_best: bool = True, **kwargs):
@@ -223,6 +229,71 @@ class FeatureSirius(SqlBaseClass, FeatureBaseClass):
         return new
 
 
+def _first_by_score(df: pd.DataFrame, score: pd.Series | np.ndarray) -> pd.DataFrame:
+    """Row with the highest score per feature (first one for ties and if all scores are NaN)."""
+    return (
+        df.assign(_score=np.asarray(score, dtype=float))
+        .sort_values(['feature_id', '_score'], ascending=[True, False], na_position='last', kind='stable')
+        .drop_duplicates('feature_id')
+        .drop(columns='_score')
+        .set_index('feature_id')
+    )
+
+
+def flatten_highest_scoring(
+        tables: dict[str, pd.DataFrame],
+        use_zodiac_scoring_for_best: bool = True,
+        prefer_npc: bool = True
+) -> pd.DataFrame:
+    """
+    FeatureSirius.get_highest_scoring for all features at once. tables are the
+    renamed SIRIUS tables (formula_identifications, compound_identifications
+    and optionally canopus_formula_summary), one row per candidate. Returns a
+    wide DataFrame indexed by feature id, where attributes of the best formula
+    candidate take precedence over those of the best compound candidate,
+    which take precedence over the best compound group.
+    """
+    score = 'zodiac_score' if use_zodiac_scoring_for_best else 'sirius_score'
+
+    formulas = tables['formula_identifications']
+    best_formula = _first_by_score(formulas, formulas[score])
+    highest_scoring_formula = best_formula['formula_sirius'].rename('highest_scoring_formula')
+
+    def candidates_of_best_formula(df: pd.DataFrame) -> pd.DataFrame:
+        is_best = df['formula_sirius'].to_numpy() == highest_scoring_formula.reindex(df['feature_id']).to_numpy()
+        return df.loc[is_best, :]
+
+    out = pd.DataFrame(dict(
+        use_zodiac_scoring_for_best=use_zodiac_scoring_for_best,
+    ), index=best_formula.index).join(highest_scoring_formula)
+
+    parts: list[pd.DataFrame] = []
+    if 'canopus_formula_summary' in tables:
+        groups = candidates_of_best_formula(tables['canopus_formula_summary'])
+        prob_attrs = [a for a in CompoundGroup.__annotations__.keys()
+                      if a.endswith('probability') and not (a.startswith('npc') ^ prefer_npc)
+                      and a in groups.columns]
+        parts.append(_first_by_score(groups, groups[prob_attrs].max(axis=1)))
+
+    if 'compound_identifications' in tables:
+        compounds = candidates_of_best_formula(tables['compound_identifications'])
+        # confidence score if any candidate of the feature has one, sirius/zodiac score otherwise
+        has_confidence = (compounds['confidence_score'] > 0).groupby(compounds['feature_id']).transform('any')
+        parts.append(_first_by_score(compounds, compounds['confidence_score'].where(has_confidence, compounds[score])))
+
+    parts.append(best_formula)
+
+    # later parts override earlier ones (for features they have a row for)
+    for part in parts:
+        overlap = [c for c in part.columns if c in out.columns]
+        has_row = out.index.isin(part.index)
+        part_aligned = part.reindex(out.index)
+        for c in overlap:
+            out[c] = part_aligned[c].where(has_row, out[c])
+        out = out.join(part.drop(columns=overlap))
+    return out
+
+
 if __name__ == '__main__':
     pass
     f = FeatureSirius()
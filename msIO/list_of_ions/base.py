@@ -1,4 +1,5 @@
 import warnings
+from dataclasses import dataclass
 from typing import Self, Iterable, Optional, Union
 
 import numpy as np
@@ -21,12 +22,34 @@ class SpectrumType(PyEnum):
     mass_over_charge_fragments = "mass_over_charge_fragments"
 
 
+def parse_peak_lines(inpt: list[str], splitter=' ') -> tuple[list[float], list[float], list[str | None]]:
+    """m/z values, intensities and (quoted) annotations of the lines starting with a number."""
+    mzs = []
+    ints = []
+    comments = []
+    for line in inpt:
+        if not line[:1].isnumeric():
+            continue
+        # split of comment
+        if '"' in line:
+            peak, comment = line.split('"', 1)
+            comment = comment.rstrip('"\n')
+            comments.append(comment)
+        else:
+            peak = line
+            comments.append(None)
+        mz, i = peak.split(splitter)[:2]
+        mzs.append(float(mz))
+        ints.append(float(i))
+    return mzs, ints, comments
+
+
 class PeakFeature(SqlBaseClass, PeakBaseClass):
     __tablename__ = "peak"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
 
-    peak_list_id: Mapped[int] = mapped_column(ForeignKey("peak_list.id"))
+    peak_list_id: Mapped[int] = mapped_column(ForeignKey("peak_list.id"), index=True)
     peak_list: Mapped["PeakList"] = relationship(back_populates="peaks")  # every peak is part of a peak list
 
 
@@ -101,39 +124,35 @@ class PeakList(SqlBaseClass, FeatureBaseClass):
     def annotations(self) -> list[str]:
         return [p.annotation for p in self.peaks]
 
+    def merge(self, other: Self, tol_ppm: float = 5.) -> Self:
+        """
+        Sum of two spectra as a new peak list (neither is changed, the name
+        is kept): peaks within tol_ppm of the first peak of their cluster
+        become one peak at the intensity-weighted mean m/z, annotated as its
+        most intense annotated peak.
+        """
+        mzs = np.asarray(self.mzs + other.mzs, dtype=float)
+        intensities = np.asarray(self.intensities + other.intensities, dtype=float)
+        annotations = np.asarray(self.annotations + other.annotations, dtype=object)
+        o = np.argsort(mzs, kind='stable')
+        mzs, intensities, annotations = mzs[o], intensities[o], annotations[o]
+
+        is_start = _cluster_starts(mzs, tol_ppm)
+        clusters = np.cumsum(is_start) - 1
+        merged_mzs, merged_intensities = _centroid_clusters(mzs, intensities, clusters, is_start)
+        is_annotated = np.array([a is not None for a in annotations], dtype=bool)
+        most_intense = np.lexsort((-intensities, ~is_annotated, clusters))[np.flatnonzero(is_start)]
+        return self.__class__(
+            mzs=merged_mzs.tolist(), intensities=merged_intensities.tolist(),
+            annotations=annotations[most_intense].tolist(), name=self.name
+        )
+
     def __add__(self, other: Self) -> Self:
-        new_peaks = self.peaks.copy()
-        mzs = self.mzs
-        for p in other.peaks:
-            mz = p.mz
-            i = p.intensity
-            if mz not in mzs:
-                new_peaks.append(PeakFeature(mz=mz, intensity=0.))
-            idx = mzs.index(mz)
-            new_peaks[idx].intensity += i
-        return self.__class__(peaks=new_peaks)
+        return self.merge(other)
 
     @classmethod
     def from_lines(cls, inpt: list[str], splitter=' ', name: Optional[str] = None) -> Self:
-        lines_peaks = [l for l in inpt if l[0].isnumeric()]
-
-        mzs = []
-        ints = []
-        comments = []
-        for line in lines_peaks:
-            # split of comment
-            if '"' in line:
-                peak, comment = line.split('"', 1)
-                comment = comment.rstrip('"\n')
-                comments.append(comment)
-            else:
-                peak = line
-                comments.append(None)
-            mz, i = peak.split(splitter)[:2]
-            mzs.append(float(mz))
-            ints.append(float(i))
-
-
+        mzs, ints, comments = parse_peak_lines(inpt, splitter)
         return cls(mzs, ints, annotations=comments, name=name)
 
     def plot(self, ax: plt.Axes = None, as_mirror: bool=False, **kwargs_stem) -> plt.Axes:
@@ -152,6 +171,197 @@ class PeakList(SqlBaseClass, FeatureBaseClass):
         return ax
 
 
+def _cluster_starts(mzs: np.ndarray[float], tol_ppm: float, breaks: np.ndarray[bool] = None) -> np.ndarray[bool]:
+    """First peak of each cluster of sorted m/z, a cluster continues while
+    peaks are within tol_ppm of its first peak (and breaks is False)."""
+    is_start = np.ones(len(mzs), dtype=bool)
+    is_start[1:] = np.diff(mzs) > mzs[1:] * tol_ppm * 1e-6
+    if breaks is not None:
+        is_start |= breaks
+    # split runs of close neighbors that are wider than the tolerance, one
+    # split per run and round (at its first peak too far from the start)
+    positions = np.arange(len(mzs))
+    while True:
+        firsts = np.maximum.accumulate(np.where(is_start, positions, 0))
+        too_far = np.flatnonzero(mzs - mzs[firsts] > mzs[firsts] * tol_ppm * 1e-6)
+        if len(too_far) == 0:
+            return is_start
+        is_start[too_far[np.unique(firsts[too_far], return_index=True)[1]]] = True
+
+
+def _centroid_clusters(
+        mzs: np.ndarray[float],
+        intensities: np.ndarray[float],
+        clusters: np.ndarray[int],
+        is_start: np.ndarray[bool]
+) -> tuple[np.ndarray[float], np.ndarray[float]]:
+    """Intensity-weighted mean m/z (first m/z without intensity) and summed intensity of each cluster."""
+    n_clusters = int(is_start.sum())
+    summed = np.bincount(clusters, intensities, minlength=n_clusters)
+    weighted = np.bincount(clusters, mzs * intensities, minlength=n_clusters)
+    centroids = mzs[is_start].copy()
+    has_intensity = summed > 0
+    centroids[has_intensity] = weighted[has_intensity] / summed[has_intensity]
+    return centroids, summed
+
+
+@dataclass
+class SpectrumArrays:
+    """
+    Many spectra held as concatenated peak arrays. The peaks of spectrum i are
+    mzs[offsets[i]:offsets[i + 1]] (sorted by m/z) with the corresponding
+    intensities.
+    """
+    feature_ids: np.ndarray[int]
+    precursor_mzs: np.ndarray[float]
+    offsets: np.ndarray[int]
+    mzs: np.ndarray[float]
+    intensities: np.ndarray[float]
+
+    def __len__(self) -> int:
+        return len(self.feature_ids)
+
+    @property
+    def n_peaks(self) -> np.ndarray[int]:
+        return np.diff(self.offsets)
+
+    @property
+    def spectrum_index(self) -> np.ndarray[int]:
+        """Index of the spectrum each peak belongs to"""
+        return np.repeat(np.arange(len(self)), self.n_peaks)
+
+    def get(self, i: int) -> tuple[np.ndarray[float], np.ndarray[float]]:
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.mzs[start:end], self.intensities[start:end]
+
+    def to_peak_list(self, i: int) -> PeakList:
+        mzs, intensities = self.get(i)
+        return PeakList(mzs=mzs.tolist(), intensities=intensities.tolist())
+
+    @classmethod
+    def from_peaks(
+            cls,
+            feature_ids: Iterable[int],
+            precursor_mzs: Iterable[float],
+            spectrum_index: np.ndarray[int],
+            mzs: np.ndarray[float],
+            intensities: np.ndarray[float]
+    ) -> Self:
+        """Build from unordered peaks that know the index of their spectrum."""
+        feature_ids = np.asarray(feature_ids, dtype=np.int64)
+        spectrum_index = np.asarray(spectrum_index, dtype=np.int64)
+        mzs = np.asarray(mzs, dtype=float)
+        o = np.lexsort((mzs, spectrum_index))
+        counts = np.bincount(spectrum_index, minlength=len(feature_ids))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(
+            feature_ids=feature_ids,
+            precursor_mzs=np.asarray(precursor_mzs, dtype=float),
+            offsets=offsets,
+            mzs=mzs[o],
+            intensities=np.asarray(intensities, dtype=float)[o]
+        )
+
+    @classmethod
+    def from_peak_lists(
+            cls,
+            peak_lists: Iterable[PeakList | None],
+            feature_ids: Iterable[int] = None,
+            precursor_mzs: Iterable[float | None] = None
+    ) -> Self:
+        """Missing peak lists (None) become empty spectra."""
+        peak_lists = list(peak_lists)
+        n = len(peak_lists)
+        feature_ids = np.arange(n) if feature_ids is None else list(feature_ids)
+        precursor_mzs = np.full(n, np.nan) if precursor_mzs is None else \
+            [np.nan if mz is None else mz for mz in precursor_mzs]
+
+        mzs, intensities, spectrum_index = [], [], []
+        for i, pl in enumerate(peak_lists):
+            if pl is None:
+                continue
+            mzs.extend(pl.mzs)
+            intensities.extend(pl.intensities)
+            spectrum_index.extend([i] * len(pl.peaks))
+        return cls.from_peaks(
+            feature_ids, precursor_mzs, np.asarray(spectrum_index, dtype=np.int64),
+            np.asarray(mzs, dtype=float), np.asarray(intensities, dtype=float)
+        )
+
+    def subset(self, idcs: Iterable[int]) -> Self:
+        idcs = np.asarray(idcs, dtype=np.int64)
+        n_peaks = self.n_peaks[idcs]
+        starts = self.offsets[idcs]
+        peak_idcs = np.arange(n_peaks.sum()) - np.repeat(np.cumsum(n_peaks) - n_peaks, n_peaks) \
+            + np.repeat(starts, n_peaks)
+        return self.__class__(
+            feature_ids=self.feature_ids[idcs],
+            precursor_mzs=self.precursor_mzs[idcs],
+            offsets=np.concatenate([[0], np.cumsum(n_peaks)]).astype(np.int64),
+            mzs=self.mzs[peak_idcs],
+            intensities=self.intensities[peak_idcs]
+        )
+
+
+def consensus_arrays(
+        spectra: SpectrumArrays,
+        groups: Iterable[int] = None,
+        tol_ppm: float = 5.,
+        min_fraction: float = 0.5
+) -> SpectrumArrays:
+    """
+    One consensus spectrum per group of spectra (all spectra are one group if
+    groups is None), e.g. replicate injections or duplicate library entries.
+    Peaks of all spectra of a group are clustered in one pass (see
+    PeakList.merge), clusters found in less than min_fraction of the spectra
+    of the group are dropped. Intensities are averaged over the spectra of the
+    group, precursors over those that have one. The feature ids of the result
+    are the sorted group ids.
+    """
+    groups = np.zeros(len(spectra), dtype=np.int64) if groups is None else np.asarray(list(groups), dtype=np.int64)
+    assert len(groups) == len(spectra), 'need a group for every spectrum'
+    group_ids, group_of_spectrum = np.unique(groups, return_inverse=True)
+    n_groups = len(group_ids)
+    n_spectra_group = np.bincount(group_of_spectrum, minlength=n_groups)
+
+    spectrum_index = spectra.spectrum_index
+    o = np.lexsort((spectra.mzs, group_of_spectrum[spectrum_index]))
+    mzs, intensities, specs = spectra.mzs[o], spectra.intensities[o], spectrum_index[o]
+    groups_peaks = group_of_spectrum[specs]
+
+    is_start = _cluster_starts(mzs, tol_ppm, breaks=np.r_[True, groups_peaks[1:] != groups_peaks[:-1]])
+    clusters = np.cumsum(is_start) - 1
+    centroids, summed = _centroid_clusters(mzs, intensities, clusters, is_start)
+    # number of spectra with a peak in each cluster
+    n_spectra = np.bincount(np.unique(clusters * len(spectra) + specs) // len(spectra), minlength=len(centroids))
+    groups_clusters = groups_peaks[is_start]
+    keep = n_spectra >= min_fraction * n_spectra_group[groups_clusters]
+
+    has_precursor = ~np.isnan(spectra.precursor_mzs)
+    n_precursors = np.bincount(group_of_spectrum[has_precursor], minlength=n_groups)
+    with np.errstate(invalid='ignore'):
+        precursor_mzs = np.bincount(
+            group_of_spectrum[has_precursor], spectra.precursor_mzs[has_precursor], minlength=n_groups
+        ) / n_precursors
+    counts = np.bincount(groups_clusters[keep], minlength=n_groups)
+    return SpectrumArrays(
+        feature_ids=group_ids,
+        precursor_mzs=precursor_mzs,
+        offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        mzs=centroids[keep],
+        intensities=summed[keep] / n_spectra_group[groups_clusters[keep]]
+    )
+
+
+def consensus(spectra: Iterable[PeakList], tol_ppm: float = 5., min_fraction: float = 0.5) -> PeakList:
+    """Consensus spectrum of replicate spectra, see consensus_arrays (empty
+    without spectra)."""
+    spectra = list(spectra)
+    if len(spectra) == 0:
+        return PeakList(mzs=[], intensities=[])
+    return consensus_arrays(SpectrumArrays.from_peak_lists(spectra), None, tol_ppm, min_fraction).to_peak_list(0)
+
+
 class BaseLib:
     df_features: pd.DataFrame = None
     peak_list: list[PeakList] = None
@@ -1,9 +1,23 @@
 import json
+import logging
+import os
+import sys
+from collections.abc import Sequence
 from dataclasses import dataclass, field
-from typing import Any, Iterable, Literal
+from typing import Any, BinaryIO, Iterable, Iterator, Literal
 
+import numpy as np
+import pandas as pd
 
-@dataclass
+logger = logging.getLogger(__name__)
+
+
+def _intern(s: str | None) -> str | None:
+    """Names repeat across millions of entries, so share one string object."""
+    return sys.intern(s) if isinstance(s, str) else s
+
+
+@dataclass(slots=True)
 class Score:
     name: str
     value: float
@@ -12,28 +26,36 @@ class Score:
     @staticmethod
     def from_dict(d: dict[str, Any]) -> 'Score':
         return Score(
-            name=d.get("name"),
+            name=_intern(d.get("name")),
             value=float(d.get("value")) if d.get("value") is not None else None,
-            unit=d.get("unit")
+            unit=_intern(d.get("unit"))
         )
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Source:
+    """Immutable, so a single instance is shared per (tool, db) combination."""
     tool_name: str | None = None
     db_name: str | None = None
 
     @staticmethod
     def from_dict(d: dict[str, Any] | None) -> 'Source':
         if d is None:
-            return Source()
-        return Source(
-            tool_name=d.get("toolName"),
-            db_name=d.get("dbName")
-        )
+            return _get_source(None, None)
+        return _get_source(d.get("toolName"), d.get("dbName"))
 
 
-@dataclass
+_sources: dict[tuple[str | None, str | None], Source] = {}
+
+
+def _get_source(tool_name: str | None, db_name: str | None) -> Source:
+    key = (tool_name, db_name)
+    if (source := _sources.get(key)) is None:
+        source = _sources[key] = Source(tool_name=_intern(tool_name), db_name=_intern(db_name))
+    return source
+
+
+@dataclass(slots=True)
 class Annotation:
     name: str
     formula: str | None = None
@@ -44,13 +66,13 @@ class Annotation:
     def from_dict(d: dict[str, Any]) -> 'Annotation':
         return Annotation(
             name=d.get("name"),
-            formula=d.get("formula"),
+            formula=_intern(d.get("formula")),
             scores=[Score.from_dict(s) for s in d.get("scores", [])],
             source=Source.from_dict(d.get("source"))
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class Ion:
     mz: float
     rt_seconds: float
@@ -65,11 +87,11 @@ class Ion:
             rt_seconds=float(d.get("rt")),  # JSON uses "rt", we store as seconds
             mobility=float(d.get("mobility")) if d.get("mobility") is not None else None,
             ccs=float(d.get("ccs")) if d.get("ccs") is not None else None,
-            notation=d.get("notation")
+            notation=_intern(d.get("notation"))
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class MoleculeAnnotation:
     neutral_mass: float | None = None
     ions: list[Ion] = field(default_factory=list)
@@ -82,11 +104,11 @@ class MoleculeAnnotation:
             neutral_mass=float(d.get("neutralMass")) if d.get("neutralMass") is not None else None,
             ions=[Ion.from_dict(i) for i in d.get("ions", [])],
             annotations=[Annotation.from_dict(a) for a in d.get("annotations", [])],
-            flag_names=d.get("flagNames", [])
+            flag_names=[_intern(f) for f in d.get("flagNames", [])]
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class AnnotationMatch:
     molecule: MoleculeAnnotation
     ion: Ion
@@ -94,42 +116,277 @@ class AnnotationMatch:
     deltas: dict[str, float]  # keys: "mz_da", "mz_ppm", "rt_s", "ccs_A"
 
 
+@dataclass
+class IonArrays:
+    """Columnar index of all ions with m/z, RT and CCS, sorted by m/z."""
+    mz: np.ndarray[float]
+    rt_seconds: np.ndarray[float]
+    ccs: np.ndarray[float]
+    molecule_idcs: np.ndarray[int]  # index into molecule_annotations
+    ion_idcs: np.ndarray[int]  # index into molecule.ions
+    _orders: dict[str, np.ndarray[int]] = field(default_factory=dict, repr=False)
+
+    def __len__(self) -> int:
+        return len(self.mz)
+
+    @classmethod
+    def from_columns(cls, mz, rt_seconds, ccs, molecule_idcs, ion_idcs) -> 'IonArrays':
+        mz = np.asarray(mz, dtype=float)
+        o = np.argsort(mz, kind='stable')
+        return cls(
+            mz=mz[o],
+            rt_seconds=np.asarray(rt_seconds, dtype=float)[o],
+            ccs=np.asarray(ccs, dtype=float)[o],
+            molecule_idcs=np.asarray(molecule_idcs).astype(np.int64)[o],
+            ion_idcs=np.asarray(ion_idcs).astype(np.int64)[o],
+        )
+
+    def order(self, dim: Literal['rt_seconds', 'ccs']) -> np.ndarray[int]:
+        """Positions sorting the index by a secondary dimension."""
+        if dim not in self._orders:
+            self._orders[dim] = np.argsort(getattr(self, dim), kind='stable')
+        return self._orders[dim]
+
+
+def _window_pairs(
+        sorted_values: np.ndarray[float],
+        lower: np.ndarray[float],
+        upper: np.ndarray[float]
+) -> tuple[np.ndarray[int], np.ndarray[int]]:
+    """Flat (query index, position) pairs of all values in [lower, upper]."""
+    idcs_left = np.searchsorted(sorted_values, lower, side='left')
+    idcs_right = np.searchsorted(sorted_values, upper, side='right')
+    counts = np.maximum(idcs_right - idcs_left, 0)
+    query_idcs = np.repeat(np.arange(len(lower)), counts)
+    pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(idcs_left, counts)
+    return query_idcs, pos
+
+
+class _JsonStream:
+    """
+    Minimal incremental reader for a JSON document. The file is decoded as
+    latin-1 so that character positions are byte offsets into the file
+    (numbers and structure are ASCII, strings have to be re-decoded as UTF-8).
+    """
+    def __init__(self, f: BinaryIO, chunk_size: int = 1 << 22):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.offset = 0  # byte offset of buf[0]
+        self.pos = 0
+        self.eof = False
+
+    def _read(self) -> bool:
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # drop what has been consumed already
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + chunk.decode('latin-1')
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Next non-whitespace character (not consumed), empty at the end of the file."""
+        while True:
+            while (self.pos < len(self.buf)) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read():
+                return ''
+
+    def expect(self, chars: str) -> str:
+        c = self.peek()
+        if (c == '') or (c not in chars):
+            raise ValueError(f'expected one of {chars!r} at byte {self.offset + self.pos}, got {c!r}')
+        self.pos += 1
+        return c
+
+    def value(self) -> tuple[Any, int, int]:
+        """Decode the next value, returns it with its start and end byte offsets."""
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a value ending with the buffer may be incomplete (e.g. a number)
+                if (end < len(self.buf)) or self.eof:
+                    start, self.pos = self.offset + self.pos, end
+                    return obj, start, self.offset + end
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read()
+
+
+def _utf8(s: Any) -> Any:
+    """Undo latin-1 decoding of _JsonStream."""
+    return s.encode('latin-1').decode('utf-8') if isinstance(s, str) else s
+
+
+class LazyMoleculeAnnotations(Sequence):
+    """
+    Molecules of an .mca file, parsed from their byte range only when
+    accessed.
+    """
+    def __init__(self, path_mca: str, starts: np.ndarray[int], ends: np.ndarray[int]):
+        self.path_mca = path_mca
+        self._starts = starts
+        self._ends = ends
+        self._cache: dict[int, MoleculeAnnotation] = {}
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def _parse(self, f: BinaryIO, i: int) -> MoleculeAnnotation:
+        if (mol := self._cache.get(i)) is None:
+            f.seek(int(self._starts[i]))
+            mol = MoleculeAnnotation.from_dict(json.loads(f.read(int(self._ends[i] - self._starts[i]))))
+            self._cache[i] = mol
+        return mol
+
+    def get_many(self, idcs: Iterable[int]) -> list[MoleculeAnnotation]:
+        idcs = list(idcs)
+        out: dict[int, MoleculeAnnotation] = {i: self._cache[i] for i in idcs if i in self._cache}
+        missing = sorted(set(idcs) - out.keys())
+        if missing:
+            with open(self.path_mca, 'rb') as f:
+                for i in missing:
+                    out[i] = self._parse(f, i)
+        return [out[i] for i in idcs]
+
+    def __getitem__(self, i: int | slice) -> MoleculeAnnotation | list[MoleculeAnnotation]:
+        if isinstance(i, slice):
+            return self.get_many(range(*i.indices(len(self))))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.get_many([i])[0]
+
+    def __iter__(self) -> Iterator[MoleculeAnnotation]:
+        with open(self.path_mca, 'rb') as f:
+            for i in range(len(self)):
+                yield self._parse(f, i)
+
+
 class McaImportManager:
+    """
+    Molecule annotations are parsed on access, only the ion index (m/z, RT,
+    CCS) is built when loading. With use_cache=True the index is stored next
+    to the .mca file and reused as long as the file is unchanged.
+    """
     model_version: str | None = None
     title: str | None = None
     export_date: str | None = None
-    molecule_annotations: list[MoleculeAnnotation] = []
+    molecule_annotations: Sequence[MoleculeAnnotation] = []
 
-    def __init__(self, path_mca: str):
+    def __init__(self, path_mca: str, use_cache: bool = False):
         self.path_mca = path_mca
         self.model_version = None
         self.title = None
         self.export_date = None
         self.molecule_annotations = []
 
-        # Build a flat index of ions for fast scanning
-        self._ion_index: list[dict[str, Any]] = []
+        # columnar index of ions for fast matching
+        self._ion_arrays: IonArrays | None = None
 
-        self._load()
+        self._load(use_cache=use_cache)
 
-    def _load(self):
-        with open(self.path_mca, "r", encoding="utf-8") as f:
-            data = json.load(f)
+    @property
+    def _path_cache(self) -> str:
+        return f'{self.path_mca}.index.npz'
 
-        self.model_version = data.get("modelVersion")
-        self.title = data.get("title")
-        self.export_date = data.get("exportDate")
-        self.molecule_annotations = [
-            MoleculeAnnotation.from_dict(ma) for ma in data.get("moleculeAnnotations", [])
-        ]
+    def _file_signature(self) -> np.ndarray[int]:
+        st = os.stat(self.path_mca)
+        return np.asarray([st.st_mtime_ns, st.st_size], dtype=np.int64)
 
-        # Build a flat index (list of dicts pointing to MoleculeAnnotation and Ion)
-        for mol in self.molecule_annotations:
-            for ion in mol.ions:
-                self._ion_index.append({
-                    "molecule": mol,
-                    "ion": ion
-                })
+    def _load(self, use_cache: bool = False):
+        data = self._load_cache() if use_cache else None
+        if data is None:
+            data = self._parse()
+            if use_cache:
+                self._save_cache(data)
+
+        header = json.loads(str(data['header']))
+        self.model_version = header.get("modelVersion")
+        self.title = header.get("title")
+        self.export_date = header.get("exportDate")
+        self.molecule_annotations = LazyMoleculeAnnotations(
+            self.path_mca, data['molecule_starts'], data['molecule_ends']
+        )
+        self._ion_arrays = IonArrays.from_columns(
+            data['mz'], data['rt_seconds'], data['ccs'], data['molecule_idcs'], data['ion_idcs']
+        )
+
+    def _parse(self, chunk_size: int = 1 << 22) -> dict[str, np.ndarray]:
+        """Stream through the file, recording ions and byte ranges of molecules."""
+        header: dict[str, Any] = {}
+        ion_rows: list[tuple[float, float, float, int, int]] = []
+        starts: list[int] = []
+        ends: list[int] = []
+
+        with open(self.path_mca, 'rb') as f:
+            stream = _JsonStream(f, chunk_size=chunk_size)
+            if stream.peek() == '\xef' and stream.buf.startswith('\xef\xbb\xbf'):
+                stream.pos += 3  # byte order mark
+            stream.expect('{')
+            while stream.peek() != '}':
+                key, _, _ = stream.value()
+                stream.expect(':')
+                if key != 'moleculeAnnotations':
+                    value, _, _ = stream.value()
+                    # only keep scalar metadata (title, dates, versions)
+                    header[key] = _utf8(value) if isinstance(value, str | int | float | bool) else None
+                else:
+                    stream.expect('[')
+                    while stream.peek() != ']':
+                        d, start, end = stream.value()
+                        i_mol = len(starts)
+                        starts.append(start)
+                        ends.append(end)
+                        for i_ion, ion in enumerate(d.get("ions", [])):
+                            mz, rt, ccs = ion.get("mz"), ion.get("rt"), ion.get("ccs")
+                            # ions without all three dimensions can not be matched
+                            if (mz is not None) and (rt is not None) and (ccs is not None):
+                                ion_rows.append((float(mz), float(rt), float(ccs), i_mol, i_ion))
+                        if stream.expect(',]') == ']':
+                            break
+                    else:
+                        stream.expect(']')
+                if stream.expect(',}') == '}':
+                    break
+            else:
+                stream.expect('}')
+
+        ion_rows = np.asarray(ion_rows, dtype=float).reshape(-1, 5)
+        return dict(
+            header=np.asarray(json.dumps(header)),
+            mz=ion_rows[:, 0],
+            rt_seconds=ion_rows[:, 1],
+            ccs=ion_rows[:, 2],
+            molecule_idcs=ion_rows[:, 3].astype(np.int64),
+            ion_idcs=ion_rows[:, 4].astype(np.int64),
+            molecule_starts=np.asarray(starts, dtype=np.int64),
+            molecule_ends=np.asarray(ends, dtype=np.int64),
+        )
+
+    def _load_cache(self) -> dict[str, np.ndarray] | None:
+        if not os.path.exists(self._path_cache):
+            return None
+        with np.load(self._path_cache, allow_pickle=False) as data:
+            if not np.array_equal(data['file_signature'], self._file_signature()):
+                logger.info(f'{self._path_cache} is outdated, parsing {self.path_mca}')
+                return None
+            return {k: data[k] for k in data.files if k != 'file_signature'}
+
+    def _save_cache(self, data: dict[str, np.ndarray]) -> None:
+        try:
+            np.savez(self._path_cache, file_signature=self._file_signature(), **data)
+        except OSError as e:
+            logger.warning(f'could not write index cache {self._path_cache}: {e}')
 
     @staticmethod
     def _ppm(delta_da: float, ref_mz: float) -> float:
@@ -137,6 +394,166 @@ class McaImportManager:
             return float("inf")
         return abs(delta_da) * 1e6 / ref_mz
 
+    def _match_arrays(
+        self,
+        mzs: np.ndarray[float],
+        rts_seconds: np.ndarray[float],
+        ccss: np.ndarray[float],
+        mz_tol_ppm: float | None,
+        mz_tol_da: float | None,
+        rt_tol_seconds: float,
+        ccs_tol_A: float,
+        require_all_within_tolerance: bool,
+        sort_by: Literal["ppm", "rt", "ccs", "combined"],
+    ) -> dict[str, np.ndarray]:
+        """
+        All matches of all queries as flat arrays (query index, position in
+        the ion index and the deltas), sorted by query and then by sort_by.
+        """
+        ions = self._ion_arrays
+        if mz_tol_da is None:
+            mz_tol_ppm = mz_tol_ppm if mz_tol_ppm is not None else 10.0
+            dmz_window = np.abs(mzs) * mz_tol_ppm * 1e-6
+        else:
+            dmz_window = np.full(len(mzs), mz_tol_da)
+        # widen windows slightly, the exact criterion is applied below
+        dmz_window = dmz_window * (1 + 1e-9) + 1e-12
+
+        query_idcs, pos = _window_pairs(ions.mz, mzs - dmz_window, mzs + dmz_window)
+        if not require_all_within_tolerance:
+            # any dimension suffices, so collect candidates of every dimension
+            all_query_idcs, all_pos = [query_idcs], [pos]
+            for dim, centers, tol in (('rt_seconds', rts_seconds, rt_tol_seconds), ('ccs', ccss, ccs_tol_A)):
+                order = ions.order(dim)
+                tol = tol * (1 + 1e-9) + 1e-12
+                q, p = _window_pairs(getattr(ions, dim)[order], centers - tol, centers + tol)
+                all_query_idcs.append(q)
+                all_pos.append(order[p])
+            pairs = np.unique(
+                np.concatenate(all_query_idcs) * len(ions) + np.concatenate(all_pos)
+            )
+            query_idcs, pos = pairs // max(len(ions), 1), pairs % max(len(ions), 1)
+
+        dmz_da = ions.mz[pos] - mzs[query_idcs]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dmz_ppm = np.where(mzs[query_idcs] == 0, np.inf, np.abs(dmz_da) * 1e6 / mzs[query_idcs])
+        drt_s = np.abs(ions.rt_seconds[pos] - rts_seconds[query_idcs])
+        dccs_A = np.abs(ions.ccs[pos] - ccss[query_idcs])
+
+        if mz_tol_da is not None:
+            in_mz = np.abs(dmz_da) <= mz_tol_da
+        else:
+            in_mz = dmz_ppm <= mz_tol_ppm
+        in_rt = drt_s <= rt_tol_seconds
+        in_ccs = dccs_A <= ccs_tol_A
+        keep = (in_mz & in_rt & in_ccs) if require_all_within_tolerance else (in_mz | in_rt | in_ccs)
+
+        if sort_by == "ppm":
+            key = dmz_ppm
+        elif sort_by == "rt":
+            key = drt_s
+        elif sort_by == "ccs":
+            key = dccs_A
+        else:
+            # combined: simple weighted sum, gives priority to ppm then RT then CCS
+            key = dmz_ppm + drt_s / max(rt_tol_seconds, 1e-9) + dccs_A / max(ccs_tol_A, 1e-9)
+
+        # stable with respect to the order of ions in the file
+        file_order = ions.molecule_idcs * (ions.ion_idcs.max(initial=0) + 1) + ions.ion_idcs
+        keep = np.flatnonzero(keep)
+        o = keep[np.lexsort((file_order[pos[keep]], key[keep], query_idcs[keep]))]
+        return dict(
+            query_idcs=query_idcs[o],
+            pos=pos[o],
+            mz_da=dmz_da[o],
+            mz_ppm=dmz_ppm[o],
+            rt_s=drt_s[o],
+            ccs_A=dccs_A[o],
+        )
+
+    def _to_annotation_match(self, pos: int, deltas: dict[str, float]) -> AnnotationMatch:
+        mol = self.molecule_annotations[int(self._ion_arrays.molecule_idcs[pos])]
+        return AnnotationMatch(
+            molecule=mol,
+            ion=mol.ions[int(self._ion_arrays.ion_idcs[pos])],
+            annotations=mol.annotations,
+            deltas=deltas
+        )
+
+    def find_annotations_table(
+        self,
+        mzs: Iterable[float],
+        rts_seconds: Iterable[float],
+        ccss: Iterable[float],
+        mz_tol_ppm: float | None = 10.0,
+        mz_tol_da: float | None = None,
+        rt_tol_seconds: float = 5.0,
+        ccs_tol_A: float = 1.0,
+        require_all_within_tolerance: bool = True,
+        sort_by: Literal["ppm", "rt", "ccs", "combined"] = "combined",
+    ) -> pd.DataFrame:
+        """
+        Same as find_annotations_many, but returns all matches as one flat
+        table (sorted by query and sort_by) referencing the molecule and ion
+        by index, so no molecule has to be parsed.
+        """
+        mzs = np.asarray(list(mzs), dtype=float)
+        rts_seconds = np.asarray(list(rts_seconds), dtype=float)
+        ccss = np.asarray(list(ccss), dtype=float)
+        assert len(mzs) == len(rts_seconds) == len(ccss), 'need mz, rt and ccs for every feature'
+
+        res = self._match_arrays(
+            mzs, rts_seconds, ccss, mz_tol_ppm, mz_tol_da, rt_tol_seconds, ccs_tol_A,
+            require_all_within_tolerance, sort_by
+        )
+        pos = res.pop('pos')
+        return pd.DataFrame(dict(
+            query_index=res.pop('query_idcs'),
+            molecule_index=self._ion_arrays.molecule_idcs[pos],
+            ion_index=self._ion_arrays.ion_idcs[pos],
+            **res
+        ))
+
+    def find_annotations_many(
+        self,
+        mzs: Iterable[float],
+        rts_seconds: Iterable[float],
+        ccss: Iterable[float],
+        mz_tol_ppm: float | None = 10.0,
+        mz_tol_da: float | None = None,
+        rt_tol_seconds: float = 5.0,
+        ccs_tol_A: float = 1.0,
+        require_all_within_tolerance: bool = True,
+        sort_by: Literal["ppm", "rt", "ccs", "combined"] = "combined",
+        require_unique_match: bool = False
+    ) -> list[list[AnnotationMatch]] | list[AnnotationMatch]:
+        """
+        Same as find_annotations for many features at once, returns one list
+        of matches per feature (or one match per feature if
+        require_unique_match).
+        """
+        mzs = np.asarray(list(mzs), dtype=float)
+        rts_seconds = np.asarray(list(rts_seconds), dtype=float)
+        ccss = np.asarray(list(ccss), dtype=float)
+        assert len(mzs) == len(rts_seconds) == len(ccss), 'need mz, rt and ccs for every feature'
+
+        res = self._match_arrays(
+            mzs, rts_seconds, ccss, mz_tol_ppm, mz_tol_da, rt_tol_seconds, ccs_tol_A,
+            require_all_within_tolerance, sort_by
+        )
+        delta_keys = ("mz_da", "mz_ppm", "rt_s", "ccs_A")
+        deltas = zip(*(res[k].tolist() for k in delta_keys))
+
+        matches: list[list[AnnotationMatch]] = [[] for _ in range(len(mzs))]
+        for query_idx, pos, d in zip(res['query_idcs'].tolist(), res['pos'].tolist(), deltas):
+            matches[query_idx].append(self._to_annotation_match(pos, dict(zip(delta_keys, d))))
+
+        if require_unique_match:
+            assert all(len(m) == 1 for m in matches), \
+                "Multiple matches found, even though one is required. Consider lowering the tolerances."
+            return [m[0] for m in matches]
+        return matches
+
     def find_annotations(
         self,
         mz: float,
@@ -167,70 +584,16 @@ class McaImportManager:
         Returns:
         - A list of AnnotationMatch objects.
         """
-        matches: list[AnnotationMatch] = []
-
-        for rec in self._ion_index:
-            ion: Ion = rec["ion"]
-            mol: MoleculeAnnotation = rec["molecule"]
-
-            if ion.mz is None or ion.rt_seconds is None or ion.ccs is None:
-                continue
-
-            dmz_da = ion.mz - mz
-            dmz_abs_da = abs(dmz_da)
-            dmz_ppm = self._ppm(dmz_da, mz)
-
-            drt_s = abs(ion.rt_seconds - rt_seconds)
-            dccs_A = abs(ion.ccs - ccs)
-
-            # Check tolerances
-            if mz_tol_da is not None:
-                in_mz = dmz_abs_da <= mz_tol_da
-            else:
-                in_mz = dmz_ppm <= (mz_tol_ppm if mz_tol_ppm is not None else 10.0)
-
-            in_rt = drt_s <= rt_tol_seconds
-            in_ccs = dccs_A <= ccs_tol_A
-
-            if require_all_within_tolerance:
-                if not (in_mz and in_rt and in_ccs):
-                    continue
-            else:
-                if not (in_mz or in_rt or in_ccs):
-                    continue
-
-            matches.append(AnnotationMatch(
-                molecule=mol,
-                ion=ion,
-                annotations=mol.annotations,
-                deltas={
-                    "mz_da": dmz_da,
-                    "mz_ppm": dmz_ppm,
-                    "rt_s": drt_s,
-                    "ccs_A": dccs_A
-                }
-            ))
-
-        if require_unique_match:
-            assert len(matches) == 1, \
-                "Multiple matches found, even though one is required. Consider lowering the tolerances."
-            return matches[0]
-
-        # Sorting
-        if sort_by == "ppm":
-            matches.sort(key=lambda m: abs(m.deltas["mz_ppm"]))
-        elif sort_by == "rt":
-            matches.sort(key=lambda m: abs(m.deltas["rt_s"]))
-        elif sort_by == "ccs":
-            matches.sort(key=lambda m: abs(m.deltas["ccs_A"]))
-        else:
-            # combined: simple weighted sum, gives priority to ppm then RT then CCS
-            def combined_key(m: AnnotationMatch) -> float:
-                # Normalize ppm and rt, ccs loosely
-                return abs(m.deltas["mz_ppm"]) + (m.deltas["rt_s"] / max(rt_tol_seconds, 1e-9)) + (m.deltas["ccs_A"] / max(ccs_tol_A, 1e-9))
-            matches.sort(key=combined_key)
-
-        return matches
+        return self.find_annotations_many(
+            [mz], [rt_seconds], [ccs],
+            mz_tol_ppm=mz_tol_ppm,
+            mz_tol_da=mz_tol_da,
+            rt_tol_seconds=rt_tol_seconds,
+            ccs_tol_A=ccs_tol_A,
+            require_all_within_tolerance=require_all_within_tolerance,
+            sort_by=sort_by,
+            require_unique_match=require_unique_match
+        )[0]
 
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ Read mgf (Mascot Generic Format) files
 https://www.matrixscience.com/help/data_file_help.html
 """
 from dataclasses import dataclass
+from functools import cached_property
 from typing import Literal, Self, Iterable
 
 import numpy as np
@@ -12,7 +13,7 @@ from matplotlib import pyplot as plt
 from tqdm import tqdm
 
 from msIO.feature_managers.base import FeatureManager
-from msIO.features.mgf import parse_ion_props, FeatureMgf, MsSpec
+from msIO.features.mgf import parse_ion_props, FeatureMgf, MsSpec, select_preferred_ions, PREFERRED_ION_PROPS
 from msIO.list_of_ions.base import BaseLib, PeakList
 
 
@@ -77,30 +78,69 @@ class MgfImportManager(BaseLib, FeatureManager):
             self.peak_list)
         )
 
+    @cached_property
+    def preferred_ions(self) -> pd.DataFrame:
+        """Preferred spectrum of every feature, see select_preferred_ions"""
+        return select_preferred_ions(self.df_features)
+
+    @cached_property
+    def _rows_by_feature(self) -> dict[int, np.ndarray[int]]:
+        return self.df_features.groupby('feature_id', sort=False).indices
+
+    @cached_property
+    def _records(self) -> list[dict]:
+        return self.df_features.to_dict('records')
+
+    @cached_property
+    def _preferred_by_feature(self) -> dict[int, tuple[int, str, bool]]:
+        pref = self.preferred_ions
+        return dict(zip(
+            pref.index.tolist(),
+            zip(pref.row.tolist(), pref.ion.tolist(), pref.has_multiple_adducts.tolist())
+        ))
+
+    def get_table(self) -> pd.DataFrame:
+        """Properties of the preferred ion of every feature, indexed by feature id."""
+        pref = self.preferred_ions
+        columns = [c for c in PREFERRED_ION_PROPS if c in self.df_features.columns]
+        df = self.df_features.iloc[pref.row.to_numpy()].loc[:, columns].set_index(pref.index)
+        df['has_multiple_adducts'] = pref.has_multiple_adducts
+        if 'polarity' in self.df_features.columns:
+            df['polarity'] = self.df_features.groupby('feature_id', sort=False)['polarity'].first()
+        return df
+
     def _inner_missing_feature(self, f_id) -> None:
         # get properties from dataframe
-        mask_id = self.df_features.feature_id == f_id
-        if mask_id.sum() == 0:
+        rows = self._rows_by_feature.get(f_id)
+        if rows is None:
             return
-        df_sub = self.df_features.loc[mask_id, :]
 
         ms_specs: list[MsSpec] = []
-        for idx, row in df_sub.iterrows():
+        for row in rows:
+            props = self._records[row].copy()
             # create keys to check for which ones we have MS spectra
-            key = row.feature_id, row.ms_level, row.ion
+            key = props['feature_id'], props['ms_level'], props['ion']
             if key not in self._peak_dict:
                 continue
             peaks = self._peak_dict[key]
-            props = row.to_dict()
             props.pop('polarity')
             props.pop('feature_id')
             ms_specs.append(MsSpec(peaks=peaks, **props))
 
         f = FeatureMgf(
             feature_id=f_id,
-            polarity=df_sub.polarity.iat[0],
+            polarity=self._records[rows[0]]['polarity'],
             ms_specs=ms_specs
         )
+
+        # preferred ion is selected for all features at once
+        row_pref, ion_pref, has_multiple_adducts = self._preferred_by_feature[f_id]
+        f.has_multiple_adducts = has_multiple_adducts
+        f._set_preferred(
+            ms_specs[int(np.searchsorted(rows, row_pref))],
+            ms1=self._peak_dict.get((f_id, 1, ion_pref)),
+            ms2=self._peak_dict.get((f_id, 2, ion_pref)),
+        )
         self._features[f_id] = f
 
     def get_ms2(
@@ -80,6 +80,23 @@ def _parse_lines(lines: list[str]) -> dict[str, str | int | float]:
     return e
 
 
+def detect_peak_splitter(lines: list[str]) -> str | None:
+    """Separator of m/z and intensity in the first peak line (None if there are no peaks)."""
+    lines_peaks = [l for l in lines if l[:1].isnumeric()]
+    if len(lines_peaks) == 0:
+        return None
+    if '\t' in lines_peaks[0]:
+        return '\t'
+    elif ',' in lines_peaks[0]:
+        return ','
+    elif ' ' in lines_peaks[0]:
+        return ' '
+    raise ValueError(
+        f'Unable to determine splitter from line '
+        f'{lines_peaks[0]}, please specify manually'
+    )
+
+
 class MSPReader(BaseLib):
     splitter_peaks_list: str = None
     path_file: str = None
@@ -113,22 +130,7 @@ class MSPReader(BaseLib):
     def _process_lines(self, lines: list[str]) -> tuple[dict, PeakList]:
         # determine splitter for peaks
         if self.splitter_peaks_list is None:
-            # determine from last line
-            lines_peaks = [l for l in lines if l[0].isnumeric()]
-            if len(lines_peaks) == 0:
-                self.splitter_peaks_list = None
-            else:
-                if '\t' in lines_peaks[0]:
-                    self.splitter_peaks_list = '\t'
-                elif ',' in lines_peaks[0]:
-                    self.splitter_peaks_list = ','
-                elif ' ' in lines_peaks[0]:
-                    self.splitter_peaks_list = ' '
-                else:
-                    raise ValueError(
-                        f'Unable to determine splitter from line '
-                        f'{lines_peaks[0]}, please specify manually'
-                    )
+            self.splitter_peaks_list = detect_peak_splitter(lines)
         entries = _parse_lines(lines)
         peak_list = PeakList.from_lines(lines, splitter=self.splitter_peaks_list)
         return entries, peak_list
@@ -1,6 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterable
+
 import numpy as np
 
 from msIO import PeakList
+from msIO.list_of_ions.base import SpectrumArrays
 
 
 def cosine_similarity_forward(ref: PeakList, meas: PeakList, max_dmz_da: float, return_nhits: bool = False) -> tuple[float] | tuple[float, int]:
@@ -45,9 +50,461 @@ def cosine_similarity_sym(a, b, max_dmz_da, return_nhits: bool = False) -> tuple
     return score,
 
 
+def _match_peaks(
+        a: SpectrumArrays,
+        b: SpectrumArrays,
+        max_dmz_da: float,
+        shifts: np.ndarray[float] = None
+) -> tuple[np.ndarray[int], np.ndarray[int]]:
+    """
+    Every pair of peaks of a[i] and b[i] within the tolerance, the m/z of b[i]
+    shifted by shifts[i] if given (NaN shifts give no pairs). Returns the peak
+    indices into a and b.
+    """
+    n = len(a)
+    spec_a, spec_b = a.spectrum_index, b.spectrum_index
+    mzs_b = b.mzs if shifts is None else b.mzs + shifts[spec_b]
+    max_shift = 0 if shifts is None else np.abs(shifts[~np.isnan(shifts)]).max(initial=0)
+    # offset the m/z of each pair such that all peaks can be searched at once
+    span = max(a.mzs.max(initial=0), b.mzs.max(initial=0)) + max_shift + 2 * max_dmz_da + 1
+    keys_a = spec_a * span + a.mzs
+    is_valid = ~np.isnan(mzs_b)
+    keys_b = spec_b[is_valid] * span + mzs_b[is_valid]
+    # widen the windows by the rounding error of the offsets, the tolerance is checked on the m/z below
+    slack = 4 * np.spacing(n * span)
+    lo = np.searchsorted(keys_a, keys_b - max_dmz_da - slack, side='right')
+    hi = np.searchsorted(keys_a, keys_b + max_dmz_da + slack, side='left')
+
+    counts = hi - lo
+    peaks_b = np.repeat(np.flatnonzero(is_valid), counts)
+    peaks_a = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    is_hit = (spec_a[peaks_a] == spec_b[peaks_b]) & (np.abs(mzs_b[peaks_b] - a.mzs[peaks_a]) < max_dmz_da)
+    return peaks_a[is_hit], peaks_b[is_hit]
+
+
+def _cosine_hits(a: SpectrumArrays, b: SpectrumArrays, max_dmz_da: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Cosine score of the spectra a[i] and b[i] and the number of peaks of
+    a and b with a match (every pair of peaks within the tolerance counts)."""
+    n = len(a)
+    spec_a, spec_b = a.spectrum_index, b.spectrum_index
+    norm_a = np.sqrt(np.bincount(spec_a, a.intensities ** 2, minlength=n))
+    norm_b = np.sqrt(np.bincount(spec_b, b.intensities ** 2, minlength=n))
+
+    peaks_a, peaks_b = _match_peaks(a, b, max_dmz_da)
+    products = np.bincount(spec_b[peaks_b], b.intensities[peaks_b] * a.intensities[peaks_a], minlength=n)
+    hits_b = np.bincount(spec_b[np.unique(peaks_b)], minlength=n)
+    hits_a = np.bincount(spec_a[np.unique(peaks_a)], minlength=n)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.minimum(1., products / (norm_a * norm_b))
+    scores[(norm_a == 0) | (norm_b == 0)] = np.nan
+    return scores, hits_a, hits_b
+
+
+def _cosine_pairs(a: SpectrumArrays, b: SpectrumArrays, max_dmz_da: float) -> tuple[np.ndarray, np.ndarray]:
+    """Cosine score and hits of the spectra a[i] and b[i] (as cosine_similarity_sym)."""
+    scores, hits_a, hits_b = _cosine_hits(a, b, max_dmz_da)
+    return scores, np.minimum(hits_a, hits_b)
+
+
+def _cosine_forward_pairs(a: SpectrumArrays, b: SpectrumArrays, max_dmz_da: float) -> tuple[np.ndarray, np.ndarray]:
+    """As cosine_similarity_forward: hits are the peaks of b found in a."""
+    scores, _, hits_b = _cosine_hits(a, b, max_dmz_da)
+    return scores, hits_b
+
+
+def _cosine_backward_pairs(a: SpectrumArrays, b: SpectrumArrays, max_dmz_da: float) -> tuple[np.ndarray, np.ndarray]:
+    scores, hits_a, _ = _cosine_hits(a, b, max_dmz_da)
+    return scores, hits_a
+
+
+def _greedy_assignment(peaks_a: np.ndarray[int], peaks_b: np.ndarray[int], products: np.ndarray[float]) -> np.ndarray[bool]:
+    """
+    One-to-one assignment of matching peaks, picking the pairs in the order of
+    decreasing products (ties by peak index). Instead of walking through the
+    pairs one by one, all pairs that are the best remaining one of both their
+    peaks are accepted in each round, which gives the same assignment.
+    """
+    order = np.lexsort((peaks_b, peaks_a, -products))
+    pa, pb = peaks_a[order], peaks_b[order]
+    used_a = np.zeros(pa.max(initial=-1) + 1, dtype=bool)
+    used_b = np.zeros(pb.max(initial=-1) + 1, dtype=bool)
+    accepted = np.zeros(len(order), dtype=bool)
+    alive = np.flatnonzero(np.ones(len(order), dtype=bool))
+    while len(alive) > 0:
+        # first (best) remaining pair of each peak
+        is_best_a = np.zeros(len(alive), dtype=bool)
+        is_best_a[np.unique(pa[alive], return_index=True)[1]] = True
+        is_best_b = np.zeros(len(alive), dtype=bool)
+        is_best_b[np.unique(pb[alive], return_index=True)[1]] = True
+        new = alive[is_best_a & is_best_b]
+        accepted[new] = True
+        used_a[pa[new]] = True
+        used_b[pb[new]] = True
+        alive = alive[~(used_a[pa[alive]] | used_b[pb[alive]])]
+
+    mask = np.zeros(len(order), dtype=bool)
+    mask[order[accepted]] = True
+    return mask
+
+
+def _assigned_peaks(
+        a: SpectrumArrays,
+        b: SpectrumArrays,
+        max_dmz_da: float,
+        intensities_a: np.ndarray[float],
+        intensities_b: np.ndarray[float],
+        shifted: bool = False
+) -> tuple[np.ndarray[int], np.ndarray[int]]:
+    """Matching peaks of a[i] and b[i] assigned one-to-one by the product of
+    the given intensities, with shifted=True peaks of b also match shifted by
+    the precursor difference."""
+    peaks_a, peaks_b = _match_peaks(a, b, max_dmz_da)
+    if shifted:
+        peaks_a_shifted, peaks_b_shifted = _match_peaks(a, b, max_dmz_da, a.precursor_mzs - b.precursor_mzs)
+        # a pair of peaks can match both ways if the precursors are close
+        pairs = np.unique(np.column_stack([
+            np.concatenate([peaks_a, peaks_a_shifted]), np.concatenate([peaks_b, peaks_b_shifted])
+        ]).reshape(-1, 2), axis=0)
+        peaks_a, peaks_b = pairs[:, 0], pairs[:, 1]
+    is_assigned = _greedy_assignment(peaks_a, peaks_b, intensities_a[peaks_a] * intensities_b[peaks_b])
+    return peaks_a[is_assigned], peaks_b[is_assigned]
+
+
+def _modified_cosine_pairs(a: SpectrumArrays, b: SpectrumArrays, max_dmz_da: float) -> tuple[np.ndarray, np.ndarray]:
+    """Modified cosine score and matched peaks of the spectra a[i] and b[i]."""
+    n = len(a)
+    spec_a, spec_b = a.spectrum_index, b.spectrum_index
+    norm_a = np.sqrt(np.bincount(spec_a, a.intensities ** 2, minlength=n))
+    norm_b = np.sqrt(np.bincount(spec_b, b.intensities ** 2, minlength=n))
+
+    peaks_a, peaks_b = _assigned_peaks(a, b, max_dmz_da, a.intensities, b.intensities, shifted=True)
+    scores = np.bincount(spec_a[peaks_a], a.intensities[peaks_a] * b.intensities[peaks_b], minlength=n)
+    n_matches = np.bincount(spec_a[peaks_a], minlength=n)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.minimum(1., scores / (norm_a * norm_b))
+    scores[(norm_a == 0) | (norm_b == 0)] = np.nan
+    return scores, n_matches
+
+
+def _xlogx(x: np.ndarray[float]) -> np.ndarray[float]:
+    """x * ln(x) with 0 for x = 0."""
+    return x * np.log(np.where(x > 0, x, 1.))
+
+
+def _entropy_weighted_intensities(spectra: SpectrumArrays) -> np.ndarray[float]:
+    """
+    Intensities normalized to a sum of 1 per spectrum. Spectra with a spectral
+    entropy below 3 get their intensities raised to 0.25 + 0.25 * entropy
+    (and normalized again), which gives low intensity peaks more weight.
+    """
+    n = len(spectra)
+    spectrum_index = spectra.spectrum_index
+
+    def normalize(values: np.ndarray[float]) -> np.ndarray[float]:
+        totals = np.bincount(spectrum_index, values, minlength=n)
+        totals[totals == 0] = 1.
+        return values / totals[spectrum_index]
+
+    p = normalize(np.clip(spectra.intensities, 0, None))
+    entropies = -np.bincount(spectrum_index, _xlogx(p), minlength=n)
+    weights = np.where(entropies < 3, 0.25 + 0.25 * entropies, 1.)
+    return normalize(p ** weights[spectrum_index])
+
+
+def _entropy_pairs(a: SpectrumArrays, b: SpectrumArrays, max_dmz_da: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Weighted entropy similarity of the spectra a[i] and b[i],
+    1 - (2 S(a + b) - S(a) - S(b)) / ln(4) with the entropies S of the weighted
+    spectra and their merge. Unmatched peaks cancel out, so only the matched
+    peaks (one-to-one) are summed.
+    """
+    n = len(a)
+    ints_a, ints_b = _entropy_weighted_intensities(a), _entropy_weighted_intensities(b)
+    peaks_a, peaks_b = _assigned_peaks(a, b, max_dmz_da, ints_a, ints_b)
+
+    pa, pb = ints_a[peaks_a], ints_b[peaks_b]
+    spec_pairs = a.spectrum_index[peaks_a]
+    scores = np.bincount(spec_pairs, _xlogx(pa + pb) - _xlogx(pa) - _xlogx(pb), minlength=n) / np.log(4)
+    scores = np.minimum(1., scores)
+    scores[(a.n_peaks == 0) | (b.n_peaks == 0)] = np.nan
+    return scores, np.bincount(spec_pairs, minlength=n)
+
+
+def _neutral_losses(spectra: SpectrumArrays) -> SpectrumArrays:
+    """Spectra of the neutral losses (precursor minus fragment), peaks at or
+    above the precursor and spectra without a precursor are left out."""
+    spectrum_index = spectra.spectrum_index
+    losses = spectra.precursor_mzs[spectrum_index] - spectra.mzs
+    keep = losses > 0  # False for NaN
+    return SpectrumArrays.from_peaks(
+        feature_ids=spectra.feature_ids,
+        precursor_mzs=spectra.precursor_mzs,
+        spectrum_index=spectrum_index[keep],
+        mzs=losses[keep],
+        intensities=spectra.intensities[keep]
+    )
+
+
+def _neutral_loss_cosine_pairs(a: SpectrumArrays, b: SpectrumArrays, max_dmz_da: float) -> tuple[np.ndarray, np.ndarray]:
+    """Cosine score and hits of the neutral loss spectra of a[i] and b[i]."""
+    return _cosine_pairs(_neutral_losses(a), _neutral_losses(b), max_dmz_da)
+
+
+def _matched_intensity_pairs(a: SpectrumArrays, b: SpectrumArrays, max_dmz_da: float) -> tuple[np.ndarray, np.ndarray]:
+    """Fraction of the intensity of b[i] in peaks that are found in a[i] and
+    the number of those peaks."""
+    n = len(a)
+    spec_b = b.spectrum_index
+    peaks_b = np.unique(_match_peaks(a, b, max_dmz_da)[1])
+    totals = np.bincount(spec_b, b.intensities, minlength=n)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.bincount(spec_b[peaks_b], b.intensities[peaks_b], minlength=n) / totals
+    scores[(totals == 0) | (a.n_peaks == 0)] = np.nan
+    return scores, np.bincount(spec_b[peaks_b], minlength=n)
+
+
+def _score_peak_lists(
+        kernel: Callable[[SpectrumArrays, SpectrumArrays, float], tuple[np.ndarray, np.ndarray]],
+        ref: PeakList | None,
+        meas: PeakList | None,
+        max_dmz_da: float,
+        return_nhits: bool,
+        precursor_mz_ref: float | None,
+        precursor_mz_meas: float | None
+) -> tuple[float] | tuple[float, int]:
+    """Score a single pair of peak lists with a pair kernel."""
+    if (ref is None) or (meas is None):
+        if return_nhits:
+            return float('nan'), 0
+        return float('nan'),
+
+    a = SpectrumArrays.from_peak_lists([ref], precursor_mzs=[precursor_mz_ref])
+    b = SpectrumArrays.from_peak_lists([meas], precursor_mzs=[precursor_mz_meas])
+    scores, n_hits = kernel(a, b, max_dmz_da)
+    if return_nhits:
+        return float(scores[0]), int(n_hits[0])
+    return float(scores[0]),
+
+
+def modified_cosine(
+        ref: PeakList,
+        meas: PeakList,
+        max_dmz_da: float,
+        return_nhits: bool = False,
+        precursor_mz_ref: float | None = None,
+        precursor_mz_meas: float | None = None
+) -> tuple[float] | tuple[float, int]:
+    """
+    Modified cosine of two spectra: peaks match directly or shifted by the
+    difference of the precursor m/z (plain cosine with one-to-one matching if
+    a precursor is missing), each peak is matched at most once (greedy by
+    intensity product). The number of hits is the number of matched pairs.
+    """
+    return _score_peak_lists(
+        _modified_cosine_pairs, ref, meas, max_dmz_da, return_nhits, precursor_mz_ref, precursor_mz_meas
+    )
+
+
+def entropy_similarity(
+        ref: PeakList,
+        meas: PeakList,
+        max_dmz_da: float,
+        return_nhits: bool = False,
+        precursor_mz_ref: float | None = None,
+        precursor_mz_meas: float | None = None
+) -> tuple[float] | tuple[float, int]:
+    """Weighted spectral entropy similarity (Li et al. 2021) of one-to-one
+    matched peaks, the number of hits is the number of matched pairs."""
+    return _score_peak_lists(_entropy_pairs, ref, meas, max_dmz_da, return_nhits, precursor_mz_ref, precursor_mz_meas)
+
+
+def neutral_loss_cosine(
+        ref: PeakList,
+        meas: PeakList,
+        max_dmz_da: float,
+        return_nhits: bool = False,
+        precursor_mz_ref: float | None = None,
+        precursor_mz_meas: float | None = None
+) -> tuple[float] | tuple[float, int]:
+    """cosine_similarity_sym of the neutral losses, NaN if a precursor is missing."""
+    return _score_peak_lists(
+        _neutral_loss_cosine_pairs, ref, meas, max_dmz_da, return_nhits, precursor_mz_ref, precursor_mz_meas
+    )
+
+
+def matched_intensity_fraction(
+        ref: PeakList,
+        meas: PeakList,
+        max_dmz_da: float,
+        return_nhits: bool = False,
+        precursor_mz_ref: float | None = None,
+        precursor_mz_meas: float | None = None
+) -> tuple[float] | tuple[float, int]:
+    """Fraction of the intensity of meas explained by peaks of ref, the hits
+    are the peaks of meas found in ref."""
+    return _score_peak_lists(
+        _matched_intensity_pairs, ref, meas, max_dmz_da, return_nhits, precursor_mz_ref, precursor_mz_meas
+    )
+
+
+def _score_in_batches(
+        kernel: Callable[[SpectrumArrays, SpectrumArrays, float], tuple[np.ndarray, np.ndarray]],
+        a: SpectrumArrays,
+        b: SpectrumArrays,
+        max_dmz_da: float,
+        idcs_a: np.ndarray[int] | None,
+        idcs_b: np.ndarray[int] | None,
+        batch_size: int,
+        n_workers: int = 1
+) -> tuple[np.ndarray[float], np.ndarray[int]]:
+    """Apply a pair kernel to a[idcs_a[i]] and b[idcs_b[i]] in batches (in
+    threads if n_workers > 1, the kernels spend most time in numpy)."""
+    idcs_a = np.arange(len(a)) if idcs_a is None else np.asarray(idcs_a, dtype=np.int64)
+    idcs_b = np.arange(len(b)) if idcs_b is None else np.asarray(idcs_b, dtype=np.int64)
+    assert len(idcs_a) == len(idcs_b), 'need the same number of spectra on both sides'
+
+    scores = np.full(len(idcs_a), np.nan)
+    n_hits = np.zeros(len(idcs_a), dtype=np.int64)
+    starts = range(0, len(idcs_a), batch_size)
+
+    def score_batch(start: int) -> None:
+        stop = start + batch_size
+        scores[start:stop], n_hits[start:stop] = kernel(
+            a.subset(idcs_a[start:stop]), b.subset(idcs_b[start:stop]), max_dmz_da
+        )
+
+    if n_workers > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(n_workers) as pool:
+            list(pool.map(score_batch, starts))
+    else:
+        for start in starts:
+            score_batch(start)
+    return scores, n_hits
+
+
+@dataclass(frozen=True)
+class Metric:
+    """
+    Similarity of MS2 spectra. The scalar version is called as
+    scalar(ref, meas, max_dmz_da, return_nhits=...), metrics that use
+    precursors also take precursor_mz_ref and precursor_mz_meas. The pair
+    kernel scores a[i] with b[i] for two SpectrumArrays of the same length and
+    returns the scores and hits as arrays.
+    """
+    name: str
+    scalar: Callable[..., tuple[float] | tuple[float, int]]
+    pairs: Callable[[SpectrumArrays, SpectrumArrays, float], tuple[np.ndarray, np.ndarray]]
+    uses_precursors: bool = False
+
+
+METRICS: dict[str, Metric] = {}
+
+
+def register_metric(metric: Metric, aliases: Iterable[str] = ()) -> Metric:
+    """Make a metric available by name (e.g. in Library.find_matches)."""
+    for name in (metric.name, *aliases):
+        METRICS[name] = metric
+    return metric
+
+
+def get_metric(name: str) -> Metric:
+    if name not in METRICS:
+        raise ValueError(f'Unknown metric {name}, available are {sorted(METRICS)}')
+    return METRICS[name]
+
+
+register_metric(Metric('cosine_sim', cosine_similarity_sym, _cosine_pairs))
+register_metric(Metric('cosine_fwd', cosine_similarity_forward, _cosine_forward_pairs))
+register_metric(Metric('cosine_bwd', cosine_similarity_backward, _cosine_backward_pairs), aliases=('cosine_backward',))
+register_metric(Metric('modified_cosine', modified_cosine, _modified_cosine_pairs, uses_precursors=True))
+register_metric(Metric('entropy', entropy_similarity, _entropy_pairs))
+register_metric(Metric('neutral_loss_cosine', neutral_loss_cosine, _neutral_loss_cosine_pairs, uses_precursors=True))
+register_metric(Metric('matched_intensity', matched_intensity_fraction, _matched_intensity_pairs))
+
+
+def score_pairs(
+        metric: str | Metric,
+        a: SpectrumArrays,
+        b: SpectrumArrays,
+        max_dmz_da: float,
+        idcs_a: np.ndarray[int] = None,
+        idcs_b: np.ndarray[int] = None,
+        batch_size: int = 20_000,
+        n_workers: int = 1
+) -> tuple[np.ndarray[float], np.ndarray[int]]:
+    """
+    Score many pairs of spectra with the pair kernel of a metric:
+    a[idcs_a[i]] with b[idcs_b[i]] (a[i] with b[i] if no indices are given).
+    Pairs with an empty spectrum get a NaN score. The pairs are processed in
+    batches to limit the memory.
+    """
+    metric = get_metric(metric) if isinstance(metric, str) else metric
+    return _score_in_batches(metric.pairs, a, b, max_dmz_da, idcs_a, idcs_b, batch_size, n_workers)
+
+
+def cosine_similarity_batch(
+        a: SpectrumArrays,
+        b: SpectrumArrays,
+        max_dmz_da: float,
+        idcs_a: np.ndarray[int] = None,
+        idcs_b: np.ndarray[int] = None,
+        batch_size: int = 20_000,
+        n_workers: int = 1
+) -> tuple[np.ndarray[float], np.ndarray[int]]:
+    """cosine_similarity_sym (with return_nhits) for many pairs of spectra, see score_pairs."""
+    return score_pairs('cosine_sim', a, b, max_dmz_da, idcs_a, idcs_b, batch_size, n_workers)
+
+
+def modified_cosine_batch(
+        a: SpectrumArrays,
+        b: SpectrumArrays,
+        max_dmz_da: float,
+        idcs_a: np.ndarray[int] = None,
+        idcs_b: np.ndarray[int] = None,
+        batch_size: int = 20_000,
+        n_workers: int = 1
+) -> tuple[np.ndarray[float], np.ndarray[int]]:
+    """modified_cosine (with return_nhits) for many pairs of spectra, see score_pairs."""
+    return score_pairs('modified_cosine', a, b, max_dmz_da, idcs_a, idcs_b, batch_size, n_workers)
+
+
+def binned_vectors(
+        spectra: SpectrumArrays,
+        bin_width: float = 1.,
+        bin_offset: float = 0.4,
+        n_bins: int = None
+):
+    """
+    Spectra as rows of a scipy CSR matrix: intensities are summed in the bins
+    floor((mz + bin_offset) / bin_width) and the rows L2-normalised, so the dot
+    product of two rows approximates their cosine score. The default puts the
+    bin edges of unit bins at a mass defect of 0.6. Peaks outside n_bins
+    (default: up to the largest m/z) are dropped.
+    """
+    from scipy.sparse import csr_matrix
+
+    bins = np.floor((spectra.mzs + bin_offset) / bin_width).astype(np.int64)
+    n_bins = int(bins.max(initial=-1)) + 1 if n_bins is None else n_bins
+    keep = (bins >= 0) & (bins < n_bins)
+    matrix = csr_matrix(
+        (spectra.intensities[keep], (spectra.spectrum_index[keep], bins[keep])), shape=(len(spectra), n_bins)
+    )
+    matrix.sum_duplicates()
+    norms = np.sqrt(np.bincount(
+        np.repeat(np.arange(len(spectra)), np.diff(matrix.indptr)), matrix.data ** 2, minlength=len(spectra)
+    ))
+    norms[norms == 0] = 1.
+    matrix.data /= np.repeat(norms, np.diff(matrix.indptr))
+    return matrix
+
+
 if __name__ == '__main__':
     pl1 = PeakList(mzs=[1, 2, 3], intensities=[1, 2, 3])
     pl2 = PeakList(mzs=[2, 3, 4], intensities=[2, 3, 1])
 
     score, *n_hits = cosine_similarity_forward(pl1, pl2, 0.5, True)
     score, *n_hits = cosine_similarity_sym(pl1, pl2, 0.5, True)
+    score, *n_hits = modified_cosine(pl1, pl2, 0.5, True, precursor_mz_ref=10, precursor_mz_meas=11)
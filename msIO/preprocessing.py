@@ -0,0 +1,156 @@
+"""
+Preprocessing of MS2 spectra before scoring. Every step works on many spectra
+at once (SpectrumArrays) and steps are combined into a Preprocessing pipeline,
+e.g.
+
+    Preprocessing([MergePeaks(0.005), RemovePrecursor(1.5), RelativeNoiseThreshold(0.01), KeepTopN(20),
+                   ScaleIntensities('sqrt')])
+"""
+import hashlib
+from dataclasses import dataclass
+from typing import Iterable, Literal
+
+import numpy as np
+
+from msIO.list_of_ions.base import SpectrumArrays
+
+
+def _keep_peaks(spectra: SpectrumArrays, keep: np.ndarray[bool]) -> SpectrumArrays:
+    """Spectra with only the peaks where keep is True (spectra may become empty)."""
+    counts = np.bincount(spectra.spectrum_index[keep], minlength=len(spectra))
+    return SpectrumArrays(
+        feature_ids=spectra.feature_ids,
+        precursor_mzs=spectra.precursor_mzs,
+        offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        mzs=spectra.mzs[keep],
+        intensities=spectra.intensities[keep]
+    )
+
+
+def _base_peaks(spectra: SpectrumArrays) -> np.ndarray[float]:
+    """Highest intensity of each spectrum (0 if empty)."""
+    base_peaks = np.zeros(len(spectra))
+    np.maximum.at(base_peaks, spectra.spectrum_index, spectra.intensities)
+    return base_peaks
+
+
+@dataclass(frozen=True)
+class ScaleIntensities:
+    """Square root or log(1 + x) of the intensities, which dampens the
+    dominance of the highest peaks in the scores."""
+    method: Literal['sqrt', 'log'] = 'sqrt'
+
+    def __call__(self, spectra: SpectrumArrays) -> SpectrumArrays:
+        if self.method == 'sqrt':
+            intensities = np.sqrt(np.clip(spectra.intensities, 0, None))
+        elif self.method == 'log':
+            intensities = np.log1p(np.clip(spectra.intensities, 0, None))
+        else:
+            raise ValueError(f"method must be 'sqrt' or 'log', got {self.method}")
+        return SpectrumArrays(
+            spectra.feature_ids, spectra.precursor_mzs, spectra.offsets, spectra.mzs, intensities
+        )
+
+
+@dataclass(frozen=True)
+class RelativeNoiseThreshold:
+    """Remove peaks below min_rel_intensity times the base peak."""
+    min_rel_intensity: float = 0.01
+
+    def __call__(self, spectra: SpectrumArrays) -> SpectrumArrays:
+        base_peaks = _base_peaks(spectra)
+        return _keep_peaks(spectra, spectra.intensities >= self.min_rel_intensity * base_peaks[spectra.spectrum_index])
+
+
+@dataclass(frozen=True)
+class KeepTopN:
+    """Keep the n most intense peaks of each spectrum (ties by m/z)."""
+    n: int = 20
+
+    def __call__(self, spectra: SpectrumArrays) -> SpectrumArrays:
+        spectrum_index = spectra.spectrum_index
+        o = np.lexsort((-spectra.intensities, spectrum_index))
+        ranks = np.arange(len(o)) - spectra.offsets[spectrum_index[o]]
+        keep = np.zeros(len(o), dtype=bool)
+        keep[o[ranks < self.n]] = True
+        return _keep_peaks(spectra, keep)
+
+
+@dataclass(frozen=True)
+class RemovePrecursor:
+    """Remove peaks within window_da of the precursor m/z (and all peaks
+    above it if remove_above is True). Spectra without precursor are kept."""
+    window_da: float = 1.5
+    remove_above: bool = False
+
+    def __call__(self, spectra: SpectrumArrays) -> SpectrumArrays:
+        dmzs = spectra.mzs - spectra.precursor_mzs[spectra.spectrum_index]
+        remove = np.abs(dmzs) <= self.window_da  # False for NaN
+        if self.remove_above:
+            remove |= dmzs > 0
+        return _keep_peaks(spectra, ~remove)
+
+
+@dataclass(frozen=True)
+class MergePeaks:
+    """
+    Centroid peaks that are closer than max_dmz_da to their neighbor: each
+    run of such peaks becomes one peak at the intensity-weighted mean m/z
+    with the summed intensity.
+    """
+    max_dmz_da: float = 0.005
+
+    def __call__(self, spectra: SpectrumArrays) -> SpectrumArrays:
+        spectrum_index = spectra.spectrum_index
+        # a new cluster starts at every peak that is far from its predecessor or starts a spectrum
+        is_start = np.ones(len(spectra.mzs), dtype=bool)
+        is_start[1:] = (np.diff(spectra.mzs) >= self.max_dmz_da) | (spectrum_index[1:] != spectrum_index[:-1])
+        clusters = np.cumsum(is_start) - 1
+        n_clusters = int(is_start.sum())
+
+        intensities = np.bincount(clusters, spectra.intensities, minlength=n_clusters)
+        weighted_mzs = np.bincount(clusters, spectra.mzs * spectra.intensities, minlength=n_clusters)
+        mzs = spectra.mzs[is_start].copy()
+        has_intensity = intensities > 0
+        mzs[has_intensity] = weighted_mzs[has_intensity] / intensities[has_intensity]
+        counts = np.bincount(spectrum_index[is_start], minlength=len(spectra))
+        return SpectrumArrays(
+            feature_ids=spectra.feature_ids,
+            precursor_mzs=spectra.precursor_mzs,
+            offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            mzs=mzs,
+            intensities=intensities
+        )
+
+
+class Preprocessing:
+    """Steps applied in order to batches of spectra."""
+
+    def __init__(self, steps: Iterable = ()) -> None:
+        self.steps = tuple(steps)
+
+    def __call__(self, spectra: SpectrumArrays) -> SpectrumArrays:
+        for step in self.steps:
+            spectra = step(spectra)
+        return spectra
+
+    def __repr__(self) -> str:
+        return f'Preprocessing([{", ".join(map(repr, self.steps))}])'
+
+    @property
+    def key(self) -> str:
+        """Short identifier of the steps and their parameters, e.g. for caching."""
+        return hashlib.sha1(repr(self).encode()).hexdigest()[:12]
+
+
+if __name__ == '__main__':
+    spectra = SpectrumArrays.from_peaks(
+        feature_ids=[1, 2],
+        precursor_mzs=[300., np.nan],
+        spectrum_index=np.array([0, 0, 0, 0, 1, 1]),
+        mzs=np.array([100., 100.002, 150., 300., 80., 90.]),
+        intensities=np.array([10., 30., 1., 50., 5., 20.])
+    )
+    preprocessing = Preprocessing([MergePeaks(0.005), RemovePrecursor(1.5), KeepTopN(1), ScaleIntensities('sqrt')])
+    print(preprocessing, preprocessing.key)
+    print(preprocessing(spectra))
@@ -1,9 +1,32 @@
+import hashlib
 import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from dataclasses import dataclass, field
+from typing import Iterator, Iterable
 
+import numpy as np
+from sqlalchemy import Table, select, insert, update, delete, func
 from tqdm import tqdm
 
 from msIO import MSPReader
-from msIO.sql.session import initiate_db, get_sessionmaker
+from msIO.features.base import SqlBaseClass
+from msIO.features.combined import FeatureCombined
+from msIO.features.metaboscape import FeatureMetaboScape
+from msIO.features.mgf import FeatureMgf, MsSpec
+from msIO.features.sirius import FeatureSirius, CompoundCandidate
+from msIO.list_of_ions.base import PeakList, PeakFeature, parse_peak_lines
+from msIO.list_of_ions.read_msp import _parse_lines, detect_peak_splitter
+from msIO.sql.manifest import LibrarySource
+from msIO.sql.session import initiate_db, get_sessionmaker, get_engine, drop_indexes, ensure_indexes
+
+# MSP entries are separated by blank lines
+_pattern_entry_end = re.compile(rb'\n\r?\n')
+# properties of an entry that end up in the library
+_ENTRY_KEYS = ('mz', 'rt_seconds', 'ccs', 'ion', 'formula', 'comment', 'name', 'logp', 'inchi', 'smiles',
+               'confidence_level')
 
 
 def write_lib_from_msp_files(db_file: str, msp_files: list[str], commit_at_latest_after=10_000, low_memory_thr_GB = 1) -> None:
@@ -46,6 +69,349 @@ def write_lib_from_msp_files(db_file: str, msp_files: list[str], commit_at_lates
         session.commit()
 
 
+def get_library_name(library_file: str) -> str:
+    return os.path.basename(library_file.replace('\\', '/')).split('.')[0]
+
+
+def _find_chunk_bounds(path_file: str, chunk_size: int, start: int = 0) -> list[tuple[int, int]]:
+    """Byte ranges of roughly chunk_size bytes from start that end after a blank line."""
+    size = os.path.getsize(path_file)
+    bounds: list[tuple[int, int]] = []
+    with open(path_file, 'rb') as f:
+        while start < size:
+            end = start + chunk_size
+            while end < size:
+                f.seek(end)
+                window = f.read(1 << 16)
+                match = _pattern_entry_end.search(window)
+                if match is not None:
+                    end += match.end()
+                    break
+                if len(window) < 1 << 16:  # no separator before the end of the file
+                    end = size
+                    break
+                # overlap in case the window split a separator
+                end += len(window) - 2
+            end = min(end, size)
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+
+def _detect_file_splitter(path_file: str) -> str | None:
+    """Peak separator from the first peak line of the file, like MSPReader."""
+    with open(path_file, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line[:1].isnumeric():
+                return detect_peak_splitter([line])
+    return None
+
+
+def _get_value_or_none(entry: dict, key: str):
+    """Like create_feature: missing and negative numbers are None."""
+    val = entry.get(key)
+    if val is None:
+        return None
+    if isinstance(val, int | float) and not (val >= 0):
+        return None
+    return val
+
+
+@dataclass
+class _ParsedChunk:
+    """Entries of a chunk of an MSP file in columnar form."""
+    entries: list[tuple] = field(default_factory=list)
+    n_peaks: list[int] = field(default_factory=list)
+    mzs: list[float] = field(default_factory=list)
+    intensities: list[float] = field(default_factory=list)
+    annotations: list[str | None] = field(default_factory=list)
+    n_bytes: int = 0
+
+    def add(self, lines: list[str], splitter: str | None) -> None:
+        entry = {k.lower(): v for k, v in _parse_lines(lines).items()}
+        if len(entry) == 0:
+            return
+        if 'rt_minutes' in entry:
+            entry['rt_seconds'] = entry['rt_minutes'] * 60
+        self.entries.append(tuple(_get_value_or_none(entry, k) for k in _ENTRY_KEYS))
+
+        mzs, ints, comments = parse_peak_lines(lines, splitter) if splitter is not None else ([], [], [])
+        self.n_peaks.append(len(mzs))
+        self.mzs.extend(mzs)
+        self.intensities.extend(ints)
+        self.annotations.extend(comments)
+
+
+def _parse_msp_chunk(args: tuple[str, int, int, str | None]) -> _ParsedChunk:
+    """Parse the entries in a byte range of an MSP file (runs in the workers)."""
+    path_file, start, end, splitter = args
+    with open(path_file, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8', errors='replace')
+
+    chunk = _ParsedChunk(n_bytes=end - start)
+    lines: list[str] = []
+    for line in text.split('\n'):
+        line = line.rstrip('\r')
+        if len(line) == 0:
+            chunk.add(lines, splitter)
+            lines = []
+        else:
+            lines.append(line)
+    chunk.add(lines, splitter)
+    return chunk
+
+
+def _parse_in_order(pool: ProcessPoolExecutor | None, tasks: list[tuple], max_in_flight: int) -> Iterator[_ParsedChunk]:
+    """Parsed chunks in order of the tasks, with a limited number of chunks in flight."""
+    if pool is None:
+        yield from map(_parse_msp_chunk, tasks)
+        return
+    in_flight: deque[Future] = deque()
+    for task in tasks:
+        in_flight.append(pool.submit(_parse_msp_chunk, task))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def _insert_rows(conn, table: Table, columns: list[str], rows: Iterable[tuple]) -> None:
+    """executemany of a positional INSERT, skips building a dict per row."""
+    quote = conn.dialect.identifier_preparer.quote
+    stmt = (f'INSERT INTO {quote(table.name)} ({", ".join(quote(table.c[c].name) for c in columns)}) '
+            f'VALUES ({", ".join("?" * len(columns))})')
+    conn.exec_driver_sql(stmt, list(rows))
+
+
+def _insert_chunk(conn, chunk: _ParsedChunk, lib_name: str, f_id: int, peak_id: int, batch_size: int) -> None:
+    """Write the parsed entries with consecutive ids starting at f_id and peak_id."""
+    n = len(chunk.entries)
+    if n == 0:
+        return
+    f_ids = range(f_id, f_id + n)
+    cols = dict(zip(_ENTRY_KEYS, zip(*chunk.entries)))
+
+    # all per-feature tables are 1:1, so they share the id of the feature
+    _insert_rows(conn, FeatureCombined.__table__, ['id', 'feature_id'], zip(f_ids, f_ids))
+    _insert_rows(
+        conn, FeatureMetaboScape.__table__,
+        ['id', 'feature_id', 'combined_feature_id', 'rt_seconds', 'CCS', 'mz_meas', 'adduct_metaboscape',
+         'formula_metaboscape', 'annotation_source', 'annotation_type'],
+        zip(f_ids, f_ids, f_ids, cols['rt_seconds'], cols['ccs'], cols['mz'], cols['ion'], cols['formula'],
+            cols['comment'], [lib_name] * n)
+    )
+    _insert_rows(conn, FeatureMgf.__table__, ['id', 'feature_id', 'combined_feature_id'], zip(f_ids, f_ids, f_ids))
+    _insert_rows(conn, PeakList.__table__, ['id'], zip(f_ids))
+    _insert_rows(conn, MsSpec.__table__, ['id', 'ms_level', 'peaks_id', 'feature_mgf_id'],
+                 zip(f_ids, [2] * n, f_ids, f_ids))
+    _insert_rows(conn, FeatureSirius.__table__,
+                 ['id', 'feature_id', 'combined_feature_id', 'use_zodiac_scoring_for_best'],
+                 zip(f_ids, f_ids, f_ids, [True] * n))
+    _insert_rows(
+        conn, CompoundCandidate.__table__,
+        ['id', 'feature_id', 'name_sirius', 'xlogp', 'inchi', 'smiles', 'confidence_rank'],
+        zip(f_ids, f_ids, cols['name'], cols['logp'], cols['inchi'], cols['smiles'], cols['confidence_level'])
+    )
+
+    n_peaks = len(chunk.mzs)
+    peak_ids = range(peak_id, peak_id + n_peaks)
+    peak_list_ids = np.repeat(np.arange(f_id, f_id + n), chunk.n_peaks).tolist()
+    for start in range(0, n_peaks, batch_size):
+        stop = start + batch_size
+        _insert_rows(
+            conn, PeakFeature.__table__, ['id', 'peak_list_id', 'mz', 'intensity', 'annotation'],
+            zip(peak_ids[start:stop], peak_list_ids[start:stop], chunk.mzs[start:stop],
+                chunk.intensities[start:stop], chunk.annotations[start:stop])
+        )
+
+
+def _hash_file(path_file: str, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path_file, 'rb') as f:
+        while block := f.read(block_size):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _delete_source_features(conn, source: LibrarySource) -> None:
+    """Remove the features (and their spectra) written for a source file."""
+    if source.first_feature_id is None or source.n_features == 0:
+        return
+    lo, hi = source.first_feature_id, source.first_feature_id + source.n_features - 1
+    conn.execute(delete(PeakFeature.__table__).where(PeakFeature.__table__.c.peak_list_id.between(lo, hi)))
+    # all per-feature tables share the id of the feature
+    for cls in (MsSpec, PeakList, FeatureMgf, FeatureMetaboScape, CompoundCandidate, FeatureSirius, FeatureCombined):
+        conn.execute(delete(cls.__table__).where(cls.__table__.c.id.between(lo, hi)))
+
+
+def _plan_sources(
+        conn, msp_files: list[str], chunk_size: int, next_feature_id: int
+) -> tuple[list[tuple[str, int, int, str | None]], list[str]]:
+    """
+    Compare the files with the manifest. Files that are already complete are
+    skipped, an interrupted file is resumed after its last committed chunk
+    (if its ids can stay consecutive), new and changed files are (re)ingested.
+    Returns the chunks to parse (resumed file first) and the skipped files.
+    """
+    table = LibrarySource.__table__
+    sources = {row.path: row for row in conn.execute(select(table)).all()}
+    # the same file may be given twice or under different spellings
+    msp_files = list(dict.fromkeys(os.path.abspath(library_file) for library_file in msp_files))
+
+    tasks_resumed: list[tuple[str, int, int, str | None]] = []
+    tasks: list[tuple[str, int, int, str | None]] = []
+    skipped: list[str] = []
+    for library_file in msp_files:
+        path = os.path.abspath(library_file)
+        size = os.path.getsize(library_file)
+        sha256 = _hash_file(library_file)
+        source = sources.get(path)
+
+        start = 0
+        if (source is not None) and (source.size == size) and (source.sha256 == sha256):
+            if source.is_complete:
+                skipped.append(library_file)
+                continue
+            if source.first_feature_id is None or source.first_feature_id + source.n_features == next_feature_id:
+                start = source.next_offset
+        if start == 0:
+            if source is not None:
+                _delete_source_features(conn, source)
+                conn.execute(delete(table).where(table.c.path == path))
+            conn.execute(insert(table).values(
+                path=path, library_name=get_library_name(library_file), size=size, sha256=sha256,
+                first_feature_id=None, n_features=0, n_peaks=0, next_offset=0, is_complete=size == 0
+            ))
+
+        splitter = _detect_file_splitter(library_file)
+        file_tasks = [(library_file, lo, hi, splitter) for lo, hi in _find_chunk_bounds(library_file, chunk_size, start)]
+        if start > 0:
+            tasks_resumed.extend(file_tasks)
+        else:
+            tasks.extend(file_tasks)
+    conn.commit()
+    return tasks_resumed + tasks, skipped
+
+
+def build_library(
+        db_file: str,
+        msp_files: list[str],
+        n_workers: int = None,
+        chunk_size_MB: float = 16,
+        batch_size: int = 100_000,
+        append: bool = False,
+        wal: bool = False
+) -> dict[str, dict[str, float]]:
+    """
+    Create a library DB from MSP files (same tables as
+    write_lib_from_msp_files). The files are split into chunks at entry
+    boundaries, which are parsed by n_workers processes (all cores by default,
+    inline for n_workers=1). A single writer inserts the chunks in file order
+    with Core inserts, so feature ids are consecutive in the order of the
+    files and entries regardless of the number of workers.
+
+    Ingested files are recorded (path, size, hash) in the library_sources
+    table. With append=True an existing DB is kept: complete files are
+    skipped, new or changed files are added with ids after the current
+    maximum (the features of an older version of a file are removed) and a
+    build that was interrupted continues after the last committed chunk.
+    Without append the DB is rebuilt, with indexes created after the load.
+
+    wal=True writes with the WAL journal, which is faster but does not work
+    on network shares; the DB is switched back to the default rollback
+    journal after the load.
+
+    Returns the number of features and peaks, the time and throughput for
+    each library and in total ('total').
+    """
+    is_new_db = not (append and os.path.exists(db_file))
+    if is_new_db:
+        initiate_db(db_file)
+        drop_indexes(db_file)
+    else:
+        # e.g. the manifest for DBs built before it existed
+        SqlBaseClass.metadata.create_all(get_engine(db_file))
+
+    stats: dict[str, dict[str, float]] = {}
+    time_start = time.perf_counter()
+    engine = get_engine(db_file)
+    n_workers = n_workers or os.cpu_count()
+    with engine.connect() as conn:
+        # commits stay durable, which resuming an interrupted build relies on
+        conn.exec_driver_sql('PRAGMA synchronous=NORMAL')
+        if wal:
+            conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+
+        # running indexes for features and peaks
+        f_id: int = conn.execute(select(func.coalesce(func.max(FeatureCombined.__table__.c.id), 0))).scalar() + 1
+        peak_id: int = conn.execute(select(func.coalesce(func.max(PeakFeature.__table__.c.id), 0))).scalar() + 1
+        f_id_start, peak_id_start = f_id, peak_id
+
+        tasks, skipped = _plan_sources(conn, msp_files, int(chunk_size_MB * 1024 ** 2), f_id)
+        for library_file in skipped:
+            stats[get_library_name(library_file)] = dict(n_features=0, n_peaks=0, seconds_writing=0., skipped=True)
+
+        table = LibrarySource.__table__
+        pool = ProcessPoolExecutor(n_workers) if n_workers > 1 and len(tasks) > 1 else None
+        try:
+            chunks = _parse_in_order(pool, tasks, max_in_flight=2 * n_workers)
+            with tqdm(
+                    total=sum(end - start for _, start, end, _ in tasks),
+                    desc='building library', unit='B', unit_scale=True, smoothing=1 / 50
+            ) as pbar:
+                for (library_file, _, end, _), chunk in zip(tasks, chunks):
+                    time_chunk = time.perf_counter()
+                    lib_name = get_library_name(library_file)
+                    _insert_chunk(conn, chunk, lib_name, f_id, peak_id, batch_size)
+
+                    n_features, n_peaks = len(chunk.entries), len(chunk.mzs)
+                    # commit the progress together with the features
+                    conn.execute(
+                        update(table)
+                        .where(table.c.path == os.path.abspath(library_file))
+                        .values(
+                            first_feature_id=func.coalesce(table.c.first_feature_id, f_id),
+                            n_features=table.c.n_features + n_features,
+                            n_peaks=table.c.n_peaks + n_peaks,
+                            next_offset=end,
+                            is_complete=end == os.path.getsize(library_file)
+                        )
+                    )
+                    conn.commit()
+
+                    f_id += n_features
+                    peak_id += n_peaks
+                    lib_stats = stats.setdefault(
+                        lib_name, dict(n_features=0, n_peaks=0, seconds_writing=0., skipped=False)
+                    )
+                    lib_stats['n_features'] += n_features
+                    lib_stats['n_peaks'] += n_peaks
+                    lib_stats['seconds_writing'] += time.perf_counter() - time_chunk
+
+                    pbar.update(chunk.n_bytes)
+                    pbar.set_postfix(features=f_id - f_id_start, peaks=peak_id - peak_id_start)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if wal:
+                # journal_mode=WAL is stored in the file
+                conn.rollback()
+                conn.exec_driver_sql('PRAGMA journal_mode=DELETE')
+
+    time_indexes = time.perf_counter()
+    ensure_indexes(db_file)
+    seconds = time.perf_counter() - time_start
+    stats['total'] = dict(
+        n_features=f_id - f_id_start,
+        n_peaks=peak_id - peak_id_start,
+        seconds=seconds,
+        seconds_indexing=time.perf_counter() - time_indexes,
+        features_per_second=(f_id - f_id_start) / seconds,
+        peaks_per_second=(peak_id - peak_id_start) / seconds
+    )
+    return stats
+
 if __name__ == '__main__':
     pass
     # from msIO.feature_managers.db import Library
@@ -70,4 +436,5 @@ if __name__ == '__main__':
                         if (not f.startswith('!') and not ('test_as_H+' in f))
                     ]
 
-
+    stats = build_library(db_file, library_files)
+    print(stats['total'])
@@ -0,0 +1,29 @@
+"""
+Source files that were ingested into a library DB, such that a library can be
+extended with new files and an interrupted build can be resumed.
+"""
+from typing import Optional
+
+from sqlalchemy import Integer, String, Boolean
+from sqlalchemy.orm import Mapped, mapped_column
+
+from msIO.features.base import SqlBaseClass
+
+
+class LibrarySource(SqlBaseClass):
+    """MSP file of a library. Its features have the consecutive ids
+    first_feature_id, ..., first_feature_id + n_features - 1."""
+    __tablename__ = "library_sources"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    path: Mapped[str] = mapped_column(String, nullable=False, unique=True)
+    library_name: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    size: Mapped[int] = mapped_column(Integer, nullable=False)
+    sha256: Mapped[str] = mapped_column(String, nullable=False)
+
+    first_feature_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    n_features: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    n_peaks: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # end of the last committed chunk, the build is resumed from here
+    next_offset: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    is_complete: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
@@ -1,6 +1,6 @@
 import os
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker
 from pathlib import Path
 
@@ -19,14 +19,94 @@ def get_sessionmaker(db_file: str):
     return sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 
 
+def _register_models() -> None:
+    """Import all models such that their tables and indexes are known to the
+    metadata."""
+    import msIO.features.combined  # noqa: F401
+    import msIO.features.mca  # noqa: F401
+    import msIO.features.duplicates  # noqa: F401
+    import msIO.features.network  # noqa: F401
+    import msIO.environmental.location  # noqa: F401
+    import msIO.sql.manifest  # noqa: F401
+
+
 def initiate_db(path_file):
     # after deleting the database, it has to be reinitialized
     if os.path.exists(path_file):
         os.remove(path_file)
 
+    _register_models()
     engine = get_engine(path_file)
     SqlBaseClass.metadata.create_all(engine)
 
 
+def ensure_indexes(db_file: str) -> list[str]:
+    """
+    Create the indexes declared on the models that do not exist in the DB yet,
+    e.g. for DBs created before the indexes were declared or after a bulk load
+    without indexes. Returns the names of the created indexes.
+    """
+    _register_models()
+    engine = get_engine(db_file)
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+
+    created: list[str] = []
+    with engine.begin() as conn:
+        for table in SqlBaseClass.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                index.create(conn)
+                created.append(index.name)
+        # update the statistics used by the query planner
+        conn.exec_driver_sql('ANALYZE')
+    return created
+
+
+def drop_indexes(db_file: str) -> None:
+    """Drop the indexes declared on the models, e.g. before a bulk load."""
+    _register_models()
+    engine = get_engine(db_file)
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+
+    with engine.begin() as conn:
+        for table in SqlBaseClass.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    index.drop(conn)
+
+
+def ensure_rtree(db_file: str) -> None:
+    """
+    Create the m/z-RT-CCS R*Tree of the MetaboScape features and its triggers
+    in DBs created before it existed, and (re)fill it from the features table.
+    """
+    from msIO.features.metaboscape import RTREE_DDL, RTREE_BACKFILL, RTREE_TABLE
+
+    engine = get_engine(db_file)
+    with engine.begin() as conn:
+        for ddl in RTREE_DDL:
+            conn.exec_driver_sql(ddl)
+        conn.exec_driver_sql(f'DELETE FROM {RTREE_TABLE}')
+        conn.exec_driver_sql(RTREE_BACKFILL)
+
+
+def explain_query_plan(db_file: str, stmt) -> list[str]:
+    """Return the SQLite query plan for a statement (one line per step)."""
+    engine = get_engine(db_file)
+    compiled = stmt.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}').all()
+    return [row[-1] for row in rows]
+
+
 if __name__ == '__main__':
     initiate_db(r"C:\Users\Yannick Zander\Nextcloud2\Promotion\msIO\msIO\feature_managers\database.db")
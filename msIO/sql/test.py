@@ -67,3 +67,13 @@ stmt = (
 
 with Session() as session:
     res = session.scalars(stmt).all()
+
+# %% same search with the sorted fragment index (no scan over peak table)
+from msIO.feature_managers.db import FeatureManagerDB
+
+db = FeatureManagerDB(db_file)
+res_index = db.find_by_fragment(fragment_target_mass, tol_ppm=ppm_tolerance)
+# water loss
+res_loss = db.find_by_neutral_loss(18.0106, tol_da=.005)
+# choline head group AND phosphocholine loss
+res_pc = db.find_by_fragments(fragments=[184.0733], neutral_losses=[183.0660], tol_da=.005)
@@ -0,0 +1,64 @@
+"""
+Library.find_duplicates on a small MSP file with known duplicates (ids are
+assigned in the order of the entries, starting at 1):
+
+    1, 2      same precursor (2 mDa) and spectrum
+    3         within 5 mDa of 1 and 2, but a different spectrum
+    4, 5, 6   chain: 4-5 and 5-6 within 5 mDa with similar spectra, 4-6 too far
+    7, 8      same precursor without MS2
+    9         alone
+"""
+import os
+
+import numpy as np
+import pytest
+
+from msIO.feature_managers.db import Library
+from msIO.sql.from_library import build_library
+
+PATH_MSP = os.path.join(os.path.dirname(__file__), 'data', 'duplicates.msp')
+
+
+@pytest.fixture
+def library(tmp_path) -> Library:
+    db_file = str(tmp_path / 'library.db')
+    build_library(db_file, [PATH_MSP], n_workers=1)
+    return Library(db_file)
+
+
+def _pairs(edges) -> set[tuple[int, int]]:
+    return set(zip(edges.feature_id_a.tolist(), edges.feature_id_b.tolist()))
+
+
+def test_find_duplicates(library):
+    edges, groups = library.find_duplicates(max_dmz_da=5e-3, min_ms2_score=0.7)
+    assert _pairs(edges) == {(1, 2), (4, 5), (5, 6)}
+    assert np.allclose(edges.dmz_mda, [2., 3., 3.])
+    assert (edges.ms2_score >= 0.7).all()
+
+    assert groups.feature_id.tolist() == [1, 2, 4, 5, 6]
+    assert groups.group_id.tolist() == [0, 0, 1, 1, 1]
+    assert groups.group_size.tolist() == [2, 2, 3, 3, 3]
+    assert groups.name.tolist()[:2] == ['dup A', 'dup A copy']
+
+
+def test_find_duplicates_without_ms2(library):
+    edges, groups = library.find_duplicates(max_dmz_da=5e-3, min_ms2_score=0.7, require_ms2=False)
+    assert _pairs(edges) == {(1, 2), (4, 5), (5, 6), (7, 8)}
+    assert groups.group_id.nunique() == 3
+
+    # precursor mass only
+    edges, groups = library.find_duplicates(max_dmz_da=5e-3, min_ms2_score=None)
+    assert _pairs(edges) == {(1, 2), (1, 3), (2, 3), (4, 5), (5, 6), (7, 8)}
+    assert groups.group_size.tolist() == [3, 3, 3, 3, 3, 3, 2, 2]
+
+
+def test_duplicate_groups_round_trip(library):
+    assert library.get_duplicate_groups() == {}
+    _, groups = library.find_duplicates(max_dmz_da=5e-3, min_ms2_score=0.7)
+    library.write_duplicate_groups(groups)
+    assert library.get_duplicate_groups() == {0: [1, 2], 1: [4, 5, 6]}
+
+    # writing again replaces the groups
+    library.write_duplicate_groups(groups[groups.group_id == 1])
+    assert library.get_duplicate_groups() == {1: [4, 5, 6]}
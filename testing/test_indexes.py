@@ -0,0 +1,63 @@
+"""
+The spectrum lookups by feature id must use the declared indexes instead of
+scanning the tables, also in DBs migrated with ensure_indexes.
+"""
+from sqlalchemy import select
+
+from msIO.features.base import SqlBaseClass
+from msIO.features.mgf import FeatureMgf, MsSpec
+from msIO.list_of_ions.base import PeakFeature, PeakList
+from msIO.sql.session import initiate_db, ensure_indexes, drop_indexes, explain_query_plan
+
+
+def _scans(plan: list[str]) -> list[str]:
+    return [step for step in plan if step.startswith('SCAN')]
+
+
+def _assert_no_scans(db_file: str) -> None:
+    # statement of FeatureManagerDB.get_ms_spectrum (single and batched)
+    for condition in (FeatureMgf.feature_id == 1, FeatureMgf.feature_id.in_([1, 2, 3])):
+        stmt = (
+            select(PeakList)
+            .select_from(MsSpec)
+            .join(MsSpec.feature_mgf)
+            .join(MsSpec.peaks)
+            .where(condition, MsSpec.ms_level == 2, MsSpec.peaks_id.is_not(None))
+        )
+        plan = explain_query_plan(db_file, stmt)
+        assert not _scans(plan), plan
+
+    # selectinload of the peaks of the found peak lists
+    stmt = select(PeakFeature).where(PeakFeature.peak_list_id.in_([1, 2, 3]))
+    plan = explain_query_plan(db_file, stmt)
+    assert not _scans(plan), plan
+
+
+def test_get_ms_spectrum_uses_indexes(tmp_path):
+    db_file = str(tmp_path / 'features.db')
+    initiate_db(db_file)
+    _assert_no_scans(db_file)
+
+
+def test_ensure_indexes(tmp_path):
+    """DBs without the declared indexes (e.g. older or bulk loaded) get them."""
+    db_file = str(tmp_path / 'features.db')
+    initiate_db(db_file)
+    declared = {index.name for table in SqlBaseClass.metadata.sorted_tables for index in table.indexes}
+    drop_indexes(db_file)
+    plan = explain_query_plan(db_file, select(PeakFeature).where(PeakFeature.peak_list_id.in_([1, 2, 3])))
+    assert _scans(plan), plan
+
+    assert set(ensure_indexes(db_file)) == declared
+    _assert_no_scans(db_file)
+    assert ensure_indexes(db_file) == []
+
+
+if __name__ == '__main__':
+    import tempfile
+    from pathlib import Path
+
+    with tempfile.TemporaryDirectory() as tmp:
+        test_get_ms_spectrum_uses_indexes(Path(tmp))
+    with tempfile.TemporaryDirectory() as tmp:
+        test_ensure_indexes(Path(tmp))
@@ -0,0 +1,65 @@
+"""
+FeatureManagerDB.get_intensity_matrix on a small DB with intensity rows:
+requested order, missing and repeated features and samples, dense and sparse.
+"""
+import numpy as np
+import pytest
+from sqlalchemy import insert
+
+from msIO.environmental.sample import Sample
+from msIO.feature_managers.db import FeatureManagerDB
+from msIO.features.metaboscape import FeatureMetaboScape, Intensity
+from msIO.sql.session import initiate_db
+
+# feature id x sample, zeros are not stored
+INTENSITIES = np.array([
+    [1., 0., 3.],
+    [0., 5., 6.],
+    [7., 8., 0.],
+])
+FEATURE_IDS = [10, 20, 30]
+SAMPLE_NAMES = ['a', 'b', 'c']
+
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory) -> FeatureManagerDB:
+    db_file = str(tmp_path_factory.mktemp('intensities') / 'features.db')
+    initiate_db(db_file)
+    db = FeatureManagerDB(db_file)
+    rows, cols = np.nonzero(INTENSITIES)
+    with db.session_maker() as session:
+        session.execute(insert(Sample), [dict(id=i + 1, sample_name=name) for i, name in enumerate(SAMPLE_NAMES)])
+        session.execute(insert(FeatureMetaboScape), [dict(id=i + 1, feature_id=f_id) for i, f_id in enumerate(FEATURE_IDS)])
+        session.execute(insert(Intensity), [
+            dict(feature_id=int(i) + 1, sample_id=int(j) + 1, value=INTENSITIES[i, j]) for i, j in zip(rows, cols)
+        ])
+        session.commit()
+    return db
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_intensity_matrix(db, sparse):
+    matrix, feature_ids, sample_names = db.get_intensity_matrix(sparse=sparse)
+    assert feature_ids.tolist() == FEATURE_IDS
+    assert sample_names.tolist() == SAMPLE_NAMES
+    assert np.array_equal(matrix.toarray() if sparse else matrix, INTENSITIES)
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_intensity_matrix_subset(db, sparse):
+    """Requested order, unknown ids and names give zeros, repeated ones the same values."""
+    requested_ids, requested_names = [30, 99, 10, 30, 10], ['c', 'x', 'a', 'c']
+    matrix, feature_ids, sample_names = db.get_intensity_matrix(requested_ids, requested_names, sparse=sparse)
+    assert feature_ids.tolist() == requested_ids
+    assert sample_names.tolist() == requested_names
+
+    full = np.zeros((len(FEATURE_IDS) + 1, len(SAMPLE_NAMES) + 1))
+    full[:-1, :-1] = INTENSITIES
+    rows = [FEATURE_IDS.index(f_id) if f_id in FEATURE_IDS else -1 for f_id in requested_ids]
+    cols = [SAMPLE_NAMES.index(name) if name in SAMPLE_NAMES else -1 for name in requested_names]
+    assert np.array_equal(matrix.toarray() if sparse else matrix, full[np.ix_(rows, cols)])
+
+
+def test_intensity_matrix_empty_request(db):
+    matrix, feature_ids, sample_names = db.get_intensity_matrix([], ['a'])
+    assert matrix.shape == (0, 1)
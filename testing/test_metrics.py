@@ -0,0 +1,149 @@
+"""
+The batched pair kernels in msIO.metrics against the scalar scores and
+straightforward reference implementations on random spectra.
+"""
+import numpy as np
+import pytest
+
+from msIO import PeakList
+from msIO.list_of_ions.base import SpectrumArrays
+from msIO.metrics import (
+    METRICS, cosine_similarity_batch, cosine_similarity_sym, cosine_similarity_forward, cosine_similarity_backward,
+    modified_cosine, modified_cosine_batch, entropy_similarity, score_pairs
+)
+
+MAX_DMZ_DA = 0.01
+
+
+def _random_spectra(n: int, seed: int = 0) -> tuple[list[PeakList], list[float]]:
+    """Spectra with peaks drawn from a shared pool (with jitter) such that many
+    peaks match, precursors are shifted copies of a few masses."""
+    rng = np.random.default_rng(seed)
+    pool = rng.uniform(50, 500, 40)
+    spectra, precursors = [], []
+    for _ in range(n):
+        k = int(rng.integers(1, 15))
+        mzs = rng.choice(pool, k, replace=False) + rng.uniform(-0.004, 0.004, k)
+        # shifted fragments for the modified cosine
+        if rng.random() < 0.5:
+            mzs = mzs + rng.choice([0., 14.01565, 15.99491])
+        mzs = np.sort(mzs)
+        spectra.append(PeakList(mzs=mzs.tolist(), intensities=rng.uniform(1, 100, k).tolist()))
+        precursors.append(float(rng.choice([600., 614.01565, 615.99491])))
+    return spectra, precursors
+
+
+def _greedy_pairs(mzs_a, mzs_b, ints_a, ints_b, shift: float | None) -> list[tuple[int, int]]:
+    """Sequential greedy one-to-one assignment by decreasing intensity product."""
+    candidates = []
+    for i, mz_a in enumerate(mzs_a):
+        for j, mz_b in enumerate(mzs_b):
+            direct = abs(mz_b - mz_a) < MAX_DMZ_DA
+            shifted = shift is not None and abs(mz_b + shift - mz_a) < MAX_DMZ_DA
+            if direct or shifted:
+                candidates.append((-ints_a[i] * ints_b[j], i, j))
+    used_a, used_b, pairs = set(), set(), []
+    for _, i, j in sorted(candidates):
+        if i in used_a or j in used_b:
+            continue
+        used_a.add(i)
+        used_b.add(j)
+        pairs.append((i, j))
+    return pairs
+
+
+def _modified_cosine_reference(a: PeakList, b: PeakList, precursor_a: float, precursor_b: float) -> tuple[float, int]:
+    ints_a, ints_b = np.asarray(a.intensities), np.asarray(b.intensities)
+    pairs = _greedy_pairs(a.mzs, b.mzs, ints_a, ints_b, precursor_a - precursor_b)
+    score = sum(ints_a[i] * ints_b[j] for i, j in pairs) / (np.linalg.norm(ints_a) * np.linalg.norm(ints_b))
+    return min(1., score), len(pairs)
+
+
+def _entropy(p: np.ndarray) -> float:
+    p = p[p > 0]
+    return float(-(p * np.log(p)).sum())
+
+
+def _weighted(intensities: list[float]) -> np.ndarray:
+    p = np.asarray(intensities) / np.sum(intensities)
+    entropy = _entropy(p)
+    if entropy < 3:
+        p = p ** (0.25 + 0.25 * entropy)
+        p = p / p.sum()
+    return p
+
+
+def _entropy_reference(a: PeakList, b: PeakList) -> tuple[float, int]:
+    """Entropies of both spectra and of the merged spectrum (Li et al. 2021)."""
+    p_a, p_b = _weighted(a.intensities), _weighted(b.intensities)
+    pairs = _greedy_pairs(a.mzs, b.mzs, p_a, p_b, None)
+    matched_a, matched_b = {i for i, _ in pairs}, {j for _, j in pairs}
+    merged = np.concatenate([
+        [p_a[i] + p_b[j] for i, j in pairs],
+        [p for i, p in enumerate(p_a) if i not in matched_a],
+        [p for j, p in enumerate(p_b) if j not in matched_b],
+    ]) / 2
+    score = 1 - (2 * _entropy(merged) - _entropy(p_a) - _entropy(p_b)) / np.log(4)
+    return min(1., score), len(pairs)
+
+
+@pytest.fixture(scope='module')
+def spectra():
+    peak_lists, precursors = _random_spectra(120)
+    arrays = SpectrumArrays.from_peak_lists(peak_lists, precursor_mzs=precursors)
+    rng = np.random.default_rng(1)
+    idcs_a, idcs_b = rng.integers(0, len(peak_lists), 1500), rng.integers(0, len(peak_lists), 1500)
+    return peak_lists, precursors, arrays, idcs_a, idcs_b
+
+
+def test_cosine_batch(spectra):
+    peak_lists, _, arrays, idcs_a, idcs_b = spectra
+    scores, n_hits = cosine_similarity_batch(arrays, arrays, MAX_DMZ_DA, idcs_a, idcs_b, batch_size=200)
+    assert np.nanmax(scores) > 0.9  # the fixture has matching spectra
+    for metric, scalar in [('cosine_sim', cosine_similarity_sym), ('cosine_fwd', cosine_similarity_forward),
+                           ('cosine_bwd', cosine_similarity_backward)]:
+        scores, n_hits = score_pairs(metric, arrays, arrays, MAX_DMZ_DA, idcs_a, idcs_b, batch_size=200)
+        for i, j, score, n in zip(idcs_a, idcs_b, scores, n_hits):
+            expected, expected_n = scalar(peak_lists[i], peak_lists[j], MAX_DMZ_DA, return_nhits=True)
+            assert score == pytest.approx(expected, abs=1e-12), (metric, i, j)
+            assert n == expected_n, (metric, i, j)
+
+
+def test_modified_cosine_batch(spectra):
+    peak_lists, precursors, arrays, idcs_a, idcs_b = spectra
+    scores, n_hits = modified_cosine_batch(arrays, arrays, MAX_DMZ_DA, idcs_a, idcs_b, batch_size=200, n_workers=2)
+    for i, j, score, n in zip(idcs_a, idcs_b, scores, n_hits):
+        expected, expected_n = _modified_cosine_reference(peak_lists[i], peak_lists[j], precursors[i], precursors[j])
+        assert score == pytest.approx(expected, abs=1e-12), (i, j)
+        assert n == expected_n, (i, j)
+        assert (score, n) == pytest.approx(modified_cosine(
+            peak_lists[i], peak_lists[j], MAX_DMZ_DA, return_nhits=True,
+            precursor_mz_ref=precursors[i], precursor_mz_meas=precursors[j]
+        ))
+
+
+def test_entropy(spectra):
+    peak_lists, _, arrays, idcs_a, idcs_b = spectra
+    scores, n_hits = score_pairs('entropy', arrays, arrays, MAX_DMZ_DA, idcs_a, idcs_b, batch_size=200)
+    for i, j, score, n in zip(idcs_a, idcs_b, scores, n_hits):
+        expected, expected_n = _entropy_reference(peak_lists[i], peak_lists[j])
+        assert score == pytest.approx(expected, abs=1e-9), (i, j)
+        assert n == expected_n, (i, j)
+        assert score == pytest.approx(entropy_similarity(peak_lists[i], peak_lists[j], MAX_DMZ_DA)[0])
+    assert entropy_similarity(peak_lists[0], peak_lists[0], MAX_DMZ_DA)[0] == pytest.approx(1.)
+
+
+@pytest.mark.parametrize('metric', sorted(set(METRICS)))
+def test_empty_and_missing_spectra(metric):
+    spectrum = PeakList(mzs=[100., 200.], intensities=[1., 2.])
+    arrays = SpectrumArrays.from_peak_lists(
+        [spectrum, PeakList(mzs=[], intensities=[]), None], precursor_mzs=[300., 300., 300.]
+    )
+    scores, n_hits = score_pairs(metric, arrays, arrays, MAX_DMZ_DA, [0, 1, 0, 2], [1, 0, 2, 2])
+    assert np.isnan(scores).all()
+    assert (n_hits == 0).all()
+
+    scalar = METRICS[metric].scalar
+    for ref, meas in [(spectrum, None), (None, spectrum), (None, None)]:
+        score, n = scalar(ref, meas, MAX_DMZ_DA, return_nhits=True)
+        assert np.isnan(score) and n == 0
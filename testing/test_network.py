@@ -0,0 +1,73 @@
+"""
+FeatureManagerDB.build_similarity_network on the MSP file of test_duplicates:
+1 and 2 share their spectrum, 4, 5 and 6 have similar spectra, 3 and 9 are
+different and 7 and 8 have no MS2.
+"""
+import os
+
+import pytest
+
+from msIO.feature_managers.db import Library
+from msIO.sql.from_library import build_library
+
+PATH_MSP = os.path.join(os.path.dirname(__file__), 'data', 'duplicates.msp')
+
+
+@pytest.fixture
+def library(tmp_path) -> Library:
+    db_file = str(tmp_path / 'library.db')
+    build_library(db_file, [PATH_MSP], n_workers=1)
+    return Library(db_file)
+
+
+def _pairs(network) -> list[tuple[int, int]]:
+    return list(zip(network.feature_id_a.tolist(), network.feature_id_b.tolist()))
+
+
+def test_build_similarity_network(library):
+    network = library.build_similarity_network(min_matched_peaks=2, store=False)
+    assert _pairs(network) == [(1, 2), (4, 5), (4, 6), (5, 6)]
+    assert (network.score >= 0.7).all()
+    assert network.n_matched_peaks.tolist() == [4, 4, 3, 3]
+    assert network.precursor_delta.to_numpy() == pytest.approx([0.002, 0.003, 0.006, 0.003])
+
+    # of 4, 5 and 6 only 4-6 is the best edge of both its features
+    network = library.build_similarity_network(min_matched_peaks=2, top_k=1, store=False)
+    assert _pairs(network) == [(1, 2), (4, 6)]
+
+    network = library.build_similarity_network(min_matched_peaks=2, max_precursor_delta=5e-3, store=False)
+    assert _pairs(network) == [(1, 2), (4, 5), (5, 6)]
+
+
+def test_build_similarity_network_precursor_window(library):
+    """min_shared_peaks=0 scores all pairs within the precursor window."""
+    network = library.build_similarity_network(
+        min_score=0., min_matched_peaks=0, min_shared_peaks=0, max_precursor_delta=5e-3, store=False
+    )
+    assert _pairs(network) == [(1, 2), (1, 3), (2, 3), (4, 5), (5, 6)]
+    assert network.score.tolist()[1:3] == [0., 0.]
+
+    network = library.build_similarity_network(min_matched_peaks=2, min_shared_peaks=0, max_precursor_delta=1.)
+    assert _pairs(network) == [(1, 2), (4, 5), (4, 6), (5, 6)]
+    with pytest.raises(AssertionError):
+        library.build_similarity_network(min_shared_peaks=0)
+
+
+def test_similarity_neighbors(library):
+    network = library.build_similarity_network(min_matched_peaks=2)
+    assert _pairs(library.get_similarity_network()) == _pairs(network)
+    assert set(library.get_similarity_network(as_graph=True).edges) == set(_pairs(network))
+
+    # the cache is written by store=True, other instances keep the adjacency in memory
+    assert os.path.exists(f'{library.path_file}.similarity_network.npz')
+    os.remove(f'{library.path_file}.similarity_network.npz')
+    library = Library(library.path_file)
+    neighbors = library.get_similarity_neighbors(5)
+    assert neighbors.index.tolist() == [4, 6]
+    assert neighbors.tolist() == pytest.approx(network.score.tolist()[1::2])
+    assert library.get_similarity_neighbors(9).empty
+    assert not os.path.exists(f'{library.path_file}.similarity_network.npz')
+
+    library = Library(library.path_file)
+    assert library.get_similarity_neighbors(5, use_cache=True).index.tolist() == [4, 6]
+    assert os.path.exists(f'{library.path_file}.similarity_network.npz')
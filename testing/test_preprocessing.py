@@ -0,0 +1,144 @@
+"""
+The vectorized preprocessing steps against per-spectrum implementations, and
+Library.find_matches with preprocessing (list and table results).
+"""
+import os
+
+import numpy as np
+import pytest
+
+from msIO import PeakList
+from msIO.feature_managers.db import Library
+from msIO.list_of_ions.base import SpectrumArrays
+from msIO.preprocessing import (
+    Preprocessing, ScaleIntensities, RelativeNoiseThreshold, KeepTopN, RemovePrecursor, MergePeaks
+)
+from msIO.sql.from_library import build_library
+
+PATH_MSP = os.path.join(os.path.dirname(__file__), 'data', 'duplicates.msp')
+
+
+def _random_spectra(n: int, seed: int = 0) -> tuple[list[PeakList], list[float | None]]:
+    rng = np.random.default_rng(seed)
+    spectra, precursors = [], []
+    for i in range(n):
+        k = int(rng.integers(0, 25))
+        # clusters of close peaks for MergePeaks, repeated intensities for ties in KeepTopN
+        mzs = np.sort(np.round(rng.uniform(50, 400, k), 2) + rng.choice([0., 0.002, 0.004], k))
+        intensities = rng.choice([1., 5., 10., 50., 100.], k) * rng.choice([1., 1.5], k)
+        spectra.append(PeakList(mzs=mzs.tolist(), intensities=intensities.tolist()))
+        precursors.append(None if i % 5 == 0 else float(rng.uniform(100, 400)))
+    return spectra, precursors
+
+
+def _reference(step, mzs: np.ndarray, intensities: np.ndarray, precursor: float | None):
+    """One spectrum processed peak by peak."""
+    if isinstance(step, ScaleIntensities):
+        return mzs, np.sqrt(intensities) if step.method == 'sqrt' else np.log1p(intensities)
+    if isinstance(step, RelativeNoiseThreshold):
+        keep = intensities >= step.min_rel_intensity * intensities.max(initial=0)
+        return mzs[keep], intensities[keep]
+    if isinstance(step, KeepTopN):
+        ranked = sorted(range(len(mzs)), key=lambda i: (-intensities[i], mzs[i]))[:step.n]
+        keep = np.isin(np.arange(len(mzs)), ranked)
+        return mzs[keep], intensities[keep]
+    if isinstance(step, RemovePrecursor):
+        if precursor is None:
+            return mzs, intensities
+        keep = [not (abs(mz - precursor) <= step.window_da or (step.remove_above and mz > precursor)) for mz in mzs]
+        return mzs[keep], intensities[keep]
+    if isinstance(step, MergePeaks):
+        merged_mzs, merged_intensities, cluster = [], [], []
+        for i in range(len(mzs)):
+            if cluster and mzs[i] - mzs[i - 1] >= step.max_dmz_da:
+                merged_mzs.append(np.average(mzs[cluster], weights=intensities[cluster]))
+                merged_intensities.append(intensities[cluster].sum())
+                cluster = []
+            cluster.append(i)
+        if cluster:
+            merged_mzs.append(np.average(mzs[cluster], weights=intensities[cluster]))
+            merged_intensities.append(intensities[cluster].sum())
+        return np.asarray(merged_mzs), np.asarray(merged_intensities)
+    raise ValueError(step)
+
+
+@pytest.mark.parametrize('step', [
+    ScaleIntensities('sqrt'), ScaleIntensities('log'), RelativeNoiseThreshold(0.1), KeepTopN(3), KeepTopN(0),
+    RemovePrecursor(1.5), RemovePrecursor(1.5, remove_above=True), MergePeaks(0.003)
+])
+def test_steps(step):
+    peak_lists, precursors = _random_spectra(200)
+    processed = step(SpectrumArrays.from_peak_lists(peak_lists, precursor_mzs=precursors))
+    assert len(processed) == len(peak_lists)
+    for i, (pl, precursor) in enumerate(zip(peak_lists, precursors)):
+        mzs, intensities = processed.get(i)
+        expected_mzs, expected_intensities = _reference(
+            step, np.asarray(pl.mzs, dtype=float), np.asarray(pl.intensities, dtype=float), precursor
+        )
+        assert mzs == pytest.approx(expected_mzs), i
+        assert intensities == pytest.approx(expected_intensities), i
+
+
+def test_pipeline():
+    peak_lists, precursors = _random_spectra(50)
+    spectra = SpectrumArrays.from_peak_lists(peak_lists, precursor_mzs=precursors)
+    steps = [MergePeaks(0.003), RemovePrecursor(1.5), KeepTopN(5), ScaleIntensities('sqrt')]
+    processed = Preprocessing(steps)(spectra)
+    expected = spectra
+    for step in steps:
+        expected = step(expected)
+    assert np.array_equal(processed.offsets, expected.offsets)
+    assert np.array_equal(processed.mzs, expected.mzs)
+    assert np.array_equal(processed.intensities, expected.intensities)
+
+    assert Preprocessing(steps).key == Preprocessing(list(steps)).key
+    assert Preprocessing(steps).key != Preprocessing(steps[:-1] + [ScaleIntensities('log')]).key
+    with pytest.raises(ValueError):
+        ScaleIntensities('cbrt')(spectra)
+
+
+@pytest.fixture(scope='module')
+def library(tmp_path_factory) -> Library:
+    db_file = str(tmp_path_factory.mktemp('library') / 'library.db')
+    build_library(db_file, [PATH_MSP], n_workers=1)
+    return Library(db_file)
+
+
+def _list_scores(matches: list[list[dict]]) -> list[tuple[int, int, float]]:
+    return [(i, m['feature_id'], m['ms2_score']) for i, matches_query in enumerate(matches) for m in matches_query]
+
+
+def _table_scores(table) -> list[tuple[int, int, float]]:
+    return list(zip(table.query_index.tolist(), table.feature_id.tolist(), table.ms2_score.tolist()))
+
+
+@pytest.mark.parametrize('preprocessing', [
+    Preprocessing([KeepTopN(2), ScaleIntensities('sqrt')]),
+    Preprocessing([RelativeNoiseThreshold(0.5)]),
+    Preprocessing([KeepTopN(0)]),  # nothing left on both sides
+])
+def test_find_matches_with_preprocessing(library, preprocessing):
+    f_ids = [1, 3, 4, 5, 9]
+    spectra = library.get_ms_spectra(f_ids, level=2)
+    mzs = [library.mzs[f_id] + 1e-3 for f_id in f_ids]
+    ms2_spectra = [spectra.get(f_id) for f_id in f_ids]
+
+    kwargs = dict(max_dmz_da=0.01, ms2_spectra=ms2_spectra, min_ms2_score=0., preprocessing=preprocessing)
+    matches = _list_scores(library.find_matches(mzs, **kwargs))
+    table = _table_scores(library.find_matches(mzs, as_table=True, **kwargs))
+    assert len(matches) == len(table) > 0
+    for (i, f_id, score), (i_table, f_id_table, score_table) in zip(sorted(matches), sorted(table)):
+        assert (i, f_id) == (i_table, f_id_table)
+        assert score == pytest.approx(score_table, nan_ok=True)
+
+
+def test_find_matches_emptied_query(library):
+    """A query spectrum without peaks after preprocessing is treated as missing."""
+    kwargs = dict(
+        max_dmz_da=0.01, ms2_spectra=[PeakList(mzs=[299.5], intensities=[100.])],
+        preprocessing=Preprocessing([RemovePrecursor(1.5)])
+    )
+    matches = _list_scores(library.find_matches([300.1], **kwargs))
+    table = _table_scores(library.find_matches([300.1], as_table=True, **kwargs))
+    assert [(i, f_id) for i, f_id, _ in matches] == [(i, f_id) for i, f_id, _ in table] == [(0, 1), (0, 2), (0, 3)]
+    assert all(np.isnan(score) for *_, score in matches + table)